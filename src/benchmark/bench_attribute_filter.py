@@ -0,0 +1,74 @@
+"""
+Compare the precompiled AttributeFilter rules with the per request
+re.compile implementation they replaced.
+
+    cd src && python -m benchmark.bench_attribute_filter
+"""
+import re
+import timeit
+
+from satosa.util import get_dict_defaults
+
+from scz_micro_services.attribute_filter import AttributeFilter
+
+N_RULES = 50
+N_ATTRIBUTES = 30
+N_VALUES = 20
+
+CONFIG = {
+    "attribute_allow": {
+        "default": {
+            "default": {"^attr{}$".format(i): ["^value{}-.*$".format(j) for j in range(i % 5 + 1)]
+                        for i in range(N_RULES)},
+        },
+    },
+    "attribute_deny": {
+        "default": {
+            "default": {"^attr{}".format(i): ["-{}$".format(i)] for i in range(0, N_RULES, 3)},
+        },
+    },
+}
+
+ATTRIBUTES = {"attr{}".format(i): ["value{}-{}".format(j % 5, j) for j in range(N_VALUES)]
+              for i in range(N_ATTRIBUTES)}
+
+
+def legacy_apply_filter(attributes, provider, requester):
+    def filter_attributes(filters):
+        attributes_filter = {}
+        for f, fv in filters.items():
+            for a in attributes.keys():
+                if re.compile(f).search(a):
+                    attributes_filter.setdefault(a, []).extend(fv)
+        return {a: list(filter(re.compile("|".join(f)).search, attributes.get(a, None))) for a, f in
+                attributes_filter.items()}
+
+    allow = filter_attributes(get_dict_defaults(CONFIG["attribute_allow"], provider, requester))
+    deny = filter_attributes(get_dict_defaults(CONFIG["attribute_deny"], provider, requester))
+    for a, v in deny.items():
+        for r in v:
+            if a in allow and r in allow[a]:
+                allow[a].remove(r)
+    return {a: v for a, v in allow.items() if len(v)}
+
+
+class Context(object):
+    state = None
+
+
+def main(number=200):
+    attribute_filter = AttributeFilter(CONFIG, name="attribute_filter", base_url="http://localhost")
+    context = Context()
+
+    assert legacy_apply_filter(ATTRIBUTES, "idp", "sp") == attribute_filter._apply_filter(context, ATTRIBUTES,
+                                                                                          "idp", "sp")
+
+    legacy = timeit.timeit(lambda: legacy_apply_filter(ATTRIBUTES, "idp", "sp"), number=number)
+    compiled = timeit.timeit(lambda: attribute_filter._apply_filter(context, ATTRIBUTES, "idp", "sp"), number=number)
+    print("{} rules, {} attributes x {} values".format(N_RULES, N_ATTRIBUTES, N_VALUES))
+    print("legacy:   {:8.1f} us/call".format(legacy / number * 1e6))
+    print("compiled: {:8.1f} us/call ({:.1f}x)".format(compiled / number * 1e6, legacy / compiled))
+
+
+if __name__ == "__main__":
+    main()
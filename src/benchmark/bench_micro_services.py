@@ -0,0 +1,284 @@
+"""
+Measure the per call latency (p50/p99) and allocations of every micro
+service with synthetic internal responses.
+
+DBAttributeStore and AttributeCheck query a local in-memory stand-in for
+MySQL unless --mysql-host is given, SBSAttributeStore talks to a mocked SBS
+that answers after --sbs-latency seconds.
+
+    cd src && python -m benchmark.bench_micro_services --size 50 --rounds 1000
+"""
+import argparse
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import requests_mock
+import yaml
+
+from benchmark import harness, standin, synthetic
+from scz_micro_services.attribute_filter import AttributeFilter
+from scz_micro_services.custom_alias import CustomAlias
+from scz_micro_services.custom_uid import CustomUID
+from scz_micro_services.instrumentation import REGISTRY
+from scz_micro_services.metainfo import MetaInfo
+from scz_micro_services.r_and_s_acl import RandSAcl
+from scz_micro_services.sbs_attribute_store import SBSAttributeStore
+
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+
+BASE_URL = "http://localhost"
+SBS_URL = "http://sbs.localhost/"
+INTERNAL_ATTRIBUTES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "test",
+                                   "internal_attributes.yaml")
+NAME_ID = '<saml:NameID xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ' \
+          'Format="urn:oasis:names:tc:SAML:2.0:nameid-format:persistent">{}</saml:NameID>'
+R_AND_S = {
+    "edupersonprincipalname": "eduPersonPrincipalName",
+    "edupersontargetedid": "eduPersonTargetedID",
+    "displayname": "displayName",
+    "givenname": "givenName",
+    "sn": "sn",
+    "mail": "mail",
+}
+
+
+def _internal_attributes():
+    with open(INTERNAL_ATTRIBUTES) as f:
+        return yaml.safe_load(f)
+
+
+def _service(cls, config, *args):
+    service = cls(config, *args, name=cls.__name__, base_url=BASE_URL)
+    service.next = lambda context, data: data
+    return service
+
+
+def _requests(options):
+    """
+    Fresh (context, data) for the next user, cycling through options.users users
+    """
+    users = itertools.cycle(range(options.users))
+    return lambda: synthetic.make_request(next(users), options.size)
+
+
+def _custom_uid(options, select, targeted_id_xml=False):
+    service = _service(CustomUID, {"select": select, "custom_attribute": "cmuid", "user_id": True})
+    requests = _requests(options)
+
+    def setup():
+        context, data = requests()
+        if targeted_id_xml:
+            data.attributes["eduPersonTargetedID"] = [NAME_ID.format(value) for value in
+                                                      data.attributes["eduPersonTargetedID"]]
+        return context, data
+
+    return service.process, setup
+
+
+def bench_custom_uid(options):
+    return _custom_uid(options, ["eduPersonPrincipalName", "mail"])
+
+
+def bench_custom_uid_targeted_id(options):
+    return _custom_uid(options, ["eduPersonTargetedID", "eduPersonPrincipalName"], targeted_id_xml=True)
+
+
+def bench_custom_uid_multi_valued(options):
+    return _custom_uid(options, ["eduPersonPrincipalName", "isMemberOf"])
+
+
+def bench_attribute_filter(options):
+    config = {
+        "attribute_allow": {"": {"": {
+            "^(eduPerson|displayName|givenName|sn|mail)": [".*"],
+            "^isMemberOf$": ["^urn:collab:group:example.org:"],
+            "^urn:bench:": ["-[02]$"],
+        }}},
+        "attribute_deny": {"": {"": {"^isMemberOf$": ["group1[0-9]$"]}}},
+    }
+    return _service(AttributeFilter, config).process, _requests(options)
+
+
+def bench_r_and_s_acl(options):
+    service = _service(RandSAcl, {"attribute_mapping": R_AND_S, "access_denied": "/static/denied"})
+    return service.process, _requests(options)
+
+
+def bench_metainfo(options):
+    class MetadataStore(object):
+        def name(self, issuer):
+            return "Example IdP"
+
+        def __getitem__(self, issuer):
+            return {"extensions": {"extension_elements": [{"registration_authority": "http://www.example.org/"}]}}
+
+    service = _service(MetaInfo, {}, _internal_attributes())
+    requests = _requests(options)
+    metadata_store = MetadataStore()
+
+    def setup():
+        context, data = requests()
+        context.internal_data["metadata_store"] = metadata_store
+        return context, data
+
+    return service.process, setup
+
+
+def bench_custom_alias(options):
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "page.html"), "w") as f:
+        f.write("<html><body>{}</body></html>".format("<p>%custom%</p>" * options.size))
+    service = _service(CustomAlias, {"locations": {"alias": directory}})
+    requests = _requests(options)
+
+    def setup():
+        context, _ = requests()
+        context._path = "alias/page.html"
+        context.state["substitutions"] = {"%custom%": synthetic.IDP}
+        return (context,)
+
+    return service._handle, setup
+
+
+def bench_sbs_attribute_store(options):
+    with open(os.path.join(os.path.dirname(INTERNAL_ATTRIBUTES), "mock", "sbs_attributes.json")) as f:
+        body = f.read()
+
+    def respond(request, context):
+        if options.sbs_latency:
+            time.sleep(options.sbs_latency)
+        context.headers["Content-Type"] = "application/json"
+        return body
+
+    mocker = requests_mock.Mocker()
+    mocker.get("{}api/users/attributes".format(SBS_URL), text=respond)
+    mocker.start()
+    options.cleanup.append(mocker.stop)
+
+    config = {"sbs_api_user": "sysread", "sbs_api_password": "secret", "sbs_api_base_url": SBS_URL}
+    return _service(SBSAttributeStore, config, _internal_attributes()).process, _requests(options)
+
+
+def _db_config(options):
+    if options.mysql_host:
+        return {"db_host": options.mysql_host, "db_user": options.mysql_user, "db_password": options.mysql_password,
+                "db_schema": options.mysql_schema}
+
+    database = standin.Database(options.users, options.size)
+    patch = mock.patch.object(MySQLdb, "connect", database.connect)
+    patch.start()
+    options.cleanup.extend([patch.stop, database.close])
+    # A host per database keeps the connection pools apart
+    return {"db_host": database.uri, "db_user": "bench", "db_password": "bench", "db_schema": "bench"}
+
+
+def _db_attribute_store(config):
+    from scz_micro_services.db_attribute_store import DBAttributeStore
+
+    return _service(DBAttributeStore, config, _internal_attributes())
+
+
+def bench_db_attribute_store(options):
+    config = dict(_db_config(options), idp_identifiers=["eduPersonPrincipalName"], user_id=False,
+                  snapshot=options.db_snapshot)
+    service = _db_attribute_store(config)
+    options.cleanup.append(service.close)
+    # Measure the snapshot, not the fallback to the DB while it loads
+    while not all(stats['loaded'] for stats in service.stats().values()):
+        time.sleep(0.01)
+    return service.process, _requests(options)
+
+
+def bench_db_attribute_store_identifiers(options):
+    """
+    Lookups with 2 to size + 1 identifier values, a different IN list length per round
+    """
+    config = dict(_db_config(options), idp_identifiers=["eduPersonPrincipalName", "isMemberOf"], user_id=False)
+    service = _db_attribute_store(config)
+    requests = _requests(options)
+    counts = itertools.cycle(range(1, options.size + 1))
+
+    def setup():
+        context, data = requests()
+        data.attributes["isMemberOf"] = data.attributes["isMemberOf"][:next(counts)]
+        return context, data
+
+    return service.process, setup
+
+
+def bench_attribute_check(options):
+    from scz_micro_services.attribute_check import AttributeCheck
+
+    config = dict(_db_config(options), changed="/changed", store_digests=True)
+    return _service(AttributeCheck, config, _internal_attributes()).process, _requests(options)
+
+
+BENCHMARKS = [
+    ("CustomUID", bench_custom_uid, False),
+    ("CustomUID/targetedID", bench_custom_uid_targeted_id, False),
+    ("CustomUID/isMemberOf", bench_custom_uid_multi_valued, False),
+    ("AttributeFilter", bench_attribute_filter, False),
+    ("RandSAcl", bench_r_and_s_acl, False),
+    ("DBAttributeStore", bench_db_attribute_store, True),
+    ("DBAttributeStore/identifiers", bench_db_attribute_store_identifiers, True),
+    ("AttributeCheck", bench_attribute_check, True),
+    ("SBSAttributeStore", bench_sbs_attribute_store, False),
+    ("MetaInfo", bench_metainfo, False),
+    ("CustomAlias", bench_custom_alias, False),
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Micro service latency benchmarks")
+    parser.add_argument("--size", type=int, default=20,
+                        help="Number of group memberships and extra attributes per response")
+    parser.add_argument("--users", type=int, default=100, help="Number of distinct users to cycle through")
+    parser.add_argument("--rounds", type=int, default=1000, help="Number of timed calls per service")
+    parser.add_argument("--alloc-rounds", type=int, default=100, help="Number of calls traced for allocations")
+    parser.add_argument("--sbs-latency", type=float, default=0.0, help="Seconds the mocked SBS takes to answer")
+    parser.add_argument("--only", action="append", default=[], help="Only run this service, may be repeated")
+    parser.add_argument("--db-snapshot", action="store_true", help="Run DBAttributeStore in snapshot mode")
+    parser.add_argument("--metrics", action="store_true", help="Record metrics, as when the Metrics service is loaded")
+    parser.add_argument("--mysql-host", help="Use this MySQL server instead of the stand-in")
+    parser.add_argument("--mysql-user", default="bench")
+    parser.add_argument("--mysql-password", default="")
+    parser.add_argument("--mysql-schema", default="bench")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    # Benchmark the services, not the log handlers
+    logging.getLogger("satosa").setLevel(logging.INFO)
+    REGISTRY.enabled = options.metrics
+
+    results = []
+    for name, bench, needs_db in BENCHMARKS:
+        if options.only and name not in options.only:
+            continue
+        if needs_db and MySQLdb is None:
+            print("{}: skipped, MySQLdb is not installed".format(name), file=sys.stderr)
+            continue
+        options.cleanup = []
+        try:
+            fn, setup = bench(options)
+            results.append(harness.measure(name, fn, setup, rounds=options.rounds, alloc_rounds=options.alloc_rounds))
+        finally:
+            for cleanup in reversed(options.cleanup):
+                cleanup()
+
+    print("size={} users={} sbs_latency={}s metrics={}".format(options.size, options.users, options.sbs_latency,
+                                                                options.metrics))
+    print(harness.report(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Measure the latency and memory allocation of a single call
+"""
+import time
+import tracemalloc
+from collections import namedtuple
+
+Result = namedtuple("Result", ["name", "rounds", "p50", "p99", "mean", "alloc"])
+
+
+def percentile(values, p):
+    """
+    The p-th percentile of sorted values, nearest rank
+    """
+    index = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def _peak_allocation(fn, args):
+    """
+    The bytes allocated at the peak of fn(*args) on top of what was already allocated
+    """
+    if hasattr(tracemalloc, "reset_peak"):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(*args)
+        return tracemalloc.get_traced_memory()[1] - current
+    # Python < 3.9, restart tracing to reset the peak
+    tracemalloc.stop()
+    tracemalloc.start()
+    fn(*args)
+    return tracemalloc.get_traced_memory()[1]
+
+
+def measure(name, fn, setup=tuple, rounds=1000, warmup=10, alloc_rounds=100):
+    """
+    Call fn(*setup()) rounds times and return the latency percentiles in
+    seconds and the mean peak allocation per call in bytes. The time spent in
+    setup, which builds fresh arguments for every call, is not measured.
+
+    :param name: Name of the measurement
+    :param fn: The function to measure
+    :param setup: Returns the arguments for one call
+    :param rounds: Number of timed calls
+    :param warmup: Number of untimed calls before measuring, to fill caches and pools
+    :param alloc_rounds: Number of calls traced for allocations, tracing is slow
+    """
+    for _ in range(warmup):
+        fn(*setup())
+
+    timings = []
+    for _ in range(rounds):
+        args = setup()
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+
+    allocations = 0
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_rounds):
+            allocations += _peak_allocation(fn, setup())
+    finally:
+        tracemalloc.stop()
+
+    return Result(name, rounds, percentile(timings, 50), percentile(timings, 99), sum(timings) / len(timings),
+                  allocations / max(alloc_rounds, 1))
+
+
+def report(results):
+    """
+    Format results as a table, latencies in microseconds and allocations in KiB
+    """
+    width = max([20] + [len(r.name) for r in results])
+    lines = ["{:<{}} {:>7} {:>10} {:>10} {:>10} {:>12}".format("service", width, "rounds", "p50 us", "p99 us",
+                                                                "mean us", "alloc KiB")]
+    for r in results:
+        lines.append("{:<{}} {:>7} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.1f}".format(
+            r.name, width, r.rounds, r.p50 * 1e6, r.p99 * 1e6, r.mean * 1e6, r.alloc / 1024))
+    return "\n".join(lines)
@@ -0,0 +1,115 @@
+"""
+A local MySQL-compatible stand-in for the DB micro services, backed by an
+in-memory SQLite database that every connection shares.
+
+Only what DBAttributeStore and AttributeCheck use is supported: %s
+parameters, backquoted names and INSERT ... ON DUPLICATE KEY UPDATE.
+"""
+import itertools
+import json
+import re
+import sqlite3
+
+from scz_micro_services.zone_snapshot import collation_key
+
+from . import synthetic
+
+_VALUES = re.compile(r"VALUES\((`\w+`)\)")
+_databases = itertools.count()
+
+# The uid and metadata compare like in the default MySQL collations
+SCHEMA = [
+    "CREATE TABLE `zone_people` (`id` INTEGER PRIMARY KEY, `uid` TEXT COLLATE mysql, `attributes` TEXT)",
+    "CREATE INDEX `zone_people_uid` ON `zone_people` (`uid`)",
+    "CREATE TABLE `zone_services` (`id` INTEGER PRIMARY KEY, `metadata` TEXT COLLATE mysql)",
+    "CREATE TABLE `zone_person_zone_service` (`zone_person_id` INTEGER, `zone_service_id` INTEGER)",
+    "CREATE TABLE `attributes_hash` (`nameid` TEXT PRIMARY KEY, `hash` TEXT, `digests` TEXT)",
+]
+
+
+def _collate(a, b):
+    a, b = collation_key(a), collation_key(b)
+    return (a > b) - (a < b)
+
+
+def _translate(query):
+    if "ON DUPLICATE KEY UPDATE" in query:
+        insert, update = query.split("ON DUPLICATE KEY UPDATE")
+        query = insert + "ON CONFLICT(`nameid`) DO UPDATE SET" + _VALUES.sub(r"excluded.\1", update)
+    return query.replace("%s", "?")
+
+
+class Cursor(object):
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, args=()):
+        return self._cursor.execute(_translate(query), list(args))
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection(object):
+
+    def __init__(self, uri, autocommit=False):
+        self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                           isolation_level=None if autocommit else "")
+        self._connection.create_collation("mysql", _collate)
+
+    def cursor(self, cursorclass=None):
+        # SQLite cursors stream rows, whatever the cursor class
+        return Cursor(self._connection.cursor())
+
+    def ping(self):
+        self._connection.execute("SELECT 1")
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def close(self):
+        self._connection.close()
+
+
+class Database(object):
+    """
+    A seeded database, connect has the signature of MySQLdb.connect
+    """
+
+    def __init__(self, users, size, services=(synthetic.SP,)):
+        self.uri = "file:standin{}?mode=memory&cache=shared".format(next(_databases))
+        # The in-memory database lives as long as this connection
+        self._keepalive = Connection(self.uri)
+        cursor = self._keepalive.cursor()
+        for statement in SCHEMA:
+            cursor.execute(statement)
+        for service_id, metadata in enumerate(services):
+            cursor.execute("INSERT INTO `zone_services` VALUES (%s, %s)", [service_id, metadata])
+        for n in range(users):
+            # Stored like the zone database does, by saml attribute name
+            attributes = {"urn:mace:dir:attribute-def:isMemberOf": ["urn:collab:org:{}:co{}".format(n, i) for i in range(size)],
+                          "urn:mace:dir:attribute-def:eduPersonEntitlement": "urn:mace:example.org:entitlement{}".format(n)}
+            cursor.execute("INSERT INTO `zone_people` VALUES (%s, %s, %s)", [n, synthetic.eppn(n), json.dumps(attributes)])
+            for service_id in range(len(services)):
+                cursor.execute("INSERT INTO `zone_person_zone_service` VALUES (%s, %s)", [n, service_id])
+        self._keepalive.commit()
+        cursor.close()
+
+    def connect(self, *args, autocommit=False, **kwargs):
+        return Connection(self.uri, autocommit=autocommit)
+
+    def close(self):
+        self._keepalive.close()
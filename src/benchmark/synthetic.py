@@ -0,0 +1,53 @@
+"""
+Synthetic SATOSA contexts and internal responses of configurable size
+"""
+from satosa.context import Context
+from satosa.internal_data import AuthenticationInformation, InternalResponse
+from satosa.state import State
+
+IDP = "https://idp.example.org"
+SP = "https://sp.example.org"
+
+
+def user_id(n):
+    return "urn:collab:person:example.org:user{}".format(n)
+
+
+def eppn(n):
+    return "user{}@example.org".format(n)
+
+
+def make_attributes(n, size):
+    """
+    The R&S attributes of user n, size group memberships and size extra
+    attributes with a few values each
+    """
+    attributes = {
+        "eduPersonPrincipalName": [eppn(n)],
+        "eduPersonTargetedID": [user_id(n)],
+        "displayName": ["User {}".format(n)],
+        "givenName": ["User"],
+        "sn": [str(n)],
+        "mail": [eppn(n), "user{}@mail.example.org".format(n)],
+        "isMemberOf": ["urn:collab:group:example.org:group{}".format(i) for i in range(size)],
+    }
+    for i in range(size):
+        attributes["urn:bench:attr{}".format(i)] = ["value{}-{}".format(i, j) for j in range(3)]
+    return attributes
+
+
+def make_request(n, size, requester=SP, issuer=IDP):
+    """
+    A fresh (context, internal response) pair for user n, as a response micro service receives it
+    """
+    data = InternalResponse(auth_info=AuthenticationInformation(None, None, issuer))
+    data.user_id = user_id(n)
+    data.requester = requester
+    data.attributes = make_attributes(n, size)
+    data.name_id = None
+
+    context = Context()
+    context.state = State()
+    context.state["SATOSA_BASE"] = {"requester": requester}
+    context.state["IDHASHER"] = {}
+    return context, data
@@ -0,0 +1,197 @@
+"""
+SATOSA microservice that runs several attribute sources, like the
+DBAttributeStore and the SBSAttributeStore, concurrently and merges
+the attributes they add within an overall deadline.
+"""
+
+import atexit
+import copy
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from pydoc import locate
+
+from satosa.exception import SATOSAConfigurationError
+from satosa.internal_data import InternalResponse
+from satosa.micro_services.base import ResponseMicroService
+from satosa.state import State
+
+from .attribute_merge import extend_unique
+from .instrumentation import Instrumented
+from .logging_util import get_logger, log
+
+STATE_KEY = "ATTRIBUTE_AGGREGATOR"
+
+_DELETED = object()
+
+
+def _state_items(state):
+    return state.state_dict if isinstance(state, State) else dict(state)
+
+
+class AttributeAggregator(Instrumented, ResponseMicroService):
+    """
+    Every source is a response micro service, configured like one in the
+    SATOSA proxy configuration, that adds attributes to the response it is
+    given. Each source gets its own copy of the response on a shared thread
+    pool. The sources that answer within ``deadline`` seconds are merged,
+    the others are logged and recorded in the state.
+
+    An attribute added or changed by more than one source is taken from the
+    source that comes first in its ``precedence`` list, by default the order
+    of the sources. The values of the attributes in ``merge`` are combined
+    from all sources in that order.
+
+    Every source also gets its own copy of the context and its state. The
+    state keys that the merged sources set, change or delete are copied back
+    by the same precedence, a key by the first source in its ``precedence``
+    list. Other changes to the context are not kept.
+    """
+    logprefix = "ATTRIBUTE_AGGREGATOR:"
+
+    def __init__(self, config, internal_attributes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
+        self.config = config
+        self.deadline = config.get('deadline', 5)
+        self.sources = [self._load_source(source, internal_attributes, kwargs.get('base_url'))
+                        for source in config.get('sources', [])]
+        names = [source.name for source in self.sources]
+        if len(set(names)) != len(names):
+            raise SATOSAConfigurationError("{} Source names must be unique: {}".format(self.logprefix, names))
+        self.precedence = {attribute: [name for name in order if name in names] + [n for n in names if n not in order]
+                           for attribute, order in config.get('precedence', {}).items()}
+        self.merge = frozenset(config.get('merge', []))
+        self.executor = ThreadPoolExecutor(max_workers=config.get('workers', 4 * max(len(self.sources), 1)))
+        atexit.register(self.executor.shutdown, wait=False)
+        self._stats_lock = threading.Lock()
+        self._stats = {name: {'answered': 0, 'timed_out': 0, 'failed': 0} for name in names}
+
+    @staticmethod
+    def _load_source(source, internal_attributes, base_url):
+        if 'module' not in source or 'name' not in source:
+            raise SATOSAConfigurationError("Sources need a module and a name: {}".format(source))
+        module_class = locate(source['module'])
+        if module_class is None or not issubclass(module_class, ResponseMicroService):
+            raise SATOSAConfigurationError("Can't find response micro service '{}'".format(source['module']))
+        service = module_class(internal_attributes=internal_attributes, config=source.get('config', {}),
+                               name=source['name'], base_url=base_url)
+        # A source ends its process by handing its copy of the response back
+        service.next = lambda context, data: data
+        return service
+
+    def stats(self):
+        """
+        :return: The number of answered, timed out and failed lookups, per source
+        """
+        with self._stats_lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def component_stats(self):
+        return {"source {}".format(name): stats for name, stats in self.stats().items()}
+
+    def _count(self, name, outcome):
+        with self._stats_lock:
+            self._stats[name][outcome] += 1
+
+    @staticmethod
+    def _copy_context(context):
+        copied = copy.copy(context)
+        copied.state = copy.deepcopy(context.state)
+        internal_data = getattr(context, 'internal_data', None)
+        if isinstance(internal_data, dict):
+            copied.internal_data = dict(internal_data)
+        return copied
+
+    @staticmethod
+    def _state_changes(original, state):
+        """
+        :return: The state keys that were set or changed and their values, _DELETED for deleted keys
+        """
+        changes = {key: value for key, value in _state_items(state).items() if original.get(key, _DELETED) != value}
+        changes.update((key, _DELETED) for key in original if key not in state)
+        return changes
+
+    def _merge_state(self, state, changes, names):
+        for key in sorted({key for values in changes.values() for key in values}):
+            order = self.precedence.get(key, names)
+            value = next(changes[name][key] for name in order if key in changes.get(name, {}))
+            if value is not _DELETED:
+                state[key] = value
+            elif key in state:
+                del state[key]
+
+    @staticmethod
+    def _copy(data):
+        copied = copy.copy(data)
+        copied.attributes = {k: list(v) if isinstance(v, list) else v for k, v in data.attributes.items()}
+        return copied
+
+    def _run(self, source, context, data, original, original_state):
+        result = source.process(context, data)
+        if not isinstance(result, InternalResponse):
+            raise TypeError("{} did not return the response but a {}".format(source.name, type(result).__name__))
+        # Only the attributes and state the source added or changed count
+        return ({k: v for k, v in result.attributes.items() if v != original.get(k)},
+                self._state_changes(original_state, context.state))
+
+    def _merged(self, attribute, provided, names):
+        order = self.precedence.get(attribute, names)
+        values = None
+        for name in order:
+            if attribute not in provided.get(name, {}):
+                continue
+            new_values = provided[name][attribute]
+            if values is None:
+                values = list(new_values) if isinstance(new_values, list) else new_values
+                if attribute not in self.merge:
+                    break
+            elif isinstance(values, list):
+                extend_unique(values, new_values if isinstance(new_values, list) else [new_values])
+        return values
+
+    def process(self, context, data):
+        logprefix = AttributeAggregator.logprefix
+        if not self.sources:
+            return super().process(context, data)
+
+        # Sources that miss the deadline keep running, they get copies so they never touch data or context
+        original = self._copy(data).attributes
+        original_state = _state_items(context.state)
+        futures = {self.executor.submit(self._run, source, self._copy_context(context), self._copy(data), original,
+                                        original_state): source.name
+                   for source in self.sources}
+        done, not_done = wait(futures, timeout=self.deadline)
+
+        names = [source.name for source in self.sources]
+        provided = {}
+        state_changes = {}
+        failed = []
+        for future in done:
+            name = futures[future]
+            try:
+                provided[name], state_changes[name] = future.result()
+            except Exception as err:
+                failed.append(name)
+                self._count(name, 'failed')
+                log(self.logger, logging.ERROR, "{} Source {} failed: {}", context.state, logprefix, name, err)
+            else:
+                self._count(name, 'answered')
+
+        timed_out = sorted(futures[future] for future in not_done)
+        for future in not_done:
+            future.cancel()
+            self._count(futures[future], 'timed_out')
+        if timed_out:
+            log(self.logger, logging.WARNING, "{} Continuing without {}, no answer within {} seconds", context.state,
+                logprefix, ", ".join(timed_out), self.deadline)
+        self._merge_state(context.state, state_changes, names)
+        context.state[STATE_KEY] = {'timed_out': timed_out, 'failed': sorted(failed)}
+
+        # Deterministic merge, independent of the order in which the sources answered
+        attributes = sorted({attribute for values in provided.values() for attribute in values})
+        for attribute in attributes:
+            data.attributes[attribute] = self._merged(attribute, provided, names)
+
+        log(self.logger, logging.DEBUG, "{} returning data.attributes {}", context.state, logprefix, data.attributes)
+        return super().process(context, data)
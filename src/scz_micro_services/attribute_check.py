@@ -3,21 +3,27 @@ SATOSA microservice that checks whether user attributes
 have changed since last visit
 """
 
-import copy
+import atexit
 import logging
-from base64 import b64encode
-from hashlib import sha256
+import threading
 
-import MySQLdb
 from satosa.attribute_mapping import AttributeMapper
-from satosa.logging_util import satosa_logging
 from satosa.micro_services.base import ResponseMicroService
 from satosa.response import Redirect
 
-logger = logging.getLogger('satosa')
+from .attribute_hash import (attribute_digests, attributes_hash, changed_attributes, encode_digests, is_legacy,
+                             legacy_hash)
+from .cache import TTLCache
+from .db_pool import mysql_pool, pool_settings
+from .instrumentation import Instrumented
+from .logging_util import get_logger, log
+from .sp_config import REQUIRED, SPConfig
+from .write_behind import WriteBehindQueue
 
+STATE_KEY = "ATTRIBUTE_CHECK"
 
-class AttributeCheck(ResponseMicroService):
+
+class AttributeCheck(Instrumented, ResponseMicroService):
     """
     ... some explanation
     """
@@ -25,153 +31,247 @@ class AttributeCheck(ResponseMicroService):
 
     logprefix = "ATTRIBUTE_CHECK:"
 
+    # Options that can be overridden per SP and their defaults
+    OPTIONS = [
+        ('db_host', REQUIRED),
+        ('db_user', REQUIRED),
+        ('db_schema', REQUIRED),
+        ('db_password', REQUIRED),
+        ('changed', REQUIRED),
+        ('store_digests', False),
+    ]
+
     def __init__(self, config, internal_attributes, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
         self.config = config
         self.converter = AttributeMapper(internal_attributes)
+        self.pool_settings = pool_settings(config)
+
+        self.write_behind = config.get('write_behind', False)
+        self.write_behind_queue_size = config.get('write_behind_queue_size', 1000)
+        self.write_behind_batch_size = config.get('write_behind_batch_size', 100)
+        self.write_behind_flush_interval = config.get('write_behind_flush_interval', 1.0)
+        self.writers = {}
+        self._writers_lock = threading.Lock()
+        if self.write_behind:
+            atexit.register(self.close)
+
+        # The hashes confirmed by this node are trusted for verified_ttl seconds, the consistency window
+        # within which changes stored by other nodes go unnoticed
+        self.verified = None
+        if config.get('verified_ttl'):
+            self.verified = TTLCache(maxsize=config.get('verified_cache_size', 10000), ttl=config['verified_ttl'])
+        self._verified_stats = {'hits': 0, 'misses': 0}
+        self._verified_lock = threading.Lock()
+
+        self.sp_config = SPConfig(config, self.OPTIONS, secrets=['db_password'], logprefix=self.logprefix)
+        for sp_config in self.sp_config.all():
+            self._get_pool(sp_config)
+
+    def _get_pool(self, config):
+        return mysql_pool(config, **self.pool_settings)
+
+    def _insert_hash(self, cursor, config, nameid, hash_value, digests):
+        if config.store_digests:
+            query = "INSERT INTO `{}` (`nameid`, `hash`, `digests`) VALUES (%s, %s, %s)"
+            cursor.execute(query.format(self.ATTRIBUTEHASH_TABLE), [nameid, hash_value, digests])
+        else:
+            query = "INSERT INTO `{}` (`nameid`, `hash`) VALUES (%s, %s)"
+            cursor.execute(query.format(self.ATTRIBUTEHASH_TABLE), [nameid, hash_value])
 
-    def process(self, context, data):
-        logprefix = self.logprefix
+    def _update_hash(self, cursor, config, nameid, hash_value, digests):
+        if config.store_digests:
+            query = "UPDATE `{}` SET `hash`=%s, `digests`=%s WHERE `nameid`=%s"
+            cursor.execute(query.format(self.ATTRIBUTEHASH_TABLE), [hash_value, digests, nameid])
+        else:
+            query = "UPDATE `{}` SET `hash`=%s WHERE `nameid`=%s"
+            cursor.execute(query.format(self.ATTRIBUTEHASH_TABLE), [hash_value, nameid])
+
+    def _write_hashes(self, pool, store_digests, rows):
+        """
+        Upsert a batch of (nameid, (hash, digests)) rows in one statement
+        """
+        if store_digests:
+            query = "INSERT INTO `{}` (`nameid`, `hash`, `digests`) VALUES {} " \
+                    "ON DUPLICATE KEY UPDATE `hash`=VALUES(`hash`), `digests`=VALUES(`digests`)"
+            query = query.format(self.ATTRIBUTEHASH_TABLE, ",".join(["(%s, %s, %s)"] * len(rows)))
+            values = [v for nameid, (hash_value, digests) in rows for v in (nameid, hash_value, digests)]
+        else:
+            query = "INSERT INTO `{}` (`nameid`, `hash`) VALUES {} ON DUPLICATE KEY UPDATE `hash`=VALUES(`hash`)"
+            query = query.format(self.ATTRIBUTEHASH_TABLE, ",".join(["(%s, %s)"] * len(rows)))
+            values = [v for nameid, (hash_value, _) in rows for v in (nameid, hash_value)]
+        with self.backend("db_write"), pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute(query, values)
+            cursor.close()
+
+    def _get_writer(self, pool, config):
+        key = (pool, config.store_digests)
+        with self._writers_lock:
+            writer = self.writers.get(key)
+            if writer is None:
+                writer = self.writers[key] = WriteBehindQueue(
+                    lambda rows: self._write_hashes(pool, config.store_digests, rows),
+                    queue_size=self.write_behind_queue_size,
+                    batch_size=self.write_behind_batch_size,
+                    flush_interval=self.write_behind_flush_interval,
+                    name="attribute-check-writer")
+            return writer
+
+    def close(self):
+        """
+        Drain the write-behind queues
+        """
+        with self._writers_lock:
+            writers = list(self.writers.values())
+        for writer in writers:
+            writer.close()
+
+    def stats(self):
+        """
+        Statistics of the recently verified cache, hits did not read attributes_hash
+        """
+        with self._verified_lock:
+            stats = dict(self._verified_stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        if self.verified is not None:
+            cache_stats = self.verified.stats()
+            stats.update(size=cache_stats['size'], evictions=cache_stats['evictions'])
+        return stats
+
+    def component_stats(self):
+        components = {"verified": self.stats()}
+        with self._writers_lock:
+            writers = list(self.writers.values())
+        if writers:
+            # Summed over the write-behind queues of all DBs
+            components["write_behind"] = {}
+            for writer in writers:
+                for stat, value in writer.stats().items():
+                    components["write_behind"][stat] = components["write_behind"].get(stat, 0) + value
+        return components
+
+    def _check_hash(self, pool, writer, config, user_id, attributes, new_hash, new_digests):
+        """
+        Compare new_hash with the stored hash and store it when it differs
+
+        :return: (whether the attributes changed, the stored digests)
+        """
+        with self.backend("db"), pool.connection() as connection:
+            cursor = connection.cursor()
+
+            # A hash that is still queued for writing is newer than the one in the DB
+            stored = writer.pending(user_id) if writer else None
+
+            if stored is None:
+                # Prepare select statement
+                query = "SELECT a.`hash`{} FROM `{}` a "
+                query += "WHERE a.`nameid` = %s"
+                query = query.format(", a.`digests`" if config.store_digests else "", self.ATTRIBUTEHASH_TABLE)
 
-        # Initialize the configuration to use as the default configuration
-        # that is passed during initialization.
-        config = self.config
-        configClean = copy.deepcopy(config)
-        if 'db_password' in configClean:
-            configClean['db_password'] = 'XXXXXXXX'
+                # satosa_logging(logger, logging.DEBUG, "{} query: {}".format(logprefix, query), context.state)
+
+                # Execute prepared statement
+                cursor.execute(query, [user_id])
+
+                rows = cursor.fetchall()
+                if len(rows):
+                    stored = (rows[0][0], rows[0][1] if config.store_digests else None)
+
+            stored_hash, stored_digests = stored if stored is not None else (None, None)
+            if stored_hash is None:
+                attributes_changed = False
+            elif is_legacy(stored_hash):
+                # Stored by a previous version, it is replaced by the new hash below
+                attributes_changed = stored_hash != legacy_hash(attributes)
+            else:
+                attributes_changed = stored_hash != new_hash
+
+            # In write-behind mode a new hash is queued, it is only written here when the queue is full
+            if (new_hash, new_digests) != (stored_hash, stored_digests) and \
+                    not (writer and writer.put(user_id, (new_hash, new_digests))):
+                if stored_hash is None:
+                    # satosa_logging(logger, logging.DEBUG, "{} No rows found, insert hash".format(logprefix), context.state)
+                    self._insert_hash(cursor, config, user_id, new_hash, new_digests)
+                else:
+                    # satosa_logging(logger, logging.DEBUG, "{} attributes have changed".format(logprefix), context.state)
+                    self._update_hash(cursor, config, user_id, new_hash, new_digests)
+            cursor.close()
 
-        # satosa_logging(logger, logging.DEBUG, "{} Using default configuration {}".format(logprefix, configClean), context.state)
+        return attributes_changed, stored_digests
+
+    def process(self, context, data):
+        logprefix = self.logprefix
 
         # Find the entityID for the SP that initiated the flow and target IdP
         try:
             spEntityID = context.state.state_dict['SATOSA_BASE']['requester']
         except KeyError:
-            satosa_logging(logger, logging.ERROR,
-                           "{} Unable to determine the entityID's for the IdP or SP".format(logprefix), context.state)
+            log(self.logger, logging.ERROR, "{} Unable to determine the entityID's for the IdP or SP", context.state,
+                logprefix)
             return super().process(context, data)
 
         # satosa_logging(logger, logging.DEBUG, "{} entityID for the requester is {}".format(logprefix, spEntityID), context.state)
-        # satosa_logging(logger, logging.ERROR, "{} entityID for the source IdP is {}".format(logprefix, idpEntityID), context.state)
-
-        # Examine our configuration to determine if there is a per-SP configuration
-        if spEntityID in self.config:
-            config = self.config[spEntityID]
-            configClean = copy.deepcopy(config)
-            if 'db_password' in configClean:
-                configClean['db_password'] = 'XXXXXXXX'
-            satosa_logging(logger, logging.DEBUG,
-                           "{} For SP {} using configuration {}".format(logprefix, spEntityID, configClean),
-                           context.state)
-
-        # Obtain configuration details from the per-SP configuration or the default configuration
-        try:
-            if 'db_host' in config:
-                db_host = config['db_host']
-            else:
-                db_host = self.config['db_host']
 
-            if 'db_user' in config:
-                db_user = config['db_user']
-            else:
-                db_user = self.config['db_user']
-
-            if 'db_schema' in config:
-                db_schema = config['db_schema']
-            else:
-                db_schema = self.config['db_schema']
-
-            if 'db_password' in config:
-                db_password = config['db_password']
-            else:
-                db_password = self.config['db_password']
-
-            if 'changed' in config:
-                changed = config['changed']
-            else:
-                changed = self.config['changed']
-
-        except KeyError as err:
-            satosa_logging(logger, logging.ERROR, "{} Configuration '{}' is missing".format(logprefix, err),
-                           context.state)
+        # The per-SP configuration or the default configuration, resolved at startup
+        config = self.sp_config.get(spEntityID)
+        if config is None:
+            log(self.logger, logging.ERROR, "{} Configuration is incomplete", context.state, logprefix)
             return super().process(context, data)
 
+        log(self.logger, logging.DEBUG, "{} For SP {} using configuration {}", context.state,
+            logprefix, spEntityID, config)
+
         try:
             # satosa_logging(logger, logging.DEBUG, "{} Using DB host {}".format(logprefix, db_host), context.state)
             # satosa_logging(logger, logging.DEBUG, "{} Using DB user {}".format(logprefix, db_user), context.state)
             # satosa_logging(logger, logging.DEBUG, "{} Using DB schema {}".format(logprefix, db_schema), context.state)
 
-            satosa_logging(logger, logging.DEBUG, "{} Using user_id {}".format(logprefix, data.user_id), context.state)
-
-            attributes = data.to_dict()['attr']
-            satosa_logging(logger, logging.DEBUG, "{} Using attributes {}".format(logprefix, attributes), context.state)
-
-            def make_hashable(o):
-                if isinstance(o, (tuple, list, set)):
-                    return tuple(sorted(make_hashable(e) for e in o))
-                if isinstance(o, dict):
-                    return tuple(sorted((k, make_hashable(v)) for k, v in o.items()))
-                # if isinstance(o, (set, frozenset)):
-                #    return tuple(sorted(make_hashable(e) for e in o))
-                return o
+            log(self.logger, logging.DEBUG, "{} Using user_id {}", context.state, logprefix, data.user_id)
 
-            def make_hash_sha256(o):
-                hasher = sha256()
-                hasher.update(repr(make_hashable(o)).encode())
-                return b64encode(hasher.digest()).decode()
+            attributes = data.attributes
+            log(self.logger, logging.DEBUG, "{} Using attributes {}", context.state, logprefix, attributes)
 
-            # frozen_attributes = freeze(attributes)
-            # satosa_logging(logger, logging.DEBUG, "{} Using frozenset {}".format(logprefix, frozen_attributes), context.state)
-            attributes_hash = make_hash_sha256(attributes)
-            # satosa_logging(logger, logging.DEBUG, "{} Using hashed frozenset {}".format(logprefix, attributes_hash), context.state)
+            digests = attribute_digests(attributes)
+            new_hash = attributes_hash(digests)
+            new_digests = encode_digests(digests) if config.store_digests else None
 
-            connection = MySQLdb.connect(host=db_host, user=db_user, passwd=db_password, db=db_schema)
-            cursor = connection.cursor()
-
-            # satosa_logging(logger, logging.DEBUG, "{} Connected to DB server".format(logprefix), context.state)
-
-            # Prepare select statement
-            query = "SELECT a.`hash` FROM `{}` a "
-            query += "WHERE a.`nameid` = %s"
-            query = query.format(self.ATTRIBUTEHASH_TABLE)
-
-            # satosa_logging(logger, logging.DEBUG, "{} query: {}".format(logprefix, query), context.state)
-
-            # Execute prepared statement
-            cursor.execute(query, [data.user_id])
-
-            attributes_changed = False
+            pool = self._get_pool(config)
+            writer = self._get_writer(pool, config) if self.write_behind else None
 
-            rows = cursor.fetchall()
-            if (not len(rows)):
-                # satosa_logging(logger, logging.DEBUG, "{} No rows found, insert hash".format(logprefix), context.state)
-                query = "INSERT INTO `{}` (`nameid`, `hash`) VALUES (%s, %s)".format(self.ATTRIBUTEHASH_TABLE)
-                # satosa_logging(logger, logging.DEBUG, "{} query: {}".format(logprefix, query), context.state)
-                cursor.execute(query, [data.user_id, attributes_hash])
-                stored_attributes_hash = attributes_hash
+            # A hash confirmed by this node within the consistency window is not read again
+            verified_key = (pool, data.user_id)
+            verified = False
+            if self.verified is not None:
+                verified = self.verified.get(verified_key) == new_hash
+                with self._verified_lock:
+                    self._verified_stats['hits' if verified else 'misses'] += 1
+            if verified:
+                log(self.logger, logging.DEBUG, "{} hash: {}, recently verified", context.state, logprefix, new_hash)
+                attributes_changed, stored_digests = False, None
             else:
-                stored_attributes_hash = rows[0][0]
-                if (attributes_hash != stored_attributes_hash):
-                    # satosa_logging(logger, logging.DEBUG, "{} attributes have changed".format(logprefix), context.state)
-                    query = "UPDATE `{}` SET `hash`=%s WHERE `nameid`=%s".format(self.ATTRIBUTEHASH_TABLE)
-                    # satosa_logging(logger, logging.DEBUG, "{} query: {}".format(logprefix, query), context.state)
-                    cursor.execute(query, [attributes_hash, data.user_id])
-                    stored_attributes_hash = attributes_hash
-                    attributes_changed = True
+                attributes_changed, stored_digests = self._check_hash(pool, writer, config, data.user_id,
+                                                                      attributes, new_hash, new_digests)
+                if self.verified is not None:
+                    self.verified.set(verified_key, new_hash)
+
+            log(self.logger, logging.DEBUG, "{} hash: {}, changed: {}", context.state,
+                logprefix, new_hash, attributes_changed)
 
-            satosa_logging(logger, logging.DEBUG,
-                           "{} hash: {}, changed: {}".format(logprefix, stored_attributes_hash, attributes_changed),
-                           context.state)
+            if attributes_changed:
+                # Which attributes changed is only known when the previous digests were stored
+                changed = changed_attributes(digests, stored_digests) if stored_digests else []
+                context.state[STATE_KEY] = {'changed': changed}
+                log(self.logger, logging.INFO, "{} Attributes of {} have changed: {}", context.state,
+                    logprefix, data.user_id, ", ".join(changed) or "unknown")
 
         except Exception as err:
-            satosa_logging(logger, logging.ERROR, "{} Caught exception: {0}".format(logprefix, err), None)
+            log(self.logger, logging.ERROR, "{} Caught exception: {}", None, logprefix, err)
             return super().process(context, data)
 
-        else:
-            # satosa_logging(logger, logging.DEBUG, "{} Closing connection to DB server".format(logprefix), context.state)
-            connection.commit()
-            connection.close()
-
         if attributes_changed:
-            return Redirect(changed)
+            return Redirect(config.changed)
         else:
             return super().process(context, data)
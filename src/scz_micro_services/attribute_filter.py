@@ -1,14 +1,53 @@
 import logging
 import re
 
-from satosa.logging_util import satosa_logging
 from satosa.micro_services.base import ResponseMicroService
 from satosa.util import get_dict_defaults
 
-logger = logging.getLogger('satosa')
+from .cache import TTLCache
+from .instrumentation import Instrumented
+from .logging_util import get_logger, log
 
 
-class AttributeFilter(ResponseMicroService):
+class FilterRules(object):
+    """
+    The compiled filters of one provider/requester entry: a list of attribute
+    name patterns, each with the value patterns that apply to the attributes
+    it matches.
+
+    Value patterns of all name patterns matching an attribute are combined in
+    one alternation, in filter order, exactly like "|".join(patterns). The
+    alternation of each single filter is compiled up front, combinations of
+    several filters are compiled once when first seen.
+    """
+
+    def __init__(self, filters):
+        self.filters = filters or {}
+        self.rules = [(re.compile(f), list(fv)) for f, fv in self.filters.items()]
+        self._alternations = {(i,): re.compile("|".join(fv)).search for i, (_, fv) in enumerate(self.rules)}
+
+    def value_matcher(self, name):
+        """
+        :return: The search function of the value alternation for attribute name,
+                 None if no filter applies to it
+        """
+        key = tuple(i for i, (name_re, _) in enumerate(self.rules) if name_re.search(name))
+        if not key:
+            return None
+        match = self._alternations.get(key)
+        if match is None:
+            patterns = [p for i in key for p in self.rules[i][1]]
+            match = self._alternations[key] = re.compile("|".join(patterns)).search
+        return match
+
+    def __repr__(self):
+        return repr(self.filters)
+
+
+FilterRules.EMPTY = FilterRules({})
+
+
+class AttributeFilter(Instrumented, ResponseMicroService):
     """
 A microservice that performs regexp-based filtering based on response
 attributes. The configuration assumes a dict with two keys: attributes_allow
@@ -49,41 +88,61 @@ Note that attribute filters work on matched value only.
 
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
         self.attribute_allow = config.get("attribute_allow", {})
         self.attribute_deny = config.get("attribute_deny", {})
+        self.allow_rules = self._compile_table(self.attribute_allow)
+        self.deny_rules = self._compile_table(self.attribute_deny)
+        self.plan_cache = TTLCache(maxsize=config.get("plan_cache_size", 1000), ttl=float("inf"))
         self.logprefix = "ATTR_FILTER:"
 
-    def _filter_attributes(self, attributes, filters):
-        attributes_filter = {}
-        for f, fv in filters.items():
-            for a in attributes.keys():
-                if re.compile(f).search(a):
-                    attributes_filter.setdefault(a, []).extend(fv)
-        attributes_filtered = {a: list(filter(re.compile("|".join(f)).search, attributes.get(a, None))) for a, f in
-                               attributes_filter.items()}
-        return attributes_filtered
+    def component_stats(self):
+        return {"plan_cache": self.plan_cache.stats()}
+
+    @staticmethod
+    def _compile_table(table):
+        """
+        Compile the filters of every provider/requester entry in table
+        """
+        return {provider: {requester: FilterRules(filters) for requester, filters in requesters.items()}
+                for provider, requesters in table.items()}
+
+    @staticmethod
+    def _get_rules(table, provider, requester):
+        rules = get_dict_defaults(table, provider, requester)
+        return rules if isinstance(rules, FilterRules) else FilterRules.EMPTY
+
+    def _get_plan(self, provider, requester, names):
+        """
+        The (allow, deny) value matchers per attribute name, memoized per
+        provider, requester and set of attribute names
+        """
+        key = (provider, requester, frozenset(names))
+        plan = self.plan_cache.get(key)
+        if plan is None:
+            filter_allow = self._get_rules(self.allow_rules, provider, requester)
+            filter_deny = self._get_rules(self.deny_rules, provider, requester)
+            plan = {a: (filter_allow.value_matcher(a), filter_deny.value_matcher(a)) for a in key[2]}
+            self.plan_cache.set(key, plan)
+        return plan
 
     def _apply_filter(self, context, attributes, provider, requester):
-        filter_allow = get_dict_defaults(self.attribute_allow, provider, requester)
-        satosa_logging(logger, logging.DEBUG, "{} filter_allow: {}".format(self.logprefix, filter_allow), context.state)
-        filter_deny = get_dict_defaults(self.attribute_deny, provider, requester)
-        satosa_logging(logger, logging.DEBUG, "{} filter_deny: {}".format(self.logprefix, filter_deny), context.state)
-        allow = self._filter_attributes(attributes, filter_allow)
-        satosa_logging(logger, logging.DEBUG, "{} allow: {}".format(self.logprefix, allow), context.state)
-        deny = self._filter_attributes(attributes, filter_deny)
-        satosa_logging(logger, logging.DEBUG, "{} deny: {}".format(self.logprefix, deny), context.state)
-
-        # Remove Denies (values) from Allows (values)
-        for a, v in deny.items():
-            for r in v:
-                if a in allow and r in allow[a]:
-                    allow[a].remove(r)
-
-        result = {a: v for a, v in allow.items() if len(v)}
-        satosa_logging(logger, logging.DEBUG, "{} result: {}".format(self.logprefix, result), context.state)
+        plan = self._get_plan(provider, requester, attributes.keys())
+        log(self.logger, logging.DEBUG, "{} plan: {}", context.state, self.logprefix, plan)
+
+        # Keep the values that are allowed and not denied
+        result = {}
+        for a, values in attributes.items():
+            allow, deny = plan[a]
+            if allow is not None:
+                v = [r for r in values if allow(r) and not (deny is not None and deny(r))]
+                if len(v):
+                    result[a] = v
+
+        log(self.logger, logging.DEBUG, "{} result: {}", context.state, self.logprefix, result)
         return result
 
     def process(self, context, data):
-        satosa_logging(logger, logging.DEBUG, "{} Processing attribute filter".format(self.logprefix), context.state)
+        log(self.logger, logging.DEBUG, "{} Processing attribute filter", context.state, self.logprefix)
         data.attributes = self._apply_filter(context, data.attributes, data.auth_info.issuer, data.requester)
         return super().process(context, data)
@@ -0,0 +1,116 @@
+"""
+Canonical hashing of attributes for AttributeCheck
+
+The sorted values of every attribute are streamed into their own SHA-256
+digest, the attributes hash covers the sorted attribute names and their
+digests. Values are joined by NUL, or tagged with their type and length
+prefixed when a value contains NUL or is not a string, so no two attribute
+dicts share an encoding: "1" and 1 differ.
+
+Hashes are stored unpadded urlsafe base64 (43 characters). Hashes stored by
+previous versions are padded standard base64 (44 characters, ending in =),
+they are recognized by is_legacy and compared using legacy_hash.
+"""
+import json
+import struct
+from base64 import b64encode, urlsafe_b64encode
+from hashlib import sha256
+
+# Number of bytes kept of the stored per attribute digests
+DIGEST_SIZE = 12
+
+_MULTI_VALUED = (list, tuple, set, frozenset)
+
+
+def _update(hasher, data):
+    hasher.update(struct.pack(">I", len(data)))
+    hasher.update(data)
+
+
+def _encode(value):
+    if isinstance(value, str):
+        return b"s" + value.encode("utf-8")
+    return "r{}:{!r}".format(type(value).__name__, value).encode("utf-8")
+
+
+def _b64(digest):
+    return urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def attribute_digest(values):
+    """
+    The digest of the values of one attribute, independent of their order
+
+    :param values: A list of values or a single value
+    """
+    if not isinstance(values, _MULTI_VALUED):
+        values = [values]
+    if all(isinstance(v, str) for v in values):
+        values = sorted(values)
+        # The common case, strings without NUL are joined by NUL and hashed at once
+        joined = "\0".join(values)
+        if values and joined.count("\0") == len(values) - 1:
+            return sha256(b"s" + joined.encode("utf-8")).digest()
+    encoded = sorted(_encode(v) for v in values)
+    hasher = sha256(b"p")
+    for value in encoded:
+        _update(hasher, value)
+    return hasher.digest()
+
+
+def attribute_digests(attributes):
+    """
+    :return: A dict of attribute name to the digest of its values
+    """
+    return {name: attribute_digest(values) for name, values in attributes.items()}
+
+
+def attributes_hash(digests):
+    """
+    The hash of all attributes from their attribute_digests
+    """
+    hasher = sha256()
+    for name in sorted(digests):
+        _update(hasher, name.encode("utf-8"))
+        hasher.update(digests[name])
+    return _b64(hasher.digest())
+
+
+def encode_digests(digests):
+    """
+    The truncated digests as a compact JSON object, for storage next to the hash
+    """
+    return json.dumps({name: _b64(digest[:DIGEST_SIZE]) for name, digest in digests.items()},
+                      sort_keys=True, separators=(",", ":"))
+
+
+def changed_attributes(digests, stored_digests):
+    """
+    :param digests: The current attribute_digests
+    :param stored_digests: Digests stored by encode_digests
+    :return: The sorted names of the attributes that were added, removed or changed
+    """
+    current = json.loads(encode_digests(digests))
+    stored = json.loads(stored_digests)
+    return sorted(name for name in set(current) | set(stored) if current.get(name) != stored.get(name))
+
+
+def is_legacy(stored_hash):
+    """
+    Whether stored_hash was stored by a previous version and must be compared with legacy_hash
+    """
+    return stored_hash.endswith("=")
+
+
+def legacy_hash(attributes):
+    """
+    The hash previous versions stored, the base64 SHA-256 of the repr of the sorted attributes
+    """
+    def make_hashable(o):
+        if isinstance(o, (tuple, list, set)):
+            return tuple(sorted(make_hashable(e) for e in o))
+        if isinstance(o, dict):
+            return tuple(sorted((k, make_hashable(v)) for k, v in o.items()))
+        return o
+
+    return b64encode(sha256(repr(make_hashable(attributes)).encode()).digest()).decode()
@@ -0,0 +1,65 @@
+"""
+Order preserving merge of multi-valued attributes
+
+loads is the fastest JSON parser that is installed: orjson, ujson or the
+standard library json.
+"""
+import json
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+    except ImportError:
+        loads = json.loads
+
+
+def _key(value):
+    # Values are strings, but JSON records can hold anything
+    return value if isinstance(value, str) else json.dumps(value, sort_keys=True)
+
+
+def extend_unique(values, new_values):
+    """
+    Append the new_values that are not in values yet, in order
+
+    :return: values
+    """
+    seen = {_key(v) for v in values}
+    for value in new_values:
+        key = _key(value)
+        if key not in seen:
+            seen.add(key)
+            values.append(value)
+    return values
+
+
+class AttributeMerger(object):
+    """
+    Merges attribute dicts into values, a dict of attribute name to the list
+    of its values in the order they were first seen, without duplicates.
+    Single values are treated as a list of one value.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self._seen = {}
+
+    def add(self, attributes):
+        for name, new_values in attributes.items():
+            if not isinstance(new_values, list):
+                new_values = [new_values]
+            values = self.values.get(name)
+            if values is None:
+                values = self.values[name] = []
+                seen = self._seen[name] = set()
+            else:
+                seen = self._seen[name]
+            for value in new_values:
+                key = _key(value)
+                if key not in seen:
+                    seen.add(key)
+                    values.append(value)
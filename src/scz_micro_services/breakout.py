@@ -4,17 +4,23 @@ Be carefull! InternalResponse.name_id is lost after serialization
 This means that any micro_service making use of InternalResponse.name_id
 like custom_uid MUST precede this one
 """
+import json
 import logging
 
+from satosa.exception import SATOSAStateError
 from satosa.internal_data import InternalResponse
 from satosa.micro_services.base import ResponseMicroService
 from satosa.response import Redirect
 
+from .instrumentation import Instrumented
+from .logging_util import get_logger
+from .state_store import decode, encode, get_state_store
+
 logger = logging.getLogger('satosa')
 STATE_KEY = "BREAKOUT"
 
 
-class BreakOut(ResponseMicroService):
+class BreakOut(Instrumented, ResponseMicroService):
     """
     Example module to show how to break out of satosa flow and return
     """
@@ -24,10 +30,13 @@ class BreakOut(ResponseMicroService):
         Initialise breakout micro service
         """
         super().__init__(*args, **kwargs)
-        self.name = "breakout"
         self.endpoint = "/resume"
         self.redirect_url = config["redirect_url"]
         self.resumed = False
+        self.logger = get_logger(self.name, config)
+        # The internal response is kept server-side when a state_store is configured,
+        # otherwise it is kept as is in the state, which SATOSA compresses as a whole
+        self.state_store = get_state_store(config.get("state_store"))
         logger.info("Breakout micro_service is active")
 
     def register_endpoints(self):
@@ -43,10 +52,19 @@ class BreakOut(ResponseMicroService):
         This is the main workhorse. It's main duty is storing the internal_resonse
         so we can pick it up when we resume
         """
-        logger.info("Process BreakOut")
-        context.state[STATE_KEY] = {}
-        context.state[STATE_KEY]["internal_resp"] = internal_response.to_dict()
-        logger.info("internal_resp: %s" % context.state[STATE_KEY]["internal_resp"])
+        self.logger.debug("Process BreakOut")
+        saved_response = internal_response.to_dict()
+        self.logger.debug("internal_resp: %s", saved_response)
+        if self.state_store is not None:
+            blob = encode(saved_response)
+            context.state[STATE_KEY] = {"key": self.state_store.put(blob)}
+            self.logger.info("Stored internal response of %d bytes server-side", len(blob))
+        else:
+            context.state[STATE_KEY] = {"internal_resp": saved_response}
+            if self.logger.isEnabledFor(logging.DEBUG):
+                # Before SATOSA compresses the state, large responses are better kept in a state_store
+                self.logger.debug("Keeping internal response of %d bytes in the state",
+                                  len(json.dumps(saved_response, separators=(",", ":"))))
         return self._check_requirement(context, internal_response)
 
     def _check_requirement(self, context, internal_response):
@@ -54,7 +72,7 @@ class BreakOut(ResponseMicroService):
         Assume BreakOut is only needed under certain conditions
         This is an example method that checks condition
         """
-        logger.info("Check BreakOut requirement")
+        self.logger.debug("Check BreakOut requirement")
         if self.resumed:
             # If everything is ok, don't break out and continue
             return super().process(context, internal_response)
@@ -67,10 +85,19 @@ class BreakOut(ResponseMicroService):
         The resume endpoint handler. It's main duty is restoring internal_response
         and checking the resume condition
         """
-        logger.info("Handle BreakOut endpoint")
+        self.logger.debug("Handle BreakOut endpoint")
         breakout_state = context.state[STATE_KEY]
-        saved_response = breakout_state["internal_resp"]
-        logger.info("internal_resp: %s" % saved_response)
+        if "key" in breakout_state:
+            blob = self.state_store.get(breakout_state["key"]) if self.state_store is not None else None
+            if blob is None:
+                raise SATOSAStateError("BreakOut state expired or unknown")
+            saved_response = decode(blob)
+        else:
+            saved_response = breakout_state["internal_resp"]
+        self.logger.debug("internal_resp: %s", saved_response)
         internal_response = InternalResponse.from_dict(saved_response)
+        if "key" in breakout_state:
+            # Consumed, the same state can't resume twice
+            self.state_store.delete(breakout_state["key"])
         self.resumed = True
         return self._check_requirement(context, internal_response)
@@ -0,0 +1,92 @@
+"""
+Circuit breaker used to fail fast while a backend is unhealthy
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger('satosa')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker(object):
+    """
+    Opens after ``failure_threshold`` consecutive failures. While open, calls
+    are refused until ``reset_timeout`` seconds have passed, after which a
+    single trial call is let through (half open). The trial decides whether
+    the breaker closes again or stays open for another ``reset_timeout``.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, timer=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._stats = {
+            'successes': 0,
+            'failures': 0,
+            'rejections': 0,
+            'opened': 0,
+        }
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._timer() - self._opened_at >= self.reset_timeout:
+                return HALF_OPEN
+            return self._state
+
+    def _transition(self, state):
+        if state != self._state:
+            logger.warning("Circuit breaker {} {} -> {}".format(self.name, self._state, state))
+            self._state = state
+
+    def allow(self):
+        """
+        :return: True if a call may be made now
+        """
+        with self._lock:
+            if self._state == OPEN and self._timer() - self._opened_at >= self.reset_timeout:
+                self._transition(HALF_OPEN)
+            if self._state == CLOSED or (self._state == HALF_OPEN and not self._trial):
+                self._trial = self._state == HALF_OPEN
+                return True
+            self._stats['rejections'] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._stats['successes'] += 1
+            self._failures = 0
+            self._trial = False
+            self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._stats['failures'] += 1
+            self._failures += 1
+            self._trial = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != OPEN:
+                    self._stats['opened'] += 1
+                self._opened_at = self._timer()
+                self._transition(OPEN)
+
+    def stats(self):
+        """
+        :return: The breaker state and counters
+        """
+        state = self.state
+        with self._lock:
+            stats = dict(self._stats)
+            stats['consecutive_failures'] = self._failures
+        stats['state'] = state
+        return stats
@@ -2,15 +2,20 @@
 A Custom Alias microservice
 """
 import logging
-import mimetypes
+from email.utils import parsedate_to_datetime
 
 from satosa.micro_services.base import RequestMicroService
 from satosa.response import Response
 
+from .file_cache import FileCache
+from .instrumentation import Instrumented
+from .logging_util import get_logger
+from .template import Template
+
 logger = logging.getLogger('satosa')
 
 
-class CustomAlias(RequestMicroService):
+class CustomAlias(Instrumented, RequestMicroService):
     logprefix = "CUSTOM_ALIAS_SERVICE:"
 
     def __init__(self, config, *args, **kwargs):
@@ -20,8 +25,19 @@ class CustomAlias(RequestMicroService):
         """
         super().__init__(*args, **kwargs)
         # self.config = config
+        self.logger = get_logger(self.name, config)
         if 'locations' in config:
             self.locations = config['locations']
+        self.cache_control = config.get('cache_control', 'public, max-age=300')
+        # One file cache per alias root
+        self.file_caches = {endpoint: FileCache(max_size=config.get('cache_size', 16 * 1024 * 1024),
+                                                max_file_size=config.get('cache_max_file_size', 1024 * 1024),
+                                                check_interval=config.get('cache_check_interval', 2),
+                                                parse=Template.parse)
+                            for endpoint in getattr(self, 'locations', {})}
+
+    def component_stats(self):
+        return {"file_cache {}".format(endpoint): cache.stats() for endpoint, cache in self.file_caches.items()}
 
     def register_endpoints(self):
         url_map = []
@@ -31,23 +47,46 @@ class CustomAlias(RequestMicroService):
             url_map.append(["^%s/" % endpoint, self._handle])
         return url_map
 
+    @staticmethod
+    def _not_modified(context, cached):
+        """
+        Whether the conditional request headers match cached, only SATOSA
+        versions that set context.http_headers pass them on
+        """
+        headers = getattr(context, 'http_headers', None) or {}
+        if_none_match = headers.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            return if_none_match.strip() == '*' or cached.etag in [e.strip() for e in if_none_match.split(',')]
+        if_modified_since = headers.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since is not None:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= cached.mtime // 10 ** 9
+            except (TypeError, ValueError):
+                return False
+        return False
+
     def _handle(self, context):
         path = context._path
         endpoint = path.split("/")[0]
         target = path[len(endpoint) + 1:]
         alias = "%s/%s" % (self.locations[endpoint], target)
-        logger.info("{} _handle: {} - {} - {}".format(self.logprefix, endpoint, target, alias))
+        self.logger.debug("%s _handle: %s - %s - %s", self.logprefix, endpoint, target, alias)
         try:
-            response = open(alias, 'rb').read()
-            mimetype = mimetypes.guess_type(alias)[0]
-            logger.debug("mimetype {}".format(mimetype))
+            cached = self.file_caches[endpoint].get(alias)
         except Exception as e:
-            response = "Not found {}".format(e)
-            mimetype = "text/html"
+            return Response("Not found {}".format(e), content="text/html")
+        self.logger.debug("mimetype %s", cached.mimetype)
 
-        if 'substitutions' in context.state:
-            for search, replace in context.state['substitutions'].items():
-                logger.info("search: {}, replace: {}".format(search, replace))
-                response = response.replace(search, replace)
+        template = cached.parsed
+        if template is not None and 'substitutions' in context.state:
+            # The response differs per request, pages without placeholders are served as is
+            substitutions = context.state['substitutions']
+            self.logger.debug("substitutions: %s", substitutions)
+            return Response(template.render(substitutions).encode("utf-8"), headers=[("Cache-Control", "no-store")],
+                            content="{}; charset=utf-8".format(cached.mimetype))
 
-        return Response(response, content=mimetype)
+        headers = [("ETag", cached.etag), ("Last-Modified", cached.last_modified),
+                   ("Cache-Control", self.cache_control)]
+        if self._not_modified(context, cached):
+            return Response(b"", status="304 Not Modified", headers=headers, content=cached.mimetype)
+        return Response(cached.body, headers=headers, content=cached.mimetype)
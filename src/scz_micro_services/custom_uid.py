@@ -1,24 +1,49 @@
 import logging
 from xml.etree import ElementTree as ET
 
-from satosa.logging_util import satosa_logging
 from satosa.micro_services.base import ResponseMicroService
 
-logger = logging.getLogger('satosa')
+from .cache import TTLCache
+from .instrumentation import Instrumented
+from .logging_util import get_logger, log
 
+_MISSING = object()
 
-class CustomUID(ResponseMicroService):
+
+class CustomUID(Instrumented, ResponseMicroService):
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
         self.config = config
         self.logprefix = "CUSTOM_UID:"
+        # Text of the serialized NameID elements seen recently
+        self.parse_cache = TTLCache(maxsize=config.get('parse_cache_size', 1000), ttl=float("inf"))
+
+    def component_stats(self):
+        return {"parse_cache": self.parse_cache.stats()}
+
+    def _value(self, v):
+        """
+        The text of v if it is a serialized XML element, like a NameID in
+        eduPersonTargetedID, otherwise v itself
+        """
+        # Only values that start with a tag can be XML, skip the parser for the others
+        if isinstance(v, str) and not v.lstrip().startswith("<"):
+            return v
+        text = self.parse_cache.get(v, _MISSING)
+        if text is _MISSING:
+            try:
+                text = ET.fromstring(v).text
+            except Exception:
+                text = v
+            self.parse_cache.set(v, text)
+        return text
 
     def process(self, context, data):
         # Initialize the configuration to use as the default configuration
         # that is passed during initialization.
         config = self.config
-        satosa_logging(logger, logging.DEBUG, "{} Using default configuration {}".format(self.logprefix, config),
-                       context.state)
+        log(self.logger, logging.DEBUG, "{} Using default configuration {}", context.state, self.logprefix, config)
 
         # Obtain configuration details from the per-SP configuration or the default configuration
         try:
@@ -38,11 +63,10 @@ class CustomUID(ResponseMicroService):
                 user_id = self.config['user_id']
 
         except KeyError as err:
-            satosa_logging(logger, logging.ERROR, "{} Configuration '{}' is missing".format(self.logprefix, err),
-                           context.state)
+            log(self.logger, logging.ERROR, "{} Configuration '{}' is missing", context.state, self.logprefix, err)
             return super().process(context, data)
 
-        satosa_logging(logger, logging.DEBUG, "{} select {}".format(self.logprefix, select), context.state)
+        log(self.logger, logging.DEBUG, "{} select {}", context.state, self.logprefix, select)
 
         name_id = data.name_id
 
@@ -50,26 +74,21 @@ class CustomUID(ResponseMicroService):
         d = {a: [] for a in select if a in data.attributes}
 
         if '__name_id__' in select and name_id.format == "urn:oasis:names:tc:SAML:2.0:nameid-format:persistent" and name_id.text:
-            satosa_logging(logger, logging.DEBUG, "{} Using name_id format {}".format(self.logprefix, name_id.format),
-                           context.state)
-            satosa_logging(logger, logging.DEBUG, "{} Using name_id text {}".format(self.logprefix, name_id.text),
-                           context.state)
+            log(self.logger, logging.DEBUG, "{} Using name_id format {}", context.state, self.logprefix, name_id.format)
+            log(self.logger, logging.DEBUG, "{} Using name_id text {}", context.state, self.logprefix, name_id.text)
             d['__name_id__'] = [name_id.text]
         else:
             for a in d:
                 values = data.attributes.get(a)
                 for v in values:
-                    try:
-                        v = ET.fromstring(v).text
-                    except Exception:
-                        pass
+                    v = self._value(v)
                     if v:
                         d[a].append(v)
 
         # Do the magic
         uid = '|'.join(['|'.join(d[a]) for a in select if a in d and len(d[a])])
 
-        satosa_logging(logger, logging.DEBUG, "{} uid: {}".format(self.logprefix, uid), context.state)
+        log(self.logger, logging.DEBUG, "{} uid: {}", context.state, self.logprefix, uid)
 
         if uid:
             data.attributes[custom_attribute] = [uid]
@@ -77,7 +96,6 @@ class CustomUID(ResponseMicroService):
                 data.user_id = uid
                 context.state['IDHASHER']['hash_type'] = 'persistent'
 
-        satosa_logging(logger, logging.DEBUG, "{} custom uid ({}): {}".format(self.logprefix, custom_attribute,
-                                                                              data.attributes.get(custom_attribute)),
-                       context.state)
+        log(self.logger, logging.DEBUG, "{} custom uid ({}): {}", context.state,
+            self.logprefix, custom_attribute, data.attributes.get(custom_attribute))
         return super().process(context, data)
@@ -5,19 +5,31 @@ for records and then consume attributes from
 the record and assert them to the receiving SP.
 """
 
-import copy
-import json
+import atexit
 import logging
 
 import MySQLdb
+import MySQLdb.cursors
 from satosa.attribute_mapping import AttributeMapper
-from satosa.logging_util import satosa_logging
 from satosa.micro_services.base import ResponseMicroService
 
-logger = logging.getLogger('satosa')
+from .attribute_merge import AttributeMerger, extend_unique, loads
+from .cache import TTLCache
+from .db_pool import mysql_pool, pool_settings
+from .instrumentation import Instrumented
+from .logging_util import get_logger, log
+from .sp_config import REQUIRED, SPConfig
+from .zone_snapshot import ZoneSnapshot
 
 
-class DBAttributeStore(ResponseMicroService):
+class _Capped(Exception):
+    """
+    A lookup result went over db_max_rows or db_max_bytes
+    """
+    pass
+
+
+class DBAttributeStore(Instrumented, ResponseMicroService):
     """
     Use identifier provided by the backend authentication service
     to lookup a person record in DB and obtain attributes
@@ -30,24 +42,184 @@ class DBAttributeStore(ResponseMicroService):
     logprefix = "DB_ATTRIBUTE_STORE:"
     attribute_profile = 'saml'
 
+    # Options that can be overridden per SP and their defaults
+    OPTIONS = [
+        ('db_host', REQUIRED),
+        ('db_user', REQUIRED),
+        ('db_schema', REQUIRED),
+        ('db_password', REQUIRED),
+        ('idp_identifiers', REQUIRED),
+        ('clear_input_attributes', False),
+        ('user_id', REQUIRED),
+        ('blacklist', []),
+        ('cache', True),
+    ]
+
     def __init__(self, config, internal_attributes, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
         self.config = config
         self.converter = AttributeMapper(internal_attributes)
+        self.pool_settings = pool_settings(config)
+        self.query_timeout = config.get('db_query_timeout')
+        # Protect against pathological records, rows beyond either limit are not read
+        self.max_rows = config.get('db_max_rows', 1000)
+        self.max_bytes = config.get('db_max_bytes', 1024 * 1024)
+        # SELECT statements per IN list size, built once
+        self._queries = {}
+
+        # Lookup results are cached per (identifier values, SP) when a cache TTL is configured
+        self.cache = None
+        self.cache_negative_ttl = config.get('cache_negative_ttl', 10)
+        if config.get('cache_ttl'):
+            self.cache = TTLCache(maxsize=config.get('cache_size', 10000), ttl=config['cache_ttl'])
+
+        # The last result per (identifier values, SP) is served when the DB fails, up to stale_max_age seconds old
+        self.last_good = None
+        if config.get('stale_max_age'):
+            self.last_good = TTLCache(maxsize=config.get('stale_size', 10000), ttl=config['stale_max_age'])
+
+        self.sp_config = SPConfig(config, self.OPTIONS, secrets=['db_password'], logprefix=self.logprefix)
+
+        # Create the pools for the default and per-SP configurations up front
+        for sp_config in self.sp_config.all():
+            self._get_pool(sp_config)
+
+        # In snapshot mode the zone tables of every DB are kept in memory, the DB
+        # is only queried while a snapshot is loading or stale
+        self.snapshots = {}
+        if config.get('snapshot'):
+            for sp_config in self.sp_config.all():
+                key = (sp_config.db_host, sp_config.db_user, sp_config.db_schema)
+                if key not in self.snapshots:
+                    self.snapshots[key] = ZoneSnapshot(self._get_pool(sp_config),
+                                                       refresh_interval=config.get('snapshot_refresh_interval', 300),
+                                                       max_age=config.get('snapshot_max_age', 900),
+                                                       updated_column=config.get('snapshot_updated_column'),
+                                                       full_refresh_interval=config.get('snapshot_full_refresh_interval', 3600),
+                                                       cursorclass=MySQLdb.cursors.SSCursor,
+                                                       name="zone-snapshot").start()
+            atexit.register(self.close)
+
+    def close(self):
+        """
+        Stop refreshing the snapshots
+        """
+        for snapshot in self.snapshots.values():
+            snapshot.close()
+
+    def stats(self):
+        """
+        :return: The age and size of the snapshots, keyed by user@host/schema
+        """
+        return {"{}@{}/{}".format(key[1], key[0], key[2]): snapshot.stats() for key, snapshot in self.snapshots.items()}
+
+    def component_stats(self):
+        components = {"snapshot {}".format(label): stats for label, stats in self.stats().items()}
+        if self.cache is not None:
+            components["cache"] = self.cache.stats()
+        if self.last_good is not None:
+            components["last_good"] = self.last_good.stats()
+        return components
+
+    def _get_pool(self, config):
+        return mysql_pool(config, **self.pool_settings)
+
+    def _select(self, size):
+        query = self._queries.get(size)
+        if query is None:
+            query = "SELECT "
+            if self.query_timeout:
+                # MySQL aborts the SELECT after this many milliseconds, MariaDB ignores the hint
+                query += "/*+ MAX_EXECUTION_TIME({}) */ ".format(int(self.query_timeout * 1000))
+            query += "p.`attributes` FROM `{}` p "
+            query += "JOIN `{}` ps ON p.`id`=ps.`zone_person_id` "
+            query += "JOIN `{}` z ON ps.`zone_service_id`=z.`id` "
+            query += "WHERE p.`uid` in (" + ",".join(['%s'] * size) + ") "
+            query += "AND z.`metadata`=%s "
+            # One row more than max_rows tells that the result was capped
+            query += "LIMIT {}".format(self.max_rows + 1)
+            query = self._queries[size] = query.format(self.PEOPLE_TABLE, self.PERSON_SERVICES_TABLE,
+                                                       self.SERVICES_TABLE)
+        return query
+
+    def _over_limits(self, row_count, row_bytes, values, state):
+        """
+        :return: Whether a result of row_count rows and row_bytes bytes goes over db_max_rows or db_max_bytes
+        """
+        if row_count > self.max_rows or row_bytes > self.max_bytes:
+            log(self.logger, logging.WARNING, "{} Ignoring rows beyond {} rows or {} bytes for {}",
+                state, self.logprefix, self.max_rows, self.max_bytes, values)
+            return True
+        return False
+
+    def _query(self, pool, values, sp_entity_id, state):
+        """
+        Query the zone tables for the people with one of the uids in values in service sp_entity_id
+
+        :return: (the merged attributes, the number of rows)
+        """
+        size = len(values)
+        parameters = values + [sp_entity_id]
+
+        # Execute the statement on a pooled connection, rows are streamed and merged
+        merger = AttributeMerger()
+        row_count = 0
+        try:
+            with self.backend("db"), pool.connection() as connection:
+                cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+                query = self._select(size)
+                log(self.logger, logging.DEBUG, "{} query: {}", state, self.logprefix, query)
+                cursor.execute(query, parameters)
+                row_bytes = 0
+                for row in cursor:
+                    row_count += 1
+                    row_bytes += len(row[0])
+                    if self._over_limits(row_count, row_bytes, values, state):
+                        # Closing the cursor would read the rest of the result, the pool discards the connection
+                        raise _Capped()
+                    merger.add(loads(row[0]))
+                cursor.close()
+        except _Capped:
+            pass
+        return merger.values, row_count
+
+    def _merge_snapshot(self, records, values, state):
+        """
+        Merge the (attributes, size) records of a snapshot lookup within the limits of _query
+
+        :return: (the merged attributes, the number of rows)
+        """
+        merger = AttributeMerger()
+        row_count = 0
+        row_bytes = 0
+        for attributes, size in records:
+            row_count += 1
+            row_bytes += size
+            if self._over_limits(row_count, row_bytes, values, state):
+                break
+            merger.add(attributes)
+        return merger.values, row_count
+
+    def _stale(self, cache_key, err, state):
+        """
+        :return: The last known result for cache_key
+        :raise: err when there is none
+        """
+        if self.last_good is None:
+            raise err
+        stale = self.last_good.get(cache_key)
+        if stale is None:
+            self.count('stale_missing')
+            raise err
+        self.count('stale_served')
+        log(self.logger, logging.WARNING, "{} Lookup failed, using the last known result: {}", state, self.logprefix,
+            err)
+        return {k: list(v) for k, v in stale.items()}
 
     def process(self, context, data):
         logprefix = DBAttributeStore.logprefix
 
-        # Initialize the configuration to use as the default configuration
-        # that is passed during initialization.
-        config = self.config
-        configClean = copy.deepcopy(config)
-        if 'db_password' in configClean:
-            configClean['db_password'] = 'XXXXXXXX'
-
-        satosa_logging(logger, logging.DEBUG, "{} Using default configuration {}".format(logprefix, configClean),
-                       context.state)
-
         # Find the entityID for the SP that initiated the flow and target IdP
         try:
             spEntityID = context.state.state_dict['SATOSA_BASE']['requester']
@@ -55,77 +227,24 @@ class DBAttributeStore(ResponseMicroService):
             # idpEntityID = urlsafe_b64decode(context.state.state_dict[router]['target_entity_id']).decode("utf-8")
             idpEntityID = data.auth_info.issuer
         except KeyError:
-            satosa_logging(logger, logging.ERROR,
-                           "{} Unable to determine the entityID's for the IdP or SP".format(logprefix), context.state)
+            log(self.logger, logging.ERROR, "{} Unable to determine the entityID's for the IdP or SP", context.state,
+                logprefix)
             return super().process(context, data)
 
-        satosa_logging(logger, logging.DEBUG, "{} entityID for the requester is {}".format(logprefix, spEntityID),
-                       context.state)
-        satosa_logging(logger, logging.ERROR, "{} entityID for the source IdP is {}".format(logprefix, idpEntityID),
-                       context.state)
-
-        # Examine our configuration to determine if there is a per-SP configuration
-        if spEntityID in self.config:
-            config = self.config[spEntityID]
-            configClean = copy.deepcopy(config)
-            if 'db_password' in configClean:
-                configClean['db_password'] = 'XXXXXXXX'
-            satosa_logging(logger, logging.DEBUG,
-                           "{} For SP {} using configuration {}".format(logprefix, spEntityID, configClean),
-                           context.state)
-
-        # Obtain configuration details from the per-SP configuration or the default configuration
-        try:
-            if 'db_host' in config:
-                db_host = config['db_host']
-            else:
-                db_host = self.config['db_host']
-
-            if 'db_user' in config:
-                db_user = config['db_user']
-            else:
-                db_user = self.config['db_user']
-
-            if 'db_schema' in config:
-                db_schema = config['db_schema']
-            else:
-                db_schema = self.config['db_schema']
-
-            if 'db_password' in config:
-                db_password = config['db_password']
-            else:
-                db_password = self.config['db_password']
-
-            if 'idp_identifiers' in config:
-                idp_identifiers = config['idp_identifiers']
-            else:
-                idp_identifiers = self.config['idp_identifiers']
-
-            if 'clear_input_attributes' in config:
-                clear_input_attributes = config['clear_input_attributes']
-            elif 'clear_input_attributes' in self.config:
-                clear_input_attributes = self.config['clear_input_attributes']
-            else:
-                clear_input_attributes = False
-
-            if 'user_id' in config:
-                user_id = config['user_id']
-            else:
-                user_id = self.config['user_id']
-
-            if 'blacklist' in config:
-                blacklist = config['blacklist']
-            else:
-                blacklist = self.config.get('blacklist') or []
+        log(self.logger, logging.DEBUG, "{} entityID for the requester is {}", context.state, logprefix, spEntityID)
+        log(self.logger, logging.DEBUG, "{} entityID for the source IdP is {}", context.state, logprefix, idpEntityID)
 
-        except KeyError as err:
-            satosa_logging(logger, logging.ERROR, "{} Configuration '{}' is missing".format(logprefix, err),
-                           context.state)
+        # The per-SP configuration or the default configuration, resolved at startup
+        config = self.sp_config.get(spEntityID)
+        if config is None:
+            log(self.logger, logging.ERROR, "{} Configuration is incomplete", context.state, logprefix)
             return super().process(context, data)
 
-        if spEntityID in blacklist:
-            satosa_logging(logger, logging.DEBUG, "{} Skipping lookup for {}".format(logprefix, spEntityID),
-                           context.state)
+        log(self.logger, logging.DEBUG, "{} For SP {} using configuration {}", context.state,
+            logprefix, spEntityID, config)
+
+        if spEntityID in config.blacklist:
+            log(self.logger, logging.DEBUG, "{} Skipping lookup for {}", context.state, logprefix, spEntityID)
             return super().process(context, data)
 
         try:
@@ -133,85 +252,77 @@ class DBAttributeStore(ResponseMicroService):
             # satosa_logging(logger, logging.DEBUG, "{} Using DB user {}".format(logprefix, db_user), context.state)
             # satosa_logging(logger, logging.DEBUG, "{} Using DB schema {}".format(logprefix, db_schema), context.state)
 
-            connection = MySQLdb.connect(host=db_host, user=db_user, passwd=db_password, db=db_schema)
-            cursor = connection.cursor()
-
-            satosa_logging(logger, logging.DEBUG, "{} Connected to DB server".format(logprefix), context.state)
-            satosa_logging(logger, logging.DEBUG,
-                           "{} Using IdP asserted attributes {}".format(logprefix, idp_identifiers), context.state)
+            log(self.logger, logging.DEBUG, "{} Using IdP asserted attributes {}", context.state,
+                logprefix, config.idp_identifiers)
 
             values = []
-            if user_id:
+            if config.user_id:
                 values += [data.user_id]
-            for identifier in idp_identifiers:
+            for identifier in config.idp_identifiers:
                 if identifier in data.attributes:
-                    satosa_logging(logger, logging.DEBUG,
-                                   "{} IdP asserted {} values for attribute {}: {}".format(logprefix, len(
-                                       data.attributes[identifier]), identifier, data.attributes[identifier]),
-                                   context.state)
+                    log(self.logger, logging.DEBUG, "{} IdP asserted {} values for attribute {}: {}", context.state,
+                        logprefix, len(data.attributes[identifier]), identifier, data.attributes[identifier])
                     values += data.attributes[identifier]
                 else:
-                    satosa_logging(logger, logging.DEBUG,
-                                   "{} IdP did not assert attribute {}".format(logprefix, identifier), context.state)
+                    log(self.logger, logging.DEBUG, "{} IdP did not assert attribute {}", context.state,
+                        logprefix, identifier)
 
-            satosa_logging(logger, logging.DEBUG, "{} IdP asserted values for DB id: {}".format(logprefix, values),
-                           context.state)
+            log(self.logger, logging.DEBUG, "{} IdP asserted values for DB id: {}", context.state, logprefix, values)
 
             return_values = {}
 
-            if (len(values) > 0):
-                # Prepare select statement
-                query = "SELECT p.`attributes` FROM `{}` p "
-                query += "JOIN `{}` ps ON p.`id`=ps.`zone_person_id` "
-                query += "JOIN `{}` z ON ps.`zone_service_id`=z.`id` "
-                query += "WHERE p.`uid` in (" + ",".join(['%s'] * len(values)) + ") "
-                query += "AND z.`metadata`=%s"
-                query = query.format(self.PEOPLE_TABLE, self.PERSON_SERVICES_TABLE, self.SERVICES_TABLE)
-
-                satosa_logging(logger, logging.DEBUG, "{} query: {}".format(logprefix, query), context.state)
-
-                # Execute prepared statement
-                cursor.execute(query, values + [spEntityID])
+            cache_key = (tuple(sorted(values)), spEntityID)
+            cached = self.cache.get(cache_key) if self.cache is not None and config.cache and values else None
 
-                rows = cursor.fetchall()
+            if cached is not None:
+                log(self.logger, logging.DEBUG, "{} Using cached lookup result", context.state, logprefix)
+                return_values = {k: list(v) for k, v in cached.items()}
 
-                for row in rows:
-                    attributes = json.loads(row[0])
-                    for k, v in attributes.items():
-                        if isinstance(v, str):
-                            v = [v]
-                        return_values.setdefault(k, []).extend(v)
-
-                if len(rows) > 1:
-                    satosa_logging(logger, logging.DEBUG, "{} More than one CO found ({})".format(logprefix, len(rows)),
-                                   context.state)
-
-            satosa_logging(logger, logging.DEBUG, "{} return_values: {}".format(logprefix, return_values),
-                           context.state)
+            elif (len(values) > 0):
+                pool = self._get_pool(config)
+                snapshot = self.snapshots.get((config.db_host, config.db_user, config.db_schema))
+                records = snapshot.lookup(values, spEntityID) if snapshot is not None else None
+                if records is not None:
+                    log(self.logger, logging.DEBUG, "{} Using snapshot", context.state, logprefix)
+                    return_values, row_count = self._merge_snapshot(records, values, context.state)
+                else:
+                    try:
+                        return_values, row_count = self._query(pool, values, spEntityID, context.state)
+                    except Exception as err:
+                        return_values = self._stale(cache_key, err, context.state)
+                        row_count = None
+
+                if row_count is not None:
+                    if row_count > 1:
+                        log(self.logger, logging.DEBUG, "{} More than one CO found ({})", context.state,
+                            logprefix, row_count)
+
+                    frozen = {k: tuple(v) for k, v in return_values.items()}
+                    if self.cache is not None and config.cache:
+                        # Empty results are kept for a shorter time
+                        self.cache.set(cache_key, frozen, ttl=None if return_values else self.cache_negative_ttl)
+                    if self.last_good is not None:
+                        self.last_good.set(cache_key, frozen)
+
+            log(self.logger, logging.DEBUG, "{} return_values: {}", context.state, logprefix, return_values)
 
         except Exception as err:
-            satosa_logging(logger, logging.ERROR, "{} Caught exception: {0}".format(logprefix, err), None)
+            log(self.logger, logging.ERROR, "{} Caught exception: {}", None, logprefix, err)
             return super().process(context, data)
 
-        else:
-            satosa_logging(logger, logging.DEBUG, "{} Closing connection to DB server".format(logprefix), context.state)
-            connection.close()
-
         # Before using a found record, if any, to populate attributes
         # clear any attributes incoming to this microservice if so configured.
-        if clear_input_attributes:
-            satosa_logging(logger, logging.DEBUG, "{} Clearing values from input attributes".format(logprefix),
-                           context.state)
+        if config.clear_input_attributes:
+            log(self.logger, logging.DEBUG, "{} Clearing values from input attributes", context.state, logprefix)
 
         internal = self.converter.to_internal(self.attribute_profile, return_values)
         for k, v in internal.items():
             if isinstance(v, str):
                 v = [v]
-            if clear_input_attributes:
+            if config.clear_input_attributes:
                 data.attributes[k] = v
             else:
-                data.attributes.setdefault(k, []).extend(v)
+                extend_unique(data.attributes.setdefault(k, []), v)
 
-        satosa_logging(logger, logging.DEBUG, "{} returning data.attributes {}".format(logprefix, str(data.attributes)),
-                       context.state)
+        log(self.logger, logging.DEBUG, "{} returning data.attributes {}", context.state, logprefix, data.attributes)
         return super().process(context, data)
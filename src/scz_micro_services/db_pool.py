@@ -0,0 +1,241 @@
+"""
+Connection pooling for the micro services that talk to a MySQL DB
+
+Pools are shared per (db_host, db_user, db_schema) and connect options, so
+all micro service instances and per-SP configurations pointing at the same
+database with the same timeouts reuse the same connections instead of
+connecting on every login.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from .instrumentation import REGISTRY
+
+logger = logging.getLogger('satosa')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(Exception):
+    """
+    No connection became available within the pool timeout
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of DB-API connections created by calling ``connect``.
+
+    Connections that have been idle for ``ping_interval`` seconds or more are
+    pinged on checkout and replaced when the ping fails. Unless ``rollback``
+    is False, for autocommit connections, connections are rolled back when
+    they are returned, so a pooled connection never keeps an old transaction
+    snapshot around. Callers that write must commit themselves.
+    """
+
+    def __init__(self, connect, size=5, timeout=10.0, ping_interval=30.0, rollback=True):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.rollback = rollback
+        self._idle = []
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'timeouts': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'discards': 0,
+        }
+
+    def _new_connection(self):
+        connection = self._connect()
+        with self._cond:
+            self._stats['connects'] += 1
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        with self._cond:
+            if not self._idle and self._in_use >= self.size:
+                self._stats['waits'] += 1
+            while not self._idle and self._in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout("No DB connection available after {}s".format(self.timeout))
+                self._cond.wait(remaining)
+            self._in_use += 1
+            waited = time.monotonic() - start
+            self._stats['checkouts'] += 1
+            entry = self._idle.pop() if self._idle else None
+            self._stats['wait_time'] += waited
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'], waited)
+
+        try:
+            if entry is None:
+                return self._new_connection()
+            connection, last_used = entry
+            if time.monotonic() - last_used >= self.ping_interval:
+                try:
+                    connection.ping()
+                except Exception as err:
+                    logger.info("DB connection failed liveness check, reconnecting: {}".format(err))
+                    self._close(connection)
+                    with self._cond:
+                        self._stats['reconnects'] += 1
+                    return self._new_connection()
+            return connection
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, connection, discard=False):
+        if not discard and self.rollback:
+            try:
+                connection.rollback()
+            except Exception:
+                discard = True
+        if discard:
+            self._close(connection)
+        with self._cond:
+            self._in_use -= 1
+            if discard:
+                self._stats['discards'] += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a connection for the duration of the with block.
+        A connection that raised inside the block is discarded, not reused.
+        """
+        connection = self._acquire()
+        try:
+            yield connection
+        except Exception:
+            self._release(connection, discard=True)
+            raise
+        self._release(connection)
+
+    def stats(self):
+        """
+        :return: A snapshot of the pool counters
+        """
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['in_use'] = self._in_use
+            stats['idle'] = len(self._idle)
+        return stats
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+
+def get_pool(key, connect, size=5, timeout=10.0, ping_interval=30.0, options=None, rollback=True):
+    """
+    Return the shared pool for key and options, creating it with connect if needed.
+    A pool is created by its first caller, later callers that ask for another
+    size, timeout or ping_interval get the existing pool and a warning.
+
+    :param key: (db_host, db_user, db_schema)
+    :param connect: callable returning a new DB-API connection
+    :param options: The connect options, like timeouts, that connect passes to the
+        driver. Callers with different options get different pools.
+    """
+    pool_key = tuple(key) + tuple(sorted((options or {}).items()))
+    with _pools_lock:
+        pool = _pools.get(pool_key)
+        if pool is None:
+            logger.info("Creating DB connection pool for {} (size {})".format(_label(pool_key), size))
+            pool = _pools[pool_key] = ConnectionPool(connect, size=size, timeout=timeout, ping_interval=ping_interval,
+                                                     rollback=rollback)
+        elif (pool.size, pool.timeout, pool.ping_interval) != (size, timeout, ping_interval):
+            logger.warning("Reusing DB connection pool for {} with size {}, timeout {} and ping interval {}, "
+                           "ignoring size {}, timeout {} and ping interval {}".format(
+                               _label(pool_key), pool.size, pool.timeout, pool.ping_interval, size, timeout,
+                               ping_interval))
+        return pool
+
+
+def pool_settings(config):
+    """
+    :return: The mysql_pool keyword arguments from the db_pool_size, db_pool_timeout,
+        db_pool_ping_interval, db_connect_timeout and db_read_timeout options of a micro service
+    """
+    return {
+        'size': config.get('db_pool_size', 5),
+        'timeout': config.get('db_pool_timeout', 10),
+        'ping_interval': config.get('db_pool_ping_interval', 30),
+        # Seconds, the driver defaults apply to the timeouts that are not configured
+        'options': {name: int(config['db_' + name]) for name in ('connect_timeout', 'read_timeout')
+                    if config.get('db_' + name)},
+    }
+
+
+def mysql_pool(db_config, size=5, timeout=10.0, ping_interval=30.0, options=None):
+    """
+    Return the shared pool of the MySQL DB of db_config, see get_pool. The
+    connections autocommit, so they are not rolled back on every release.
+
+    :param db_config: A configuration with db_host, db_user, db_password and db_schema, like a resolved SPConfig
+    :param options: The connect options of MySQLdb.connect, like connect_timeout and read_timeout
+    """
+    options = dict(options or {})
+
+    def connect():
+        # Only the DB micro services depend on mysqlclient, not the pool
+        import MySQLdb
+        return MySQLdb.connect(host=db_config.db_host, user=db_config.db_user, passwd=db_config.db_password,
+                               db=db_config.db_schema, autocommit=True, **options)
+
+    return get_pool((db_config.db_host, db_config.db_user, db_config.db_schema), connect, size=size, timeout=timeout,
+                    ping_interval=ping_interval, options=options, rollback=False)
+
+
+def _label(pool_key):
+    label = "{}@{}/{}".format(pool_key[1], pool_key[0], pool_key[2])
+    if len(pool_key) > 3:
+        label += "?" + "&".join("{}={}".format(name, value) for name, value in pool_key[3:])
+    return label
+
+
+def pool_stats():
+    """
+    :return: The stats of all shared pools keyed by "user@host/schema", followed
+        by the connect options, if any
+    """
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {_label(k): p.stats() for k, p in pools}
+
+
+REGISTRY.add_collector("db_pool", pool_stats)
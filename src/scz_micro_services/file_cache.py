@@ -0,0 +1,94 @@
+"""
+In-memory cache of static files with their HTTP validators
+"""
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from email.utils import formatdate
+
+CachedFile = namedtuple("CachedFile", ["body", "mimetype", "etag", "last_modified", "mtime", "size", "checked",
+                                       "parsed"])
+
+
+class FileCache(object):
+    """
+    Caches file contents with their mimetype, ETag and Last-Modified.
+
+    A cached file is served as is for ``check_interval`` seconds, after that
+    it is stat-ed and reloaded when its mtime or size changed. The cache holds
+    at most ``max_size`` bytes, least recently used files are dropped first.
+    Files larger than ``max_file_size`` are read on every request.
+
+    When given, ``parse(body, mimetype)`` is called once per load and its
+    result kept as ``parsed``.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024, max_file_size=1024 * 1024, check_interval=2.0, parse=None,
+                 timer=time.monotonic):
+        self._parse = parse
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.check_interval = check_interval
+        self._timer = timer
+        self._files = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'reloads': 0,
+            'evictions': 0,
+        }
+
+    def _load(self, path, stat, now):
+        with open(path, 'rb') as f:
+            body = f.read()
+        mimetype = mimetypes.guess_type(path)[0]
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:32])
+        return CachedFile(body, mimetype, etag, formatdate(stat.st_mtime, usegmt=True), stat.st_mtime_ns, stat.st_size,
+                          now, self._parse(body, mimetype) if self._parse else None)
+
+    def get(self, path):
+        """
+        :return: The CachedFile for path
+        :raise OSError: If path can not be read
+        """
+        now = self._timer()
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and now - cached.checked < self.check_interval:
+                self._files.move_to_end(path)
+                self._stats['hits'] += 1
+                return cached
+
+        stat = os.stat(path)
+        if cached is not None and (cached.mtime, cached.size) == (stat.st_mtime_ns, stat.st_size):
+            outcome = 'hits'
+            cached = cached._replace(checked=now)
+        else:
+            outcome = 'reloads' if cached is not None else 'misses'
+            cached = self._load(path, stat, now)
+
+        with self._lock:
+            self._stats[outcome] += 1
+            previous = self._files.pop(path, None)
+            if previous is not None:
+                self._size -= previous.size
+            if cached.size <= self.max_file_size:
+                self._files[path] = cached
+                self._size += cached.size
+                while self._size > self.max_size:
+                    _, evicted = self._files.popitem(last=False)
+                    self._size -= evicted.size
+                    self._stats['evictions'] += 1
+        return cached
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['files'] = len(self._files)
+            stats['size'] = self._size
+        return stats
@@ -0,0 +1,269 @@
+"""
+Latency histograms and outcome counters of the micro services, rendered in
+the Prometheus text format.
+
+Nothing is recorded until the Metrics micro service enables the registry,
+until then an instrumented process costs one flag check. The statistics of
+caches, pools and other components are read when the metrics are rendered.
+"""
+import logging
+import numbers
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+from satosa.response import Redirect
+
+logger = logging.getLogger('satosa')
+
+# Seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PROCESS_SECONDS = "satosa_micro_service_process_seconds"
+BACKEND_SECONDS = "satosa_micro_service_backend_seconds"
+OUTCOMES = "satosa_micro_service_outcomes_total"
+EVENTS = "satosa_micro_service_events_total"
+STATS = "satosa_micro_service_stat"
+
+_HELP = {
+    PROCESS_SECONDS: ("histogram", "Time spent in process, without the micro services after it"),
+    BACKEND_SECONDS: ("histogram", "Time spent in backend calls"),
+    OUTCOMES: ("counter", "Processed requests by outcome: pass_through, redirect, response or error"),
+    EVENTS: ("counter", "Notable events of the micro services, like a stale result served"),
+    STATS: ("gauge", "Statistics of the caches, pools and other components of the micro services"),
+}
+
+
+class _Histogram(object):
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.sum = 0.0
+
+
+def _stat_values(stats):
+    """
+    The numeric stats, booleans as 0 or 1 and a state like "open" as state_open 1
+    """
+    for stat, value in stats.items():
+        if isinstance(value, str):
+            yield "{}_{}".format(stat, value), 1
+        elif isinstance(value, numbers.Real):
+            yield stat, int(value) if isinstance(value, bool) else value
+
+
+def _labels(names, values):
+    return ",".join('{}="{}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for n, v in zip(names, values))
+
+
+class Registry(object):
+    """
+    Histograms and counters keyed by metric name and label values
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.enabled = False
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._services = weakref.WeakSet()
+        self._collectors = []
+        self._label_names = {
+            PROCESS_SECONDS: ("service",),
+            BACKEND_SECONDS: ("service", "backend"),
+            OUTCOMES: ("service", "outcome"),
+            EVENTS: ("service", "event"),
+            STATS: ("service", "component", "stat"),
+        }
+
+    def observe(self, metric, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get((metric, labels))
+            if histogram is None:
+                histogram = self._histograms[(metric, labels)] = _Histogram(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += value
+
+    def inc(self, metric, labels):
+        key = (metric, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    def add_service(self, service):
+        """
+        Export the component_stats of service for as long as it exists
+        """
+        with self._lock:
+            self._services.add(service)
+
+    def add_collector(self, service, collector):
+        """
+        Export the stats of components shared by micro services, like the DB pools
+
+        :param collector: Returns {component: stats}, like component_stats
+        """
+        with self._lock:
+            self._collectors.append((service, collector))
+
+    def _collect(self):
+        with self._lock:
+            sources = [(service.name, service.component_stats) for service in self._services] + self._collectors
+        gauges = {}
+        for service, collector in sources:
+            try:
+                components = collector()
+            except Exception as err:
+                logger.warning("Can't collect the stats of %s: %s", service, err)
+                continue
+            for component, stats in components.items():
+                for stat, value in _stat_values(stats):
+                    gauges[(service, component, stat)] = value
+        return gauges
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def render(self):
+        """
+        :return: All metrics in the Prometheus text exposition format
+        """
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+        gauges = self._collect()
+
+        lines = []
+        for metric in (PROCESS_SECONDS, BACKEND_SECONDS, OUTCOMES, EVENTS, STATS):
+            kind, description = _HELP[metric]
+            lines.append("# HELP {} {}".format(metric, description))
+            lines.append("# TYPE {} {}".format(metric, kind))
+            names = self._label_names[metric]
+            for (name, labels), (counts, total) in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                label_text = _labels(names, labels)
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, label_text, bound, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(metric, label_text, total))
+                lines.append("{}_count{{{}}} {}".format(metric, label_text, cumulative))
+            for (name, labels), count in sorted(counters.items()):
+                if name == metric:
+                    lines.append("{}{{{}}} {}".format(metric, _labels(names, labels), count))
+            if metric == STATS:
+                for labels, value in sorted(gauges.items()):
+                    lines.append("{}{{{}}} {}".format(metric, _labels(names, labels), value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _NotTimed(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOT_TIMED = _NotTimed()
+
+
+class _BackendTimer(object):
+    __slots__ = ('labels', 'start')
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        REGISTRY.observe(BACKEND_SECONDS, self.labels, time.perf_counter() - self.start)
+        return False
+
+
+class Instrumented(object):
+    """
+    Mixin for micro services that records the time spent in process, up to
+    the moment it hands the data to the next micro service, and its outcome.
+
+    Put it before the SATOSA base class::
+
+        class DBAttributeStore(Instrumented, ResponseMicroService):
+
+    Time backend calls with ``with self.backend("db"):`` and count other
+    events with ``self.count("event")``. The stats of caches and other
+    components are exported from ``component_stats``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_local = threading.local()
+        # The chain calls the instance attribute, which shadows the process method
+        self.process = self._instrument(self.process)
+        REGISTRY.add_service(self)
+
+    def _instrument(self, process):
+        local = self._metrics_local
+
+        def instrumented_process(context, data):
+            if not REGISTRY.enabled:
+                return process(context, data)
+            # Read at call time, a micro service may change its name after construction
+            service = (self.name,)
+            local.handoff = None
+            start = time.perf_counter()
+            try:
+                result = process(context, data)
+            except Exception:
+                handoff = local.handoff
+                outcome = 'error' if handoff is None else 'pass_through'
+                REGISTRY.observe(PROCESS_SECONDS, service, (handoff or time.perf_counter()) - start)
+                REGISTRY.inc(OUTCOMES, (self.name, outcome))
+                raise
+            handoff = local.handoff
+            if handoff is not None:
+                outcome = 'pass_through'
+            else:
+                handoff = time.perf_counter()
+                outcome = 'redirect' if isinstance(result, Redirect) else 'response'
+            REGISTRY.observe(PROCESS_SECONDS, service, handoff - start)
+            REGISTRY.inc(OUTCOMES, (self.name, outcome))
+            return result
+
+        return instrumented_process
+
+    def process(self, context, data):
+        # Reached through super().process of the micro service, right before next
+        if REGISTRY.enabled:
+            self._metrics_local.handoff = time.perf_counter()
+        return super().process(context, data)
+
+    def component_stats(self):
+        """
+        :return: {component: stats} of the caches and other components of this micro service
+        """
+        return {}
+
+    def count(self, event):
+        if REGISTRY.enabled:
+            REGISTRY.inc(EVENTS, (self.name, event))
+
+    def backend(self, backend):
+        """
+        :return: A context manager that records the duration of a call to backend
+        """
+        if not REGISTRY.enabled:
+            return _NOT_TIMED
+        return _BackendTimer((self.name, backend))
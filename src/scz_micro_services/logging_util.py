@@ -0,0 +1,40 @@
+"""
+Logging helpers for the micro services
+
+Messages are only formatted when their level is enabled, so large attribute
+dicts and configurations cost nothing to log at DEBUG when running at INFO.
+"""
+import logging
+
+from satosa.logging_util import satosa_logging
+
+
+def get_logger(name, config=None):
+    """
+    The logger of micro service name, a child of the satosa logger.
+    Its level can be overridden with log_level in the micro service config.
+
+    :param name: The micro service name
+    :param config: The micro service config
+    """
+    logger = logging.getLogger('satosa').getChild(name)
+    level = config.get('log_level') if config else None
+    if level:
+        logger.setLevel(level.upper() if isinstance(level, str) else level)
+    return logger
+
+
+def log(logger, level, message, state, *args, **kwargs):
+    """
+    Like satosa_logging, but message is formatted with args using str.format
+    and only if level is enabled for logger.
+
+    :param logger: Logger to use
+    :param level: Logger level
+    :param message: Message, a format string when args are given
+    :param state: The current state or None
+    :param args: Arguments to format message with
+    :param kwargs: Passed to satosa_logging, e.g. exc_info=True
+    """
+    if logger.isEnabledFor(level):
+        satosa_logging(logger, level, message.format(*args) if args else message, state, **kwargs)
@@ -2,13 +2,71 @@
 Micro Service that extracts info from IdP metadata if available
 """
 import logging
+import threading
+from collections import namedtuple
 
 from satosa.micro_services.base import ResponseMicroService
 
+from .instrumentation import Instrumented
+from .logging_util import get_logger
+
 logger = logging.getLogger('satosa')
 
+IssuerInfo = namedtuple("IssuerInfo", ["name", "registration_authority", "country"])
+
+
+def _sources(metadata_store):
+    # A pysaml2 MetadataStore replaces its sources when it reloads them
+    sources = getattr(metadata_store, 'metadata', None)
+    return tuple(sources.values()) if isinstance(sources, dict) else ()
+
+
+class IssuerIndex(object):
+    """
+    The IssuerInfo of the issuers in one metadata store, looked up on first
+    use or all at once by build. An index is current as long as the metadata
+    store and its sources are the same objects.
+    """
+
+    def __init__(self, metadata_store, lookup):
+        """
+        :param lookup: Returns the IssuerInfo for (metadata_store, issuer)
+        """
+        self.metadata_store = metadata_store
+        self._sources = _sources(metadata_store)
+        self._lookup = lookup
+        self._index = {}
 
-class MetaInfo(ResponseMicroService):
+    def is_current(self, metadata_store):
+        if metadata_store is not self.metadata_store:
+            return False
+        sources = _sources(metadata_store)
+        return len(sources) == len(self._sources) and all(a is b for a, b in zip(sources, self._sources))
+
+    def get(self, issuer):
+        info = self._index.get(issuer)
+        if info is None:
+            info = self._index[issuer] = self._lookup(self.metadata_store, issuer)
+        return info
+
+    def build(self):
+        """
+        Look up all identity providers of the metadata store
+        """
+        mds = self.metadata_store
+        issuers = mds.identity_providers() if hasattr(mds, 'identity_providers') else mds.keys()
+        for issuer in issuers:
+            try:
+                self.get(issuer)
+            except Exception as err:
+                logger.debug("MetaInfo skipping %s: %s", issuer, err)
+        logger.info("MetaInfo indexed %s issuers", len(self._index))
+
+    def __len__(self):
+        return len(self._index)
+
+
+class MetaInfo(Instrumented, ResponseMicroService):
     """
     Metadata info extracting micro_service
     """
@@ -18,6 +76,13 @@ class MetaInfo(ResponseMicroService):
         self.displayname = config.get('displayname', 'idp_name')
         self.country = config.get('country', 'idp_country')
         self.exceptions = config.get('exceptions', {})
+        # The metadata store only reaches a micro service with a response, so the index
+        # can't be built at startup. Instead, index all identity providers in the
+        # background when a response brings a new or reloaded metadata store
+        self.prebuild_index = config.get('prebuild', False)
+        self.index = None
+        self._index_lock = threading.Lock()
+        self.logger = get_logger(self.name, config)
         logger.info("MetaInfo micro_service is active %s, %s " % (self.displayname, self.country))
 
     def _get_name(self, mds, issuer):
@@ -41,21 +106,41 @@ class MetaInfo(ResponseMicroService):
             country = ra.split(".")[-1].replace("/", "")
         return country
 
+    def _lookup(self, mds, issuer):
+        ra = self._get_registration_authority(mds, issuer)
+        return IssuerInfo(self._get_name(mds, issuer), ra, self._get_ra_country(ra))
+
+    def _get_index(self, metadata_store):
+        index = self.index
+        if index is not None and index.is_current(metadata_store):
+            return index
+        with self._index_lock:
+            index = self.index
+            if index is None or not index.is_current(metadata_store):
+                self.logger.debug("New metadata, rebuilding issuer index")
+                index = self.index = IssuerIndex(metadata_store, self._lookup)
+                if self.prebuild_index:
+                    thread = threading.Thread(target=index.build, name="metainfo-index")
+                    thread.daemon = True
+                    thread.start()
+        return index
+
     def process(self, context, internal_response):
-        logger.info("Process MetaInfo")
+        self.logger.debug("Process MetaInfo")
         issuer = internal_response.auth_info.issuer
-        logger.info("Issuer: %s" % issuer)
+        self.logger.debug("Issuer: %s", issuer)
         metadata_store = context.internal_data.get('metadata_store')
-        if metadata_store:
-            name = self._get_name(metadata_store, issuer)
-            ra = self._get_registration_authority(metadata_store, issuer)
-            country = self._get_ra_country(ra)
+        if not metadata_store:
+            self.logger.debug("No metadata store")
+            return super().process(context, internal_response)
+
+        info = self._get_index(metadata_store).get(issuer)
 
-        internal_response.attributes[self.displayname] = [name]
-        internal_response.attributes[self.country] = [country]
+        internal_response.attributes[self.displayname] = [info.name]
+        internal_response.attributes[self.country] = [info.country]
 
-        logger.info("Name: %s" % name)
-        logger.info("RegAuth: %s" % ra)
-        logger.info("Country: %s" % country)
+        self.logger.debug("Name: %s", info.name)
+        self.logger.debug("RegAuth: %s", info.registration_authority)
+        self.logger.debug("Country: %s", info.country)
 
         return super().process(context, internal_response)
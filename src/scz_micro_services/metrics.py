@@ -0,0 +1,34 @@
+"""
+A Metrics microservice that serves the latencies and outcomes of the
+instrumented micro services in the Prometheus text format
+"""
+import logging
+
+from satosa.micro_services.base import RequestMicroService
+from satosa.response import Response
+
+from .instrumentation import REGISTRY
+from .logging_util import get_logger
+
+logger = logging.getLogger('satosa')
+
+
+class Metrics(RequestMicroService):
+    logprefix = "METRICS:"
+
+    def __init__(self, config, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
+        self.endpoint = config.get('endpoint', 'metrics').strip("/")
+        if config.get('buckets'):
+            REGISTRY.buckets = tuple(sorted(config['buckets']))
+            REGISTRY.clear()
+        # The instrumented micro services only record while the endpoint exists
+        REGISTRY.enabled = True
+
+    def register_endpoints(self):
+        logger.info("{} registering {}".format(self.logprefix, self.endpoint))
+        return [("^{}$".format(self.endpoint), self._handle)]
+
+    def _handle(self, context):
+        return Response(REGISTRY.render(), content="text/plain; version=0.0.4; charset=utf-8")
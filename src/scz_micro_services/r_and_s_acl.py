@@ -2,78 +2,133 @@
 SATOSA microservice that checks compliance with R&S attribute set
 """
 
-import copy
 import logging
+import re
 
-from satosa.logging_util import satosa_logging
+from satosa.exception import SATOSAConfigurationError
 from satosa.micro_services.base import ResponseMicroService
 from satosa.response import Redirect
 
-logger = logging.getLogger('satosa')
+from .instrumentation import Instrumented
+from .logging_util import get_logger, log
+from .sp_config import REQUIRED, SPConfig
 
 
-class RandSAcl(ResponseMicroService):
+# The R&S attribute bundle, eduPersonPrincipalName, a name and mail
+R_AND_S = "edupersonprincipalname and (displayname or (givenname and sn)) and mail"
+
+
+class Requirement(object):
+    """
+    A boolean expression with and, or and parentheses over attribute_mapping
+    names, compiled into the minimal sets of attributes that satisfy it. The
+    sets are bitmasks over the attributes the expression names, an attribute
+    is present when it has a non-empty value.
+    """
+    TOKENS = re.compile(r"\(|\)|[^\s()]+")
+
+    def __init__(self, expression, attribute_mapping):
+        self.expression = expression
+        self._names = []
+        self._tokens = self.TOKENS.findall(expression)
+        try:
+            masks = self._parse_or()
+            self.attributes = [(1 << i, attribute_mapping[name]) for i, name in enumerate(self._names)]
+        except (IndexError, KeyError) as err:
+            raise SATOSAConfigurationError("Invalid requirement '{}': {!r}".format(expression, err))
+        if self._tokens:
+            raise SATOSAConfigurationError("Invalid requirement '{}' at '{}'".format(expression, self._tokens[0]))
+        # Drop sets that contain a smaller set
+        self.masks = sorted({m for m in masks if not any(o != m and o & m == o for o in masks)})
+        del self._tokens
+
+    def _bit(self, name):
+        if name not in self._names:
+            self._names.append(name)
+        return 1 << self._names.index(name)
+
+    def _parse_or(self):
+        masks = self._parse_and()
+        while self._tokens and self._tokens[0].lower() == "or":
+            self._tokens.pop(0)
+            masks = masks + self._parse_and()
+        return masks
+
+    def _parse_and(self):
+        masks = self._parse_term()
+        while self._tokens and self._tokens[0].lower() == "and":
+            self._tokens.pop(0)
+            right = self._parse_term()
+            masks = [a | b for a in masks for b in right]
+        return masks
+
+    def _parse_term(self):
+        token = self._tokens.pop(0)
+        if token == "(":
+            masks = self._parse_or()
+            if self._tokens.pop(0) != ")":
+                raise KeyError(")")
+            return masks
+        if token in (")", "and", "or"):
+            raise KeyError(token)
+        return [self._bit(token)]
+
+    def matches(self, attributes):
+        """
+        :param attributes: The internal attributes
+        """
+        present = 0
+        for bit, name in self.attributes:
+            if any(attributes.get(name) or ()):
+                present |= bit
+        return any(mask & present == mask for mask in self.masks)
+
+
+class RandSAcl(Instrumented, ResponseMicroService):
     """
     Check existance of R&S attributes
     """
     logprefix = "R_AND_S_ACL:"
 
+    # Options that can be overridden per SP
+    OPTIONS = [
+        ('attribute_mapping', REQUIRED),
+        ('access_denied', REQUIRED),
+        ('requirement', R_AND_S),
+    ]
+
     def __init__(self, config, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
         self.config = config
+        self.sp_config = SPConfig(config, self.OPTIONS, logprefix=self.logprefix)
+        # The requirements of the default and per-SP configurations, compiled once
+        self.requirements = {sp: Requirement(c.requirement, c.attribute_mapping)
+                             for sp, c in self.sp_config.per_sp.items() if c is not None}
+        default = self.sp_config.default
+        self.default_requirement = Requirement(default.requirement, default.attribute_mapping) if default else None
 
     def process(self, context, data):
         logprefix = RandSAcl.logprefix
 
-        # Initialize the configuration to use as the default configuration
-        # that is passed during initialization.
-        config = self.config
-        configClean = copy.deepcopy(config)
-
-        satosa_logging(logger, logging.DEBUG, "{} Using default configuration {}".format(logprefix, configClean),
-                       context.state)
-
-        # Obtain configuration details from the per-SP configuration or the default configuration
-        try:
-            if 'attribute_mapping' in config:
-                attribute_mapping = config['attribute_mapping']
-            if 'access_denied' in config:
-                access_denied = config['access_denied']
-
-        except KeyError as err:
-            satosa_logging(logger, logging.ERROR, "{} Configuration '{}' is missing".format(logprefix, err),
-                           context.state)
+        # The per-SP configuration or the default configuration, resolved at startup
+        config = self.sp_config.get(data.requester)
+        if config is None:
+            log(self.logger, logging.ERROR, "{} Configuration is incomplete", context.state, logprefix)
             return super().process(context, data)
 
-        # Show what we have
-        satosa_logging(logger, logging.DEBUG, "{} attribute mapping: {}".format(logprefix, attribute_mapping),
-                       context.state)
-
-        received_attributes = data.attributes
-        satosa_logging(logger, logging.DEBUG, "{} attributes received: {}".format(logprefix, received_attributes),
-                       context.state)
-
-        # Do the hard work
-        valid_attributes = {a: received_attributes[v] for (a, v) in attribute_mapping.items() if
-                            (v in received_attributes and ''.join(received_attributes[v]))}
-        satosa_logging(logger, logging.DEBUG, "{} valid attributes: {}".format(logprefix, valid_attributes),
-                       context.state)
-
-        isset = {a: a in valid_attributes for a in attribute_mapping.keys()}
-        satosa_logging(logger, logging.DEBUG, "{} isset: {}".format(logprefix, isset), context.state)
+        requirement = self.requirements.get(data.requester, self.default_requirement)
+        log(self.logger, logging.DEBUG, "{} requirement: {}", context.state, logprefix, requirement.expression)
+        log(self.logger, logging.DEBUG, "{} attributes received: {}", context.state, logprefix, data.attributes)
 
-        # valid_r_and_s = (isset['edupersonprincipalname'] or (isset['edupersonprincipalname'] and isset['edupersontargetedid'])) and (isset['displayname'] or (isset['givenname'] and isset['sn'])) and isset['mail']
-        valid_r_and_s = (isset['edupersonprincipalname'] or (
-                isset['edupersonprincipalname'] and isset['edupersontargetedid'])) and (
-                                isset['displayname'] or (isset['givenname'] and isset['sn'])) and (isset['mail'])
+        valid_r_and_s = requirement.matches(data.attributes)
 
         if valid_r_and_s:
-            satosa_logging(logger, logging.DEBUG, "{} R&S attribute set found, user may continue".format(logprefix),
-                           context.state)
+            log(self.logger, logging.DEBUG, "{} R&S attribute set found, user may continue", context.state, logprefix)
         else:
-            satosa_logging(logger, logging.DEBUG,
-                           "{} missing R&S attribute set, user may not continue".format(logprefix), context.state)
+            log(self.logger, logging.DEBUG, "{} missing R&S attribute set, user may not continue", context.state,
+                logprefix)
             context.state['substitutions'] = {'%custom%': data.auth_info.issuer}
-            return Redirect(access_denied)
+            return Redirect(config.access_denied)
 
         return super().process(context, data)
@@ -5,77 +5,228 @@ the home organization SAML IdP as a key to query the SBS API
 for attributes assert them to the receiving SP.
 """
 
-import copy
 import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 from satosa.attribute_mapping import AttributeMapper
-from satosa.logging_util import satosa_logging
 from satosa.micro_services.base import ResponseMicroService
+from urllib3.util.retry import Retry
 
-logger = logging.getLogger("satosa")
+from .cache import TTLCache
+from .circuit_breaker import CircuitBreaker
+from .instrumentation import Instrumented
+from .logging_util import get_logger, log
+from .single_flight import SingleFlight
+from .sp_config import REQUIRED, SPConfig
 
 
-class SBSAttributeStore(ResponseMicroService):
+CachedAttributes = namedtuple("CachedAttributes", ["internal", "etag", "fresh_until", "stale_until"])
+
+
+class SBSAttributeStore(Instrumented, ResponseMicroService):
     log_prefix = "SBS_ATTRIBUTE_STORE:"
     attribute_profile = "saml"
 
+    # Options that can be overridden per SP and their defaults
+    OPTIONS = [
+        ("sbs_api_user", REQUIRED),
+        ("sbs_api_password", REQUIRED),
+        ("sbs_api_base_url", REQUIRED),
+        ("sbs_blacklist", []),
+    ]
+
     def __init__(self, config, internal_attributes, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.logger = get_logger(self.name, config)
         self.config = config
         self.converter = AttributeMapper(internal_attributes)
+        self.sp_config = SPConfig(config, self.OPTIONS, secrets=["sbs_api_password"], logprefix=self.log_prefix)
+        self.timeout = (config.get("sbs_connect_timeout", 2), config.get("sbs_read_timeout", 5))
+        self.session = self._create_session(config)
+        self.circuit_breaker = CircuitBreaker("SBS",
+                                              failure_threshold=config.get("sbs_breaker_failure_threshold", 5),
+                                              reset_timeout=config.get("sbs_breaker_reset_timeout", 30))
+        # Concurrent lookups for the same (uid, service_entity_id) share one request
+        self.single_flight = SingleFlight()
+
+        # Converted attributes per (uid, service_entity_id), kept for revalidation with their ETag
+        self.cache = None
+        self.cache_default_ttl = config.get("sbs_cache_default_ttl", 0)
+        self.cache_stale_while_revalidate = config.get("sbs_cache_stale_while_revalidate", 0)
+        if config.get("sbs_cache_size"):
+            self.cache = TTLCache(maxsize=config["sbs_cache_size"], ttl=config.get("sbs_cache_retention", 3600))
+            self._revalidator = ThreadPoolExecutor(max_workers=config.get("sbs_cache_revalidate_workers", 2))
+            self._revalidating = set()
+            self._revalidating_lock = threading.Lock()
+
+    def stats(self):
+        """
+        :return: The SBS requests made and coalesced, and the circuit breaker statistics
+        """
+        return {"requests": self.single_flight.stats(), "circuit_breaker": self.circuit_breaker.stats()}
+
+    def component_stats(self):
+        components = self.stats()
+        if self.cache is not None:
+            components["cache"] = self.cache.stats()
+        return components
 
     @staticmethod
-    def _debug(msg, context):
-        satosa_logging(logger, logging.DEBUG, msg, context.state)
+    def _create_session(config):
+        """
+        One keep-alive session for all logins, retrying connection errors and
+        5xx responses with exponential backoff, ignoring Retry-After.
+        """
+        retry = Retry(total=config.get("sbs_retries", 2),
+                      backoff_factor=config.get("sbs_retry_backoff", 0.1),
+                      status_forcelist=(502, 503, 504),
+                      # A Retry-After from SBS must not stall the login beyond the backoff
+                      respect_retry_after_header=False,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.get("sbs_pool_size", 10), max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _debug(self, msg, context, *args):
+        log(self.logger, logging.DEBUG, msg, context.state, *args)
 
     def process(self, context, data):
-        config_clean = copy.deepcopy(self.config)
-        if "sbs_api_password" in config_clean:
-            del config_clean["sbs_api_password"]
-
-        self._debug(f"{self.log_prefix} Using default configuration {config_clean}", context)
-
         # Find the entityID for the SP that initiated the flow and target IdP
         try:
             sp_entity_id = context.state.state_dict["SATOSA_BASE"]["requester"]
             idp_entity_id = data.auth_info.issuer
         except KeyError:
-            satosa_logging(logger, logging.ERROR,
-                           f"{self.log_prefix} Unable to determine the entityID's for the IdP or SP", context.state)
+            log(self.logger, logging.ERROR, "{} Unable to determine the entityID's for the IdP or SP", context.state,
+                self.log_prefix)
             return super().process(context, data)
 
-        self._debug(f"{self.log_prefix} entityID for the requester is {sp_entity_id}", context)
-        self._debug(f"{self.log_prefix} entityID for the source IdP is {idp_entity_id}", context)
+        self._debug("{} entityID for the requester is {}", context, self.log_prefix, sp_entity_id)
+        self._debug("{} entityID for the source IdP is {}", context, self.log_prefix, idp_entity_id)
 
-        try:
-            sbs_api_user = self.config["sbs_api_user"]
-            sbs_api_password = self.config["sbs_api_password"]
-            sbs_api_base_url = self.config["sbs_api_base_url"]
-            sbs_blacklist = self.config.get("sbs_blacklist") or []
-
-        except KeyError as err:
-            satosa_logging(logger, logging.ERROR, f"{self.log_prefix} Configuration {err} is missing", context.state)
+        # The per-SP configuration or the default configuration, resolved at startup
+        config = self.sp_config.get(sp_entity_id)
+        if config is None:
+            log(self.logger, logging.ERROR, "{} Configuration is incomplete", context.state, self.log_prefix)
             return super().process(context, data)
 
-        if sp_entity_id in sbs_blacklist:
-            satosa_logging(logger, logging.DEBUG, f"{self.log_prefix} Skipping lookup for {sp_entity_id}", context.state)
-            return super().process(context, data)
+        self._debug("{} Using configuration {}", context, self.log_prefix, config)
 
-        res = requests.get(f"{sbs_api_base_url}api/users/attributes",
-                           params={"service_entity_id": sp_entity_id, "uid": data.user_id},
-                           auth=(sbs_api_user, sbs_api_password))
-        if res.status_code != 200:
-            satosa_logging(logger, logging.ERROR, f"{self.log_prefix} Error response {res.status_code} from SBS",
-                           context.state)
+        if sp_entity_id in config.sbs_blacklist:
+            log(self.logger, logging.DEBUG, "{} Skipping lookup for {}", context.state, self.log_prefix, sp_entity_id)
             return super().process(context, data)
 
-        json_response = res.json()
-        self._debug(f"{self.log_prefix} Response from SBS: {json_response}", context)
+        url = f"{config.sbs_api_base_url}api/users/attributes"
+        params = {"service_entity_id": sp_entity_id, "uid": data.user_id}
+        auth = (config.sbs_api_user, config.sbs_api_password)
+
+        key = (data.user_id, sp_entity_id)
+        entry = self.cache.get(key) if self.cache is not None else None
+        now = time.monotonic()
+        if entry is not None and now < entry.stale_until:
+            if now >= entry.fresh_until:
+                self._revalidate_in_background(key, entry, url, params, auth)
+            self._debug("{} Using cached attributes for {}", context, self.log_prefix, key)
+            internal = entry.internal
+        else:
+            internal = self.single_flight.do(key, self._fetch, key, entry, url, params, auth, context.state)
+            if internal is None:
+                return super().process(context, data)
 
-        internal = self.converter.to_internal(self.attribute_profile, json_response)
         for k, v in internal.items():
-            data.attributes[k] = v
+            data.attributes[k] = list(v)
 
-        self._debug(f"{self.log_prefix} returning data.attributes {data.attributes}", context)
+        self._debug("{} returning data.attributes {}", context, self.log_prefix, data.attributes)
         return super().process(context, data)
+
+    def _fetch(self, key, entry, url, params, auth, state):
+        """
+        Get the attributes from SBS, revalidating a cached entry if there is one
+
+        :return: The internal attributes or None when SBS did not answer
+        """
+        if not self.circuit_breaker.allow():
+            log(self.logger, logging.WARNING, "{} SBS circuit breaker is open, skipping lookup", state, self.log_prefix)
+            return None
+
+        headers = {"If-None-Match": entry.etag} if entry is not None and entry.etag else None
+        try:
+            with self.backend("sbs"):
+                res = self.session.get(url, params=params, auth=auth, headers=headers, timeout=self.timeout)
+        except requests.RequestException as err:
+            self.circuit_breaker.record_failure()
+            log(self.logger, logging.ERROR, "{} Error calling SBS: {}", state, self.log_prefix, err)
+            return None
+
+        if res.status_code >= 500:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+
+        if res.status_code == 304 and headers:
+            log(self.logger, logging.DEBUG, "{} Attributes for {} not modified", state, self.log_prefix, key)
+            self._store(key, res, entry.internal, entry.etag)
+            return entry.internal
+
+        if res.status_code != 200:
+            log(self.logger, logging.ERROR, "{} Error response {} from SBS", state, self.log_prefix, res.status_code)
+            return None
+
+        json_response = res.json()
+        log(self.logger, logging.DEBUG, "{} Response from SBS: {}", state, self.log_prefix, json_response)
+
+        internal = self.converter.to_internal(self.attribute_profile, json_response)
+        internal = {k: tuple(v) for k, v in internal.items()}
+        self._store(key, res, internal)
+        return internal
+
+    def _store(self, key, res, internal, etag=None):
+        """
+        Cache internal attributes for as long as the Cache-Control of res allows
+        """
+        if self.cache is None:
+            return
+        directives = {}
+        for directive in res.headers.get("Cache-Control", "").split(","):
+            name, _, value = directive.strip().partition("=")
+            if name:
+                directives[name.lower()] = value.strip('"')
+        if "no-store" in directives:
+            self.cache.delete(key)
+            return
+
+        max_age = 0 if "no-cache" in directives else _seconds(directives.get("max-age"), self.cache_default_ttl)
+        stale = _seconds(directives.get("stale-while-revalidate"), self.cache_stale_while_revalidate)
+        etag = res.headers.get("ETag", etag)
+        if not max_age and not etag:
+            return
+        now = time.monotonic()
+        self.cache.set(key, CachedAttributes(internal, etag, now + max_age, now + max_age + stale))
+
+    def _revalidate_in_background(self, key, entry, url, params, auth):
+        with self._revalidating_lock:
+            if key in self._revalidating:
+                return
+            self._revalidating.add(key)
+
+        def revalidate():
+            try:
+                self.single_flight.do(key, self._fetch, key, entry, url, params, auth, None)
+            finally:
+                with self._revalidating_lock:
+                    self._revalidating.discard(key)
+
+        self._revalidator.submit(revalidate)
+
+
+def _seconds(value, default):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,104 @@
+"""
+Resolve micro service configuration once, per SP entityID
+"""
+import logging
+import re
+from collections import namedtuple
+from types import MappingProxyType
+
+logger = logging.getLogger('satosa')
+
+REQUIRED = object()
+
+# entityIDs are URIs, like https://sp.example.org or urn:mace:example.org:sp
+_ENTITY_ID = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:")
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    return value
+
+
+class SPConfig(object):
+    """
+    The effective configuration of a micro service for the default and for
+    every per-SP override, resolved at construction into immutable tuples.
+
+    A per-SP override is a top level key that looks like an entityID, a URI,
+    whose value is a dict. Other dict values that are not options, like a
+    misspelled option, and unknown options in an override are logged and
+    ignored. Options missing from an override come from the
+    default configuration, then from the option default, which also replaces
+    empty (None) values. Configurations that lack a REQUIRED option are logged
+    once and resolve to None.
+    """
+
+    def __init__(self, config, options, secrets=(), logprefix=""):
+        """
+        :param config: The micro service config
+        :param options: A list of (option name, default value or REQUIRED)
+        :param secrets: Option names that are masked in the repr
+        """
+        fields = namedtuple("Config", [name for name, _ in options])
+
+        class Config(fields):
+            __slots__ = ()
+
+            def __repr__(self):
+                masked = {s: 'XXXXXXXX' for s in secrets if getattr(self, s) is not None}
+                return fields.__repr__(self._replace(**masked))
+
+        self.logprefix = logprefix
+        self._config_type = Config
+        self._options = options
+        self.default = self._resolve(config, config, "default")
+        names = {name for name, _ in options}
+        self.per_sp = {}
+        for key, value in config.items():
+            if key in names or not isinstance(value, dict):
+                continue
+            if not _ENTITY_ID.match(key):
+                logger.warning("{} Ignoring {}, it is neither an option nor an entityID".format(logprefix, key))
+                continue
+            unknown = sorted(set(value) - names)
+            if unknown:
+                logger.warning("{} Ignoring unknown options for {}: {}".format(logprefix, key, ", ".join(unknown)))
+            self.per_sp[key] = self._resolve(value, config, key)
+
+    def _resolve(self, sp_config, config, label):
+        values = []
+        missing = []
+        for name, default in self._options:
+            if name in sp_config:
+                value = sp_config[name]
+            elif name in config:
+                value = config[name]
+            elif default is REQUIRED:
+                missing.append(name)
+                continue
+            else:
+                value = default
+            if value is None and default is not REQUIRED:
+                value = default
+            values.append(_freeze(value))
+        if missing:
+            logger.error("{} Configuration {} is missing for {}".format(self.logprefix, ", ".join(missing), label))
+            return None
+        return self._config_type(*values)
+
+    def get(self, sp_entity_id):
+        """
+        :return: The configuration for sp_entity_id, None if it is incomplete
+        """
+        return self.per_sp.get(sp_entity_id, self.default)
+
+    def all(self):
+        """
+        :return: All complete configurations, the default first
+        """
+        return [c for c in [self.default] + list(self.per_sp.values()) if c is not None]
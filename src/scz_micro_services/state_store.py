@@ -0,0 +1,114 @@
+"""
+Compact encoding and server-side storage of data that would otherwise be
+kept in the SATOSA state cookie
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from base64 import urlsafe_b64encode
+
+from satosa.exception import SATOSAConfigurationError
+
+from .cache import TTLCache
+
+
+def encode(data):
+    """
+    :return: data as compressed JSON, in bytes
+    """
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"), 9)
+
+
+def decode(blob):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+def new_key():
+    """
+    :return: An opaque, unguessable key
+    """
+    return urlsafe_b64encode(os.urandom(24)).decode("ascii")
+
+
+class MemoryStateStore(object):
+    """
+    Keeps values in memory for ttl seconds. Values are not shared between
+    processes, use it with a single SATOSA process only.
+    """
+
+    def __init__(self, ttl=600.0, maxsize=10000):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def put(self, value):
+        """
+        :param value: bytes
+        :return: The key to get value back
+        """
+        key = new_key()
+        self._cache.set(key, value)
+        return key
+
+    def get(self, key):
+        """
+        :return: The value stored under key, None if it is unknown or expired
+        """
+        return self._cache.get(key)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+
+class SqliteStateStore(object):
+    """
+    Keeps values in an SQLite database for ttl seconds, shared by the SATOSA
+    processes of one host
+    """
+
+    def __init__(self, path, ttl=600.0, timer=time.time):
+        self.ttl = ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS `states` "
+                                 "(`key` TEXT PRIMARY KEY, `value` BLOB, `expires` REAL)")
+
+    def put(self, value):
+        key = new_key()
+        now = self._timer()
+        with self._lock:
+            self._connection.execute("DELETE FROM `states` WHERE `expires` < ?", [now])
+            self._connection.execute("INSERT INTO `states` VALUES (?, ?, ?)", [key, value, now + self.ttl])
+        return key
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute("SELECT `value` FROM `states` WHERE `key` = ? AND `expires` >= ?",
+                                           [key, self._timer()]).fetchone()
+        return bytes(row[0]) if row else None
+
+    def delete(self, key):
+        with self._lock:
+            self._connection.execute("DELETE FROM `states` WHERE `key` = ?", [key])
+
+
+def get_state_store(config):
+    """
+    :param config: The state_store config, with type memory or sqlite, ttl
+        and, for sqlite, path
+    :return: A state store or None for storage in the state
+    """
+    if not config:
+        return None
+    store_type = config.get('type', 'memory')
+    ttl = config.get('ttl', 600)
+    if store_type == 'memory':
+        return MemoryStateStore(ttl=ttl, maxsize=config.get('size', 10000))
+    if store_type == 'sqlite':
+        if 'path' not in config:
+            raise SATOSAConfigurationError("state_store of type sqlite needs a path")
+        return SqliteStateStore(config['path'], ttl=ttl)
+    raise SATOSAConfigurationError("Unknown state_store type {}".format(store_type))
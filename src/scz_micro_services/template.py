@@ -0,0 +1,47 @@
+"""
+Substitution templates for static pages
+"""
+import re
+
+# Placeholders look like %name%, as in the substitutions other micro services put in the state
+PLACEHOLDER = re.compile(r"(%\w+%)")
+
+_TEXT_TYPES = ("application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+
+class Template(object):
+    """
+    A text split once into literal segments and placeholder slots, the
+    parts at odd indexes are placeholders
+    """
+
+    def __init__(self, text):
+        self.parts = PLACEHOLDER.split(text)
+        self.placeholders = frozenset(self.parts[1::2])
+
+    @classmethod
+    def parse(cls, body, mimetype, encoding="utf-8"):
+        """
+        :return: The Template of a text body with placeholders, None for
+            other bodies, which are served as is
+        """
+        if not mimetype or not (mimetype.startswith("text/") or mimetype in _TEXT_TYPES):
+            return None
+        try:
+            text = body.decode(encoding)
+        except UnicodeDecodeError:
+            return None
+        template = cls(text)
+        return template if template.placeholders else None
+
+    def render(self, values):
+        """
+        Replace the placeholders by their values in one pass, placeholders
+        without a value are kept
+        """
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            value = values.get(parts[i])
+            if value is not None:
+                parts[i] = str(value)
+        return "".join(parts)
@@ -0,0 +1,134 @@
+"""
+Bounded write-behind queue that batches writes off the login path
+"""
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('satosa')
+
+_STOP = object()
+
+
+class WriteBehindQueue(object):
+    """
+    Collects (key, value) writes and hands them to ``flush`` in batches from a
+    background thread. A batch is flushed when it holds ``batch_size`` items or
+    ``flush_interval`` seconds after its first item, whichever comes first.
+    Within a batch the last value per key wins.
+
+    Values that are queued but not yet flushed can be read back with
+    ``pending`` so callers see their own writes.
+    """
+
+    def __init__(self, flush, queue_size=1000, batch_size=100, flush_interval=1.0, name="write-behind"):
+        self._flush = flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(queue_size)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {
+            'queued': 0,
+            'flushed': 0,
+            'batches': 0,
+            'failures': 0,
+            'overflows': 0,
+        }
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pending(self, key):
+        """
+        :return: The queued, not yet flushed, value for key or None
+        """
+        with self._lock:
+            return self._pending.get(key)
+
+    def put(self, key, value):
+        """
+        Queue a write without blocking
+
+        :return: False if the queue is full or closed, the caller must write itself
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            self._pending[key] = value
+        try:
+            self._queue.put_nowait((key, value))
+        except queue.Full:
+            with self._lock:
+                if self._pending.get(key) == value:
+                    del self._pending[key]
+                self._stats['overflows'] += 1
+            return False
+        with self._lock:
+            self._stats['queued'] += 1
+        return True
+
+    def _write(self, batch):
+        items = OrderedDict()
+        for key, value in batch:
+            items[key] = value
+        try:
+            self._flush(list(items.items()))
+        except Exception as err:
+            logger.error("Write-behind flush of {} items failed: {}".format(len(items), err))
+            with self._lock:
+                self._stats['failures'] += 1
+        else:
+            with self._lock:
+                self._stats['flushed'] += len(items)
+                self._stats['batches'] += 1
+        with self._lock:
+            for key, value in items.items():
+                if self._pending.get(key) == value:
+                    del self._pending[key]
+
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    running = False
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+
+    def stats(self):
+        """
+        :return: A snapshot of the queue counters
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+    def close(self, timeout=10.0):
+        """
+        Stop accepting writes and drain everything queued so far
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
@@ -0,0 +1,183 @@
+"""
+In-memory snapshot of the zone tables for DB-free attribute lookups
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from .attribute_merge import loads
+
+logger = logging.getLogger('satosa')
+
+Index = namedtuple("Index", ["loaded_at", "uids", "people", "services", "memberships", "updated", "full_at"])
+
+
+def collation_key(value):
+    """
+    value as the default MySQL collations compare it in the lookup query,
+    case insensitive and, like the PAD SPACE collations, without trailing
+    spaces. Accents are not folded.
+    """
+    return value.rstrip(" ").casefold() if isinstance(value, str) else value
+
+
+class ZoneSnapshot(object):
+    """
+    Loads zone_people, zone_person_zone_service and zone_services into
+    indexes from a background thread, every ``refresh_interval`` seconds:
+
+    - uids: uid to the ids of the people with that uid
+    - people: person id to (uid, attributes, size of the attributes JSON)
+    - services: person id to the metadata of the services the person is in
+
+    The uids and metadata are indexed and looked up by their collation_key,
+    so they match like in the lookup query.
+
+    When ``updated_column`` names a zone_people column that grows on every
+    change, refreshes only load the people changed since the previous
+    refresh, the (small) membership tables are always loaded in full. Rows
+    at the previous high-water mark are read again, so rows written later
+    with the same value are not missed. Removed people are dropped by
+    comparing with the ids in zone_people, and every
+    ``full_refresh_interval`` seconds everything is loaded again.
+
+    Every refresh builds new indexes and swaps them in, readers never lock.
+    ``lookup`` returns None while the snapshot is loading or older than
+    ``max_age`` seconds, callers then query the DB.
+    """
+    PEOPLE_TABLE = "zone_people"
+    PERSON_SERVICES_TABLE = "zone_person_zone_service"
+    SERVICES_TABLE = "zone_services"
+
+    def __init__(self, pool, refresh_interval=300.0, max_age=900.0, updated_column=None, full_refresh_interval=3600.0,
+                 cursorclass=None, name="zone-snapshot", timer=time.monotonic):
+        """
+        :param pool: The ConnectionPool of the DB
+        :param cursorclass: Cursor class for the bulk loads, e.g. an unbuffered cursor
+        """
+        self._pool = pool
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.updated_column = updated_column
+        self.full_refresh_interval = full_refresh_interval
+        self._cursorclass = cursorclass
+        self._timer = timer
+        self._index = None
+        self._stats = {
+            'refreshes': 0,
+            'full_refreshes': 0,
+            'failures': 0,
+            'load_time': 0.0,
+        }
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _query(self, connection, query, args=()):
+        cursor = connection.cursor(self._cursorclass) if self._cursorclass else connection.cursor()
+        try:
+            cursor.execute(query, args)
+            for row in cursor:
+                yield row
+        finally:
+            cursor.close()
+
+    def refresh(self):
+        """
+        Load the tables and swap in the new indexes
+        """
+        start = self._timer()
+        previous = self._index
+        incremental = self.updated_column is not None and previous is not None
+        if incremental and start - previous.full_at >= self.full_refresh_interval:
+            incremental = False
+        with self._pool.connection() as connection:
+            metadata = dict(self._query(connection, "SELECT `id`, `metadata` FROM `{}`".format(self.SERVICES_TABLE)))
+
+            services = {}
+            memberships = 0
+            query = "SELECT `zone_person_id`, `zone_service_id` FROM `{}`".format(self.PERSON_SERVICES_TABLE)
+            for person_id, service_id in self._query(connection, query):
+                if service_id in metadata:
+                    services.setdefault(person_id, set()).add(collation_key(metadata[service_id]))
+                    memberships += 1
+
+            people = dict(previous.people) if incremental else {}
+            updated = previous.updated if incremental else None
+            if self.updated_column is None:
+                query = "SELECT `id`, `uid`, `attributes`, NULL FROM `{}`".format(self.PEOPLE_TABLE)
+                rows = self._query(connection, query)
+            elif updated is None:
+                query = "SELECT `id`, `uid`, `attributes`, `{}` FROM `{}`".format(self.updated_column, self.PEOPLE_TABLE)
+                rows = self._query(connection, query)
+            else:
+                # Drop the people that were removed since the previous refresh
+                ids = {row[0] for row in self._query(connection, "SELECT `id` FROM `{}`".format(self.PEOPLE_TABLE))}
+                for person_id in set(people) - ids:
+                    del people[person_id]
+                query = "SELECT `id`, `uid`, `attributes`, `{0}` FROM `{1}` WHERE `{0}` >= %s".format(
+                    self.updated_column, self.PEOPLE_TABLE)
+                rows = self._query(connection, query, [updated])
+            for person_id, uid, attributes, person_updated in rows:
+                people[person_id] = (uid, loads(attributes), len(attributes))
+                if person_updated is not None and (updated is None or person_updated > updated):
+                    updated = person_updated
+
+        uids = {}
+        for person_id, (uid, _, _) in people.items():
+            uids.setdefault(collation_key(uid), []).append(person_id)
+
+        self._index = Index(self._timer(), uids, people, services, memberships, updated,
+                            previous.full_at if incremental else start)
+        self._stats['refreshes'] += 1
+        if not incremental:
+            self._stats['full_refreshes'] += 1
+        self._stats['load_time'] = self._timer() - start
+
+    def lookup(self, uids, metadata):
+        """
+        :param uids: The uids of the person
+        :param metadata: The entityID of the service
+        :return: (attributes, size of their JSON) of the people with one of uids
+            that are in the service metadata, None if the snapshot is loading or stale
+        """
+        index = self._index
+        if index is None or self._timer() - index.loaded_at > self.max_age:
+            return None
+        metadata = collation_key(metadata)
+        result = []
+        for uid in {collation_key(uid) for uid in uids}:
+            for person_id in index.uids.get(uid, ()):
+                if metadata in index.services.get(person_id, ()):
+                    result.append(index.people[person_id][1:])
+        return result
+
+    def _run(self):
+        while not self._closed.is_set():
+            try:
+                self.refresh()
+            except Exception as err:
+                self._stats['failures'] += 1
+                logger.error("Zone snapshot refresh failed: {}".format(err))
+            self._closed.wait(self.refresh_interval)
+
+    def stats(self):
+        """
+        :return: The age in seconds and size of the snapshot and the refresh counters
+        """
+        stats = dict(self._stats)
+        index = self._index
+        stats['loaded'] = index is not None
+        stats['age'] = self._timer() - index.loaded_at if index is not None else None
+        stats['stale'] = index is None or stats['age'] > self.max_age
+        stats['people'] = len(index.people) if index is not None else 0
+        stats['memberships'] = index.memberships if index is not None else 0
+        return stats
+
+    def close(self):
+        self._closed.set()
@@ -0,0 +1,104 @@
+import time
+from unittest import TestCase
+
+from munch import munchify
+from satosa.internal_data import AuthenticationInformation, InternalResponse
+from satosa.micro_services.base import ResponseMicroService
+from satosa.state import State
+
+from scz_micro_services.attribute_aggregator import STATE_KEY, AttributeAggregator
+
+
+class StaticSource(ResponseMicroService):
+    """
+    Adds the configured attributes after the configured delay
+    """
+
+    def __init__(self, config, internal_attributes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config = config
+
+    def process(self, context, data):
+        time.sleep(self.config.get("delay", 0))
+        for key, value in self.config.get("state", {}).items():
+            # Each source sees only its own writes
+            context.state[key] = dict(context.state[key], **value) if key in context.state else value
+        for key in self.config.get("delete_state", []):
+            del context.state[key]
+        if self.config.get("fail"):
+            raise ValueError("failed")
+        for name, values in self.config["attributes"].items():
+            data.attributes.setdefault(name, []).extend(values)
+        return super().process(context, data)
+
+
+def source(name, **config):
+    return {"module": "test.test_attribute_aggregator.StaticSource", "name": name, "config": config}
+
+
+class TestAttributeAggregator(TestCase):
+
+    def _process(self, config, state=None):
+        aggregator = AttributeAggregator(config, {}, name="aggregator", base_url="http://localhost")
+        aggregator.next = lambda context, data: data
+        data = InternalResponse(AuthenticationInformation(None, "2019-01-01T00:00:00Z", "https://idp"))
+        data.attributes = {"mail": ["john@idp"], "isMemberOf": ["idp:group"]}
+        context = munchify({"state": {}})
+        if state is not None:
+            context.state = state
+        return aggregator, context, aggregator.process(context, data)
+
+    def test_merge(self):
+        config = {
+            "sources": [
+                source("db", delay=0.05, attributes={"isMemberOf": ["db:group"], "uid": ["db"]}),
+                source("sbs", attributes={"isMemberOf": ["sbs:group"], "uid": ["sbs"], "sshKey": ["key"]}),
+            ],
+            "precedence": {"uid": ["sbs"]},
+            "merge": ["isMemberOf"],
+        }
+        _, context, data = self._process(config)
+        self.assertEqual(["john@idp"], data.attributes["mail"])
+        self.assertEqual(["idp:group", "db:group", "sbs:group"], data.attributes["isMemberOf"])
+        self.assertEqual(["sbs"], data.attributes["uid"])
+        self.assertEqual(["key"], data.attributes["sshKey"])
+        self.assertEqual({"timed_out": [], "failed": []}, context.state[STATE_KEY])
+
+    def test_deadline(self):
+        config = {
+            "deadline": 0.1,
+            "sources": [
+                source("slow", delay=1, attributes={"uid": ["slow"]}),
+                source("fast", attributes={"uid": ["fast"]}),
+                source("broken", fail=True, attributes={}),
+            ],
+        }
+        start = time.monotonic()
+        aggregator, context, data = self._process(config)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(["fast"], data.attributes["uid"])
+        self.assertEqual({"timed_out": ["slow"], "failed": ["broken"]}, context.state[STATE_KEY])
+        self.assertEqual(1, aggregator.stats()["slow"]["timed_out"])
+
+    def test_state(self):
+        state = State()
+        state["SATOSA_BASE"] = {"requester": "https://sp"}
+        state["shared"] = {"idp": 1}
+        state["old"] = {"idp": 1}
+        config = {
+            "sources": [
+                source("db", delay=0.05, attributes={}, state={"shared": {"db": 1}, "db": {"db": 1}},
+                       delete_state=["old"]),
+                source("sbs", attributes={}, state={"shared": {"sbs": 1}, "sbs": {"sbs": 1}}),
+                source("broken", fail=True, attributes={}, state={"broken": {}}),
+            ],
+            "precedence": {"shared": ["sbs"]},
+        }
+        _, context, _ = self._process(config, state)
+        self.assertEqual({"requester": "https://sp"}, state["SATOSA_BASE"])
+        self.assertEqual({"idp": 1, "sbs": 1}, state["shared"])
+        self.assertEqual({"db": 1}, state["db"])
+        self.assertEqual({"sbs": 1}, state["sbs"])
+        self.assertNotIn("old", state)
+        self.assertNotIn("broken", state)
+        self.assertEqual({"timed_out": [], "failed": ["broken"]}, state[STATE_KEY])
@@ -0,0 +1,99 @@
+from unittest import TestCase, mock, skipIf
+
+from satosa.response import Redirect
+
+from benchmark import standin, synthetic
+from scz_micro_services.attribute_hash import attribute_digests, attributes_hash, legacy_hash
+
+try:
+    import MySQLdb
+    from scz_micro_services.attribute_check import STATE_KEY, AttributeCheck
+except ImportError:
+    MySQLdb = None
+
+ATTRIBUTES = {"mail": ["john@example.org"], "isMemberOf": ["co:a", "co:b"]}
+
+
+@skipIf(MySQLdb is None, "MySQLdb is not installed")
+class TestAttributeCheck(TestCase):
+
+    def setUp(self):
+        self.database = standin.Database(0, 0)
+        self.addCleanup(self.database.close)
+        patch = mock.patch.object(MySQLdb, "connect", self.database.connect)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _check(self, **config):
+        # A host per database keeps the connection pools of the tests apart
+        config = dict({"db_host": self.database.uri, "db_user": "test", "db_password": "secret", "db_schema": "test",
+                       "changed": "/changed"}, **config)
+        check = AttributeCheck(config, {"attributes": {}}, name="check", base_url="http://localhost")
+        check.next = lambda context, data: data
+        self.addCleanup(check.close)
+        return check
+
+    @staticmethod
+    def _process(check, attributes):
+        context, data = synthetic.make_request(1, 0)
+        data.attributes = {name: list(values) for name, values in attributes.items()}
+        return context, check.process(context, data)
+
+    @staticmethod
+    def _checkouts(check):
+        return check._get_pool(check.sp_config.default).stats()["checkouts"]
+
+    def _stored(self):
+        connection = self.database.connect()
+        cursor = connection.cursor()
+        cursor.execute("SELECT `hash`, `digests` FROM `attributes_hash` WHERE `nameid`=%s", [synthetic.user_id(1)])
+        row = cursor.fetchone()
+        connection.close()
+        return row
+
+    def test_verified(self):
+        check = self._check(verified_ttl=60)
+        for _ in range(3):
+            _, result = self._process(check, ATTRIBUTES)
+            self.assertNotIsInstance(result, Redirect)
+        # Only the first login read and stored the hash
+        self.assertEqual(1, self._checkouts(check))
+        self.assertEqual(2, check.stats()["hits"])
+        self.assertEqual(attributes_hash(attribute_digests(ATTRIBUTES)), self._stored()[0])
+
+        # A changed attribute is not taken from the verified cache
+        _, result = self._process(check, dict(ATTRIBUTES, mail=["john@org.com"]))
+        self.assertIsInstance(result, Redirect)
+        self.assertEqual(2, self._checkouts(check))
+
+    def test_changed(self):
+        check = self._check(store_digests=True)
+        self._process(check, ATTRIBUTES)
+
+        context, result = self._process(check, dict(ATTRIBUTES, mail=["john@org.com"], name=["John"]))
+        self.assertIsInstance(result, Redirect)
+        self.assertIn(("Location", "/changed"), result.headers)
+        self.assertDictEqual({"changed": ["mail", "name"]}, context.state[STATE_KEY])
+
+        # The new hash was stored, the next login passes
+        context, result = self._process(check, dict(ATTRIBUTES, mail=["john@org.com"], name=["John"]))
+        self.assertNotIsInstance(result, Redirect)
+        self.assertNotIn(STATE_KEY, context.state.state_dict)
+
+    def test_legacy_migration(self):
+        connection = self.database.connect()
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO `attributes_hash` (`nameid`, `hash`) VALUES (%s, %s)",
+                       [synthetic.user_id(1), legacy_hash(ATTRIBUTES)])
+        connection.commit()
+        connection.close()
+
+        check = self._check(write_behind=True, write_behind_flush_interval=60)
+        _, result = self._process(check, ATTRIBUTES)
+        self.assertNotIsInstance(result, Redirect)
+        # Queued, not yet written
+        self.assertEqual(legacy_hash(ATTRIBUTES), self._stored()[0])
+
+        check.close()
+        self.assertEqual(attributes_hash(attribute_digests(ATTRIBUTES)), self._stored()[0])
+        self.assertEqual(1, check.component_stats()["write_behind"]["flushed"])
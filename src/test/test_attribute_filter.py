@@ -0,0 +1,108 @@
+import re
+from unittest import TestCase
+
+from munch import munchify
+from satosa.util import get_dict_defaults
+
+from scz_micro_services.attribute_filter import AttributeFilter
+
+CONFIG = {
+    "attribute_allow": {
+        "default": {
+            "default": {
+                "": [""],
+            },
+        },
+        "https://idp1": {
+            "https://sp1": {
+                "mail$": ["@example\\.org$", "^admin"],
+                "^(mail|eppn)$": ["^john"],
+                "^isMemberOf": [],
+            },
+            "": {
+                "^eppn$": ["@idp1\\.org$"],
+            },
+        },
+    },
+    "attribute_deny": {
+        "default": {
+            "default": {
+                "^eppn": ["^[^@]+$"],
+            },
+        },
+        "https://idp1": {
+            "https://sp1": {
+                "mail": ["^admin@"],
+                "isMemberOf": ["^co:secret$"],
+            },
+        },
+    },
+}
+
+ATTRIBUTES = {
+    "mail": ["john@example.org", "admin@example.org", "admin@other.org", "jane@other.org"],
+    "eppn": ["john@idp1.org", "jane", "jane@idp2.org"],
+    "isMemberOf": ["co:one", "co:secret"],
+    "displayName": ["John Doe"],
+}
+
+
+def reference_apply_filter(config, attributes, provider, requester):
+    """
+    The filter as it was implemented before the rules were compiled
+    """
+    def filter_attributes(filters):
+        attributes_filter = {}
+        for f, fv in filters.items():
+            for a in attributes.keys():
+                if re.compile(f).search(a):
+                    attributes_filter.setdefault(a, []).extend(fv)
+        return {a: list(filter(re.compile("|".join(f)).search, attributes.get(a, None))) for a, f in
+                attributes_filter.items()}
+
+    allow = filter_attributes(get_dict_defaults(config.get("attribute_allow", {}), provider, requester))
+    deny = filter_attributes(get_dict_defaults(config.get("attribute_deny", {}), provider, requester))
+    for a, v in deny.items():
+        for r in v:
+            if a in allow and r in allow[a]:
+                allow[a].remove(r)
+    return {a: v for a, v in allow.items() if len(v)}
+
+
+class TestAttributeFilter(TestCase):
+
+    def _process(self, config, issuer, requester):
+        attribute_filter = AttributeFilter(config, name="attribute_filter", base_url="http://localhost")
+        attribute_filter.__dict__["next"] = lambda ctx, data: data
+        data = munchify({"attributes": {a: list(v) for a, v in ATTRIBUTES.items()},
+                         "auth_info": {"issuer": issuer},
+                         "requester": requester})
+        context = munchify({"state": {}})
+        return attribute_filter.process(context, data).attributes
+
+    def test_same_as_reference(self):
+        for issuer, requester in [("https://idp1", "https://sp1"), ("https://idp1", "https://sp2"),
+                                  ("https://idp2", "https://sp1")]:
+            self.assertEqual(reference_apply_filter(CONFIG, ATTRIBUTES, issuer, requester),
+                             self._process(CONFIG, issuer, requester))
+
+    def test_filter(self):
+        attributes = self._process(CONFIG, "https://idp1", "https://sp1")
+        self.assertEqual({"mail": ["john@example.org"],
+                          "eppn": ["john@idp1.org"],
+                          "isMemberOf": ["co:one"]}, attributes)
+
+    def test_plan_cache(self):
+        attribute_filter = AttributeFilter(CONFIG, name="attribute_filter", base_url="http://localhost")
+        context = munchify({"state": {}})
+        for _ in range(3):
+            attribute_filter._apply_filter(context, ATTRIBUTES, "https://idp1", "https://sp1")
+        attribute_filter._apply_filter(context, {"mail": ["john@example.org"]}, "https://idp1", "https://sp1")
+
+        stats = attribute_filter.plan_cache.stats()
+        self.assertEqual(2, stats["size"])
+        self.assertEqual(2, stats["hits"])
+        self.assertEqual(2, stats["misses"])
+
+    def test_empty_config(self):
+        self.assertEqual({}, self._process({}, "https://idp1", "https://sp1"))
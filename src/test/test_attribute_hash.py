@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from scz_micro_services.attribute_hash import (attribute_digests, attributes_hash, changed_attributes, encode_digests,
+                                               is_legacy, legacy_hash)
+
+ATTRIBUTES = {"mail": ["john@example.org", "john@org.com"],
+              "isMemberOf": ["co:{}".format(i) for i in range(10)],
+              "uid": "urn:john"}
+
+
+class TestAttributeHash(TestCase):
+
+    def test_canonical(self):
+        reordered = {"uid": "urn:john",
+                     "isMemberOf": list(reversed(ATTRIBUTES["isMemberOf"])),
+                     "mail": ["john@org.com", "john@example.org"]}
+        self.assertEqual(attributes_hash(attribute_digests(ATTRIBUTES)), attributes_hash(attribute_digests(reordered)))
+
+        # Values are length prefixed, moving a separator changes the hash
+        self.assertNotEqual(attributes_hash(attribute_digests({"a": ["b,c"]})),
+                            attributes_hash(attribute_digests({"a": ["b", "c"]})))
+        self.assertNotEqual(attributes_hash(attribute_digests({"ab": ["c"]})),
+                            attributes_hash(attribute_digests({"a": ["bc"]})))
+
+        # Values are type tagged, a string and a number with the same text differ
+        self.assertNotEqual(attributes_hash(attribute_digests({"a": ["1", 1]})),
+                            attributes_hash(attribute_digests({"a": [1, 1]})))
+        self.assertNotEqual(attributes_hash(attribute_digests({"a": [1]})),
+                            attributes_hash(attribute_digests({"a": [True]})))
+        self.assertNotEqual(attributes_hash(attribute_digests({"a": ["s\0", "r1"]})),
+                            attributes_hash(attribute_digests({"a": ["\0", 1]})))
+
+    def test_changed_attributes(self):
+        stored = encode_digests(attribute_digests(ATTRIBUTES))
+        attributes = dict(ATTRIBUTES, mail=["john@example.org"], name=["John"])
+        del attributes["uid"]
+        self.assertListEqual(["mail", "name", "uid"], changed_attributes(attribute_digests(attributes), stored))
+        self.assertListEqual([], changed_attributes(attribute_digests(ATTRIBUTES), stored))
+
+    def test_legacy(self):
+        self.assertTrue(is_legacy(legacy_hash(ATTRIBUTES)))
+        self.assertFalse(is_legacy(attributes_hash(attribute_digests(ATTRIBUTES))))
+        self.assertEqual(legacy_hash(ATTRIBUTES), legacy_hash(dict(ATTRIBUTES, mail=list(reversed(ATTRIBUTES["mail"])))))
@@ -0,0 +1,20 @@
+from unittest import TestCase
+
+from scz_micro_services.attribute_merge import AttributeMerger, extend_unique, loads
+
+
+class TestAttributeMerge(TestCase):
+
+    def test_merge(self):
+        merger = AttributeMerger()
+        for row in ['{"isMemberOf": ["co:b", "co:a"], "uid": "john"}',
+                    '{"isMemberOf": ["co:a", "co:c", "co:b"], "uid": "john", "mail": ["john@example.org"]}']:
+            merger.add(loads(row))
+
+        self.assertDictEqual({"isMemberOf": ["co:b", "co:a", "co:c"], "uid": ["john"], "mail": ["john@example.org"]},
+                             merger.values)
+
+    def test_extend_unique(self):
+        values = ["a", "b"]
+        self.assertIs(values, extend_unique(values, ["c", "a", "c", "d"]))
+        self.assertListEqual(["a", "b", "c", "d"], values)
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+from base64 import urlsafe_b64encode
+from unittest import TestCase
+
+from munch import munchify
+from satosa.exception import SATOSAStateError
+from satosa.internal_data import AuthenticationInformation, InternalResponse
+from satosa.response import Redirect
+from satosa.state import State
+
+from scz_micro_services.breakout import STATE_KEY, BreakOut
+from scz_micro_services.state_store import SqliteStateStore, encode
+
+
+class TestBreakOut(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _breakout(self, state_store=None):
+        config = {"redirect_url": "/static/breakout"}
+        if state_store:
+            config["state_store"] = state_store
+        breakout = BreakOut(config, {}, name="MyBreakOut", base_url="http://localhost")
+        breakout.next = lambda context, data: data
+        return breakout
+
+    @staticmethod
+    def _internal_response():
+        internal_response = InternalResponse(AuthenticationInformation(None, "2019-01-01T00:00:00Z", "https://idp"))
+        internal_response.user_id = "urn:john"
+        internal_response.requester = "https://sp"
+        internal_response.attributes = {"isMemberOf": ["co:{}".format(i) for i in range(100)]}
+        return internal_response
+
+    def _resume(self, breakout):
+        context = munchify({"state": {}})
+        self.assertIsInstance(breakout.process(context, self._internal_response()), Redirect)
+        data = breakout._handle_endpoint(context)
+        self.assertEqual("urn:john", data.user_id)
+        self.assertListEqual(self._internal_response().attributes["isMemberOf"], data.attributes["isMemberOf"])
+        return context
+
+    def test_inline(self):
+        breakout = self._breakout()
+        self.assertEqual("MyBreakOut", breakout.name)
+        with self.assertLogs("satosa.MyBreakOut", "DEBUG") as logs:
+            context = self._resume(breakout)
+        self.assertIn("internal_resp", context.state[STATE_KEY])
+        self.assertTrue(any("Keeping internal response of" in message for message in logs.output))
+
+    def test_inline_cookie_size(self):
+        # SATOSA compresses the whole state, compressing the response before that only adds to the cookie
+        saved_response = self._internal_response().to_dict()
+        plain = State()
+        plain[STATE_KEY] = {"internal_resp": saved_response}
+        compressed = State()
+        compressed[STATE_KEY] = {"internal_resp_z": urlsafe_b64encode(encode(saved_response)).decode("ascii")}
+        self.assertLess(len(plain.urlstate("key")), len(compressed.urlstate("key")))
+
+        context = self._resume(self._breakout())
+        self.assertEqual({"internal_resp": saved_response}, context.state[STATE_KEY])
+
+    def test_state_store(self):
+        for state_store in [{"type": "memory"}, {"type": "sqlite", "path": os.path.join(self.directory, "state.db")}]:
+            breakout = self._breakout(state_store)
+            context = self._resume(breakout)
+            self.assertListEqual(["key"], list(context.state[STATE_KEY]))
+
+            # A resumed state can't be replayed
+            self.assertIsNone(breakout.state_store.get(context.state[STATE_KEY]["key"]))
+            breakout.resumed = False
+            with self.assertRaises(SATOSAStateError):
+                breakout._handle_endpoint(context)
+
+    def test_sqlite_expiry(self):
+        now = [0]
+        store = SqliteStateStore(os.path.join(self.directory, "state.db"), ttl=10, timer=lambda: now[0])
+        key = store.put(b"value")
+        self.assertEqual(b"value", store.get(key))
+        now[0] = 11
+        self.assertIsNone(store.get(key))
@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+from scz_micro_services.cache import TTLCache
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(TestCase):
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = TTLCache(maxsize=10, ttl=60, timer=clock)
+        cache.set("positive", {"mail": ("john@example.org",)})
+        cache.set("negative", {}, ttl=10)
+
+        clock.now = 9
+        self.assertEqual({}, cache.get("negative"))
+        self.assertEqual({"mail": ("john@example.org",)}, cache.get("positive"))
+
+        clock.now = 10
+        self.assertIsNone(cache.get("negative"))
+        clock.now = 60
+        self.assertEqual("gone", cache.get("positive", "gone"))
+
+        stats = cache.stats()
+        self.assertEqual(2, stats["hits"])
+        self.assertEqual(2, stats["misses"])
+        self.assertEqual(2, stats["expirations"])
+        self.assertEqual(0, stats["size"])
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(1, cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(3, cache.get("c"))
+        self.assertEqual(1, cache.stats()["evictions"])
+        self.assertEqual(2, len(cache))
@@ -0,0 +1,49 @@
+from unittest import TestCase
+
+from scz_micro_services.circuit_breaker import CircuitBreaker
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_open_half_open_close(self):
+        clock = Clock()
+        breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=30, timer=clock)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual("closed", breaker.state)
+        breaker.record_failure()
+        self.assertEqual("open", breaker.state)
+        self.assertFalse(breaker.allow())
+
+        clock.now = 30
+        self.assertEqual("half_open", breaker.state)
+        self.assertTrue(breaker.allow())
+        # Only one trial call while half open
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual("closed", breaker.state)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        clock = Clock()
+        breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=30, timer=clock)
+        breaker.record_failure()
+        clock.now = 30
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual("open", breaker.state)
+        clock.now = 59
+        self.assertFalse(breaker.allow())
+
+        stats = breaker.stats()
+        self.assertEqual(2, stats["opened"])
+        self.assertEqual(1, stats["rejections"])
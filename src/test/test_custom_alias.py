@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from munch import munchify
+
+from scz_micro_services.custom_alias import CustomAlias
+from scz_micro_services.file_cache import FileCache
+
+
+class TestCustomAlias(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, "page.html"), "w") as f:
+            f.write("<p>Hello</p>")
+        with open(os.path.join(self.directory, "denied.html"), "w", encoding="utf-8") as f:
+            f.write("<p>Access denied by %custom% for %user%</p>")
+        self.custom_alias = CustomAlias({"locations": {"static": self.directory}}, name="custom_alias",
+                                        base_url="http://localhost")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _handle(self, path, state=None, **headers):
+        return self.custom_alias._handle(munchify({"_path": path, "state": state or {}, "http_headers": headers}))
+
+    def test_handle(self):
+        response = self._handle("static/page.html")
+        self.assertEqual("200 OK", response.status)
+        self.assertEqual(b"<p>Hello</p>", response.message)
+        headers = dict(response.headers)
+        self.assertEqual("text/html", headers["Content-Type"])
+        self.assertEqual("public, max-age=300", headers["Cache-Control"])
+
+        response = self._handle("static/page.html", HTTP_IF_NONE_MATCH=headers["ETag"])
+        self.assertEqual("304 Not Modified", response.status)
+        self.assertEqual(b"", response.message)
+
+        response = self._handle("static/page.html", HTTP_IF_MODIFIED_SINCE=headers["Last-Modified"])
+        self.assertEqual("304 Not Modified", response.status)
+
+        response = self._handle("static/missing.html")
+        self.assertTrue(response.message.startswith("Not found"))
+
+    def test_substitutions(self):
+        state = {"substitutions": {"%custom%": "https://idp.example.org/ø"}}
+        response = self._handle("static/denied.html", state)
+        self.assertEqual("<p>Access denied by https://idp.example.org/ø for %user%</p>".encode("utf-8"),
+                         response.message)
+        headers = dict(response.headers)
+        self.assertEqual("text/html; charset=utf-8", headers["Content-Type"])
+        self.assertEqual("no-store", headers["Cache-Control"])
+
+        # Pages without placeholders are static
+        response = self._handle("static/page.html", state)
+        self.assertEqual(b"<p>Hello</p>", response.message)
+        self.assertIn("ETag", dict(response.headers))
+
+    def test_file_cache_reload(self):
+        path = os.path.join(self.directory, "page.html")
+        file_cache = FileCache(check_interval=0)
+        self.assertEqual(b"<p>Hello</p>", file_cache.get(path).body)
+        self.assertEqual(b"<p>Hello</p>", file_cache.get(path).body)
+
+        with open(path, "w") as f:
+            f.write("<p>Changed</p>")
+        self.assertEqual(b"<p>Changed</p>", file_cache.get(path).body)
+        stats = file_cache.stats()
+        self.assertEqual((1, 1, 1), (stats["misses"], stats["hits"], stats["reloads"]))
@@ -28,3 +28,18 @@ class TestCustomUid(TestCase):
         c_uid.process(context, data)
 
         self.assertEqual("u|r|n|:|j|o|h|n|u|r|n|:|t|a|r|g|e|t", data.user_id)
+
+    def test_custom_uid_name_id(self):
+        c_uid = CustomUID({"select": ["eduPersonTargetedID", "eduPersonPrincipalName"], "custom_attribute": "cmuid",
+                           "user_id": False}, name="custom_uid", base_url="http://localhost")
+        c_uid.__dict__["next"] = lambda ctx, data: data
+        name_id = '<saml:NameID xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion">urn:target</saml:NameID>'
+
+        for _ in range(2):
+            data = munchify({"name_id": None, "attributes": {"eduPersonTargetedID": [name_id],
+                                                             "eduPersonPrincipalName": ["john@example.org", "<john"]}})
+            c_uid.process(munchify({"state": {}}), data)
+            self.assertListEqual(["urn:target|john@example.org|<john"], data.attributes["cmuid"])
+
+        self.assertEqual(2, len(c_uid.parse_cache))
+        self.assertEqual(2, c_uid.parse_cache.stats()["hits"])
@@ -0,0 +1,204 @@
+import os
+import time
+from unittest import TestCase, mock, skipIf
+
+import yaml
+
+from benchmark import standin, synthetic
+from scz_micro_services.cache import TTLCache
+
+try:
+    import MySQLdb
+    from scz_micro_services.db_attribute_store import DBAttributeStore
+except ImportError:
+    MySQLdb = None
+
+INTERNAL_ATTRIBUTES = os.path.join(os.path.dirname(os.path.realpath(__file__)), "internal_attributes.yaml")
+OTHER_SP = "https://other.example.org"
+
+
+class Timer(object):
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@skipIf(MySQLdb is None, "MySQLdb is not installed")
+class TestDBAttributeStore(TestCase):
+
+    def setUp(self):
+        # Users 0, 1 and 2 with two memberships each, in the zones of synthetic.SP and OTHER_SP
+        self.database = standin.Database(3, 2, services=(synthetic.SP, OTHER_SP))
+        self.addCleanup(self.database.close)
+        patch = mock.patch.object(MySQLdb, "connect", self.database.connect)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _store(self, **config):
+        # A host per database keeps the connection pools of the tests apart
+        config = dict({"db_host": self.database.uri, "db_user": "test", "db_password": "secret", "db_schema": "test",
+                       "idp_identifiers": ["eduPersonPrincipalName"], "user_id": False}, **config)
+        with open(INTERNAL_ATTRIBUTES) as f:
+            internal_attributes = yaml.safe_load(f)
+        store = DBAttributeStore(config, internal_attributes, name="store", base_url="http://localhost")
+        store.next = lambda context, data: data
+        self.addCleanup(store.close)
+        return store
+
+    def _snapshot_store(self, **config):
+        store = self._store(snapshot=True, **config)
+        deadline = time.monotonic() + 5
+        while not all(stats["loaded"] for stats in store.stats().values()) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return store
+
+    def _cached_store(self, **config):
+        store = self._store(cache_ttl=60, **config)
+        self.timer = Timer()
+        store.cache = TTLCache(maxsize=10, ttl=60, timer=self.timer)
+        return store
+
+    def _execute(self, query, args=()):
+        connection = self.database.connect()
+        cursor = connection.cursor()
+        cursor.execute(query, args)
+        cursor.close()
+        connection.commit()
+        connection.close()
+
+    @staticmethod
+    def _process(store, n, eppns=None, requester=synthetic.SP):
+        context, data = synthetic.make_request(n, 0, requester=requester)
+        if eppns is not None:
+            data.attributes["eduPersonPrincipalName"] = eppns
+        return store.process(context, data)
+
+    @staticmethod
+    def _stats(store):
+        return store._get_pool(store.sp_config.default).stats()
+
+    def _fail(self, store):
+        """
+        Take the DB away, the idle connections are closed and connecting times out
+        """
+        def connect(**kwargs):
+            raise OSError("timed out")
+
+        patch = mock.patch.object(MySQLdb, "connect", connect)
+        patch.start()
+        self.addCleanup(patch.stop)
+        store._get_pool(store.sp_config.default).close()
+
+    def test_process(self):
+        store = self._store()
+        data = self._process(store, 1)
+        self.assertListEqual(["urn:collab:org:1:co0", "urn:collab:org:1:co1"], data.attributes["isMemberOf"])
+        self.assertListEqual(["urn:mace:example.org:entitlement1"], data.attributes["eduPersonEntitlement"])
+
+    def test_cache(self):
+        store = self._cached_store()
+        for _ in range(2):
+            data = self._process(store, 1)
+            self.assertListEqual(["urn:collab:org:1:co0", "urn:collab:org:1:co1"], data.attributes["isMemberOf"])
+        # The repeated login did not query
+        self.assertEqual(1, self._stats(store)["checkouts"])
+        stats = store.cache.stats()
+        self.assertEqual((1, 1), (stats["hits"], stats["misses"]))
+
+        self.timer.now = 61
+        self._process(store, 1)
+        self.assertEqual(2, self._stats(store)["checkouts"])
+        self.assertEqual(1, store.cache.stats()["expirations"])
+
+    def test_cache_eviction(self):
+        store = self._cached_store()
+        store.cache = TTLCache(maxsize=1, ttl=60, timer=self.timer)
+        for n in [1, 2, 1]:
+            self._process(store, n)
+        self.assertEqual(3, self._stats(store)["checkouts"])
+        self.assertEqual(2, store.cache.stats()["evictions"])
+
+    def test_cache_negative(self):
+        store = self._cached_store()
+        for _ in range(2):
+            data = self._process(store, 3)
+            self.assertListEqual([], data.attributes["isMemberOf"])
+        self.assertEqual(1, self._stats(store)["checkouts"])
+
+        # Empty results are kept for cache_negative_ttl seconds
+        self.timer.now = 11
+        self._process(store, 3)
+        self.assertEqual(2, self._stats(store)["checkouts"])
+
+    def test_cache_opt_out(self):
+        store = self._cached_store(**{OTHER_SP: {"cache": False}})
+        for _ in range(3):
+            data = self._process(store, 1, requester=OTHER_SP)
+            self.assertListEqual(["urn:collab:org:1:co0", "urn:collab:org:1:co1"], data.attributes["isMemberOf"])
+        self.assertEqual(3, self._stats(store)["checkouts"])
+        self.assertEqual(0, len(store.cache))
+
+    def test_max_rows(self):
+        store = self._store(db_max_rows=1)
+        self.assertTrue(store._select(1).endswith("LIMIT 2"))
+
+        data = self._process(store, 0, [synthetic.eppn(0), synthetic.eppn(1)])
+        self.assertEqual(2, len(data.attributes["isMemberOf"]))
+        # The rest of the result is not read, the connection is closed instead
+        self.assertEqual(1, self._stats(store)["discards"])
+
+        data = self._process(store, 2)
+        self.assertListEqual(["urn:collab:org:2:co0", "urn:collab:org:2:co1"], data.attributes["isMemberOf"])
+
+    def test_max_bytes(self):
+        store = self._store(db_max_bytes=10)
+        data = self._process(store, 1)
+        self.assertListEqual([], data.attributes["isMemberOf"])
+        self.assertNotIn("eduPersonEntitlement", data.attributes)
+        self.assertEqual(1, self._stats(store)["discards"])
+
+    def test_collation(self):
+        # MySQL compares uid and metadata without case and trailing spaces, so does the snapshot
+        self._execute("UPDATE `zone_people` SET `uid`=%s WHERE `id`=1", ["User1@Example.ORG "])
+        for store in [self._store(), self._snapshot_store()]:
+            data = self._process(store, 1, requester=synthetic.SP.upper())
+            self.assertListEqual(["urn:collab:org:1:co0", "urn:collab:org:1:co1"], data.attributes["isMemberOf"])
+
+    def test_snapshot_limits(self):
+        store = self._snapshot_store(db_max_rows=1)
+        data = self._process(store, 0, [synthetic.eppn(0), synthetic.eppn(1)])
+        self.assertEqual(2, len(data.attributes["isMemberOf"]))
+
+        store = self._snapshot_store(db_max_bytes=10, db_schema="max_bytes")
+        data = self._process(store, 1)
+        self.assertListEqual([], data.attributes["isMemberOf"])
+
+    def test_stale(self):
+        store = self._store(stale_max_age=3600)
+        self._process(store, 1)
+        self._fail(store)
+
+        data = self._process(store, 1)
+        self.assertListEqual(["urn:collab:org:1:co0", "urn:collab:org:1:co1"], data.attributes["isMemberOf"])
+        self.assertListEqual(["urn:mace:example.org:entitlement1"], data.attributes["eduPersonEntitlement"])
+        self.assertEqual(1, store.last_good.stats()["hits"])
+
+    def test_stale_missing(self):
+        store = self._store(stale_max_age=3600)
+        self._process(store, 1)
+        self._fail(store)
+
+        # Nothing is known about user 2, the IdP attributes pass through unchanged
+        context, data = synthetic.make_request(2, 0)
+        self.assertEqual(synthetic.make_attributes(2, 0), store.process(context, data).attributes)
+
+    def test_timeouts(self):
+        connects = []
+        connect = self.database.connect
+        with mock.patch.object(MySQLdb, "connect", lambda **kwargs: connects.append(kwargs) or connect(**kwargs)):
+            store = self._store(db_connect_timeout=2, db_read_timeout=5, db_query_timeout=1.5)
+            data = self._process(store, 1)
+        self.assertListEqual(["urn:collab:org:1:co0", "urn:collab:org:1:co1"], data.attributes["isMemberOf"])
+        self.assertEqual((2, 5), (connects[-1]["connect_timeout"], connects[-1]["read_timeout"]))
+        self.assertIn("SELECT /*+ MAX_EXECUTION_TIME(1500) */ ", store._select(1))
@@ -0,0 +1,152 @@
+import threading
+from unittest import TestCase, mock, skipIf
+
+from scz_micro_services.db_pool import ConnectionPool, PoolTimeout, get_pool, pool_stats
+
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+
+
+class FakeConnection(object):
+
+    def __init__(self, alive=True):
+        self.alive = alive
+        self.closed = False
+        self.rollbacks = 0
+
+    def ping(self):
+        if not self.alive:
+            raise Exception("MySQL server has gone away")
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestConnectionPool(TestCase):
+
+    def test_reuse(self):
+        created = []
+
+        def connect():
+            created.append(FakeConnection())
+            return created[-1]
+
+        pool = ConnectionPool(connect, size=2)
+        for _ in range(5):
+            with pool.connection() as connection:
+                self.assertIs(created[0], connection)
+
+        self.assertEqual(1, len(created))
+        self.assertEqual(5, created[0].rollbacks)
+        stats = pool.stats()
+        self.assertEqual(5, stats["checkouts"])
+        self.assertEqual(1, stats["connects"])
+        self.assertEqual(1, stats["idle"])
+        self.assertEqual(0, stats["in_use"])
+
+    def test_autocommit(self):
+        pool = ConnectionPool(FakeConnection, size=1, rollback=False)
+        for _ in range(3):
+            with pool.connection() as connection:
+                pass
+        self.assertEqual(0, connection.rollbacks)
+
+    def test_discard_on_error(self):
+        pool = ConnectionPool(FakeConnection, size=1)
+        with self.assertRaises(ValueError):
+            with pool.connection() as connection:
+                raise ValueError("boom")
+
+        self.assertTrue(connection.closed)
+        with pool.connection() as other:
+            self.assertIsNot(connection, other)
+        self.assertEqual(1, pool.stats()["discards"])
+
+    def test_reconnect_on_failed_ping(self):
+        pool = ConnectionPool(FakeConnection, size=1, ping_interval=0)
+        with pool.connection() as connection:
+            connection.alive = False
+        with pool.connection() as other:
+            self.assertIsNot(connection, other)
+
+        self.assertTrue(connection.closed)
+        self.assertEqual(1, pool.stats()["reconnects"])
+
+    def test_timeout(self):
+        pool = ConnectionPool(FakeConnection, size=1, timeout=0.05)
+        with pool.connection():
+            with self.assertRaises(PoolTimeout):
+                with pool.connection():
+                    pass
+
+        stats = pool.stats()
+        self.assertEqual(1, stats["timeouts"])
+        self.assertEqual(1, stats["waits"])
+
+    def test_waiter_gets_released_connection(self):
+        pool = ConnectionPool(FakeConnection, size=1, timeout=5)
+        checked_out = threading.Event()
+        got = []
+
+        def waiter():
+            checked_out.wait()
+            with pool.connection() as c:
+                got.append(c)
+
+        t = threading.Thread(target=waiter)
+        t.start()
+        with pool.connection() as connection:
+            checked_out.set()
+        t.join()
+
+        self.assertEqual([connection], got)
+        self.assertEqual(1, pool.stats()["connects"])
+
+    def test_shared_per_key(self):
+        key = ("db.example.org", "test_shared_per_key", "schema")
+        pool = get_pool(key, FakeConnection)
+        self.assertIs(pool, get_pool(key, FakeConnection, size=10))
+        self.assertIsNot(pool, get_pool(("db.example.org", "other", "schema"), FakeConnection))
+
+    def test_connect_options(self):
+        key = ("db.example.org", "test_connect_options", "schema")
+        with self.assertLogs("satosa", "WARNING"):
+            pool = get_pool(key, FakeConnection, size=2)
+            self.assertIs(pool, get_pool(key, FakeConnection, size=10))
+        bounded = get_pool(key, FakeConnection, options={"read_timeout": 5, "connect_timeout": 2})
+        self.assertIsNot(pool, bounded)
+        self.assertIs(bounded, get_pool(key, FakeConnection, options={"connect_timeout": 2, "read_timeout": 5}))
+        self.assertIn("test_connect_options@db.example.org/schema?connect_timeout=2&read_timeout=5", pool_stats())
+
+    @skipIf(MySQLdb is None, "MySQLdb is not installed")
+    def test_shared_between_services(self):
+        from scz_micro_services.attribute_check import AttributeCheck
+        from scz_micro_services.db_attribute_store import DBAttributeStore
+
+        db = {"db_host": "db.example.org", "db_user": "test_shared_between_services", "db_schema": "schema",
+              "db_password": "secret"}
+        connects = []
+        with mock.patch.object(MySQLdb, "connect", lambda **kwargs: connects.append(kwargs) or FakeConnection()):
+            check = AttributeCheck(dict(db, changed="/changed"), {"attributes": {}}, name="check", base_url="")
+            store = DBAttributeStore(dict(db, idp_identifiers=[], user_id=True, db_pool_size=2, db_read_timeout=5),
+                                     {"attributes": {}}, name="store", base_url="")
+            check_pool = check._get_pool(check.sp_config.default)
+            store_pool = store._get_pool(store.sp_config.default)
+            self.assertIsNot(check_pool, store_pool)
+            self.assertEqual(2, store_pool.size)
+            with store_pool.connection():
+                pass
+            self.assertEqual(5, connects[-1]["read_timeout"])
+            # Lookups don't pay a rollback on every release
+            self.assertTrue(connects[-1]["autocommit"])
+            self.assertFalse(store_pool.rollback)
+
+            # Both services connect the same way, the same settings give the same pool
+            check = AttributeCheck(dict(db, changed="/changed", db_pool_size=2, db_read_timeout=5),
+                                   {"attributes": {}}, name="check", base_url="")
+            self.assertIs(store_pool, check._get_pool(check.sp_config.default))
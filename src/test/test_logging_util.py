@@ -0,0 +1,96 @@
+import logging
+from unittest import TestCase
+
+from munch import munchify
+
+from scz_micro_services.attribute_filter import AttributeFilter
+from scz_micro_services.custom_uid import CustomUID
+from scz_micro_services.logging_util import get_logger, log
+from scz_micro_services.r_and_s_acl import RandSAcl
+
+
+class Value(str):
+    """
+    An attribute value that counts how often it is serialized
+    """
+    serialized = 0
+
+    def __repr__(self):
+        Value.serialized += 1
+        return super().__repr__()
+
+    def __str__(self):
+        Value.serialized += 1
+        return super().__str__()
+
+    def __format__(self, format_spec):
+        Value.serialized += 1
+        return super().__format__(format_spec)
+
+
+class TestLogging(TestCase):
+
+    def setUp(self):
+        self.satosa_logger = logging.getLogger("satosa")
+        self.level = self.satosa_logger.level
+        Value.serialized = 0
+
+    def tearDown(self):
+        self.satosa_logger.setLevel(self.level)
+
+    def test_log_defers_formatting(self):
+        logger = get_logger("test_log_defers_formatting")
+        self.satosa_logger.setLevel(logging.INFO)
+        log(logger, logging.DEBUG, "{} attributes {}", None, "PREFIX:", [Value("john")])
+        self.assertEqual(0, Value.serialized)
+
+        self.satosa_logger.setLevel(logging.DEBUG)
+        log(logger, logging.DEBUG, "{} attributes {}", None, "PREFIX:", [Value("john")])
+        self.assertEqual(1, Value.serialized)
+
+    def test_log_level_override(self):
+        self.satosa_logger.setLevel(logging.INFO)
+        logger = get_logger("test_log_level_override", {"log_level": "debug"})
+        self.assertEqual("satosa.test_log_level_override", logger.name)
+        self.assertTrue(logger.isEnabledFor(logging.DEBUG))
+        self.assertFalse(get_logger("test_log_level_default", {}).isEnabledFor(logging.DEBUG))
+
+    def _process(self, level):
+        self.satosa_logger.setLevel(level)
+        services = [
+            CustomUID({"select": ["eduPersonPrincipalName", "mail"], "custom_attribute": "cmuid", "user_id": False},
+                      name="custom_uid", base_url="http://localhost"),
+            AttributeFilter({"attribute_allow": {"": {"": {"": [""]}}}},
+                            name="attribute_filter", base_url="http://localhost"),
+            RandSAcl({"attribute_mapping": {"edupersonprincipalname": "eduPersonPrincipalName",
+                                            "edupersontargetedid": "eduPersonTargetedID",
+                                            "displayname": "displayName",
+                                            "givenname": "givenName",
+                                            "sn": "sn",
+                                            "mail": "mail"},
+                      "access_denied": "/static/denied"},
+                     name="r_and_s_acl", base_url="http://localhost"),
+        ]
+        for service in services:
+            service.next = lambda ctx, data: data
+
+        data = munchify({"name_id": None,
+                         "requester": "https://sp",
+                         "auth_info": {"issuer": "https://idp"},
+                         "attributes": {"eduPersonPrincipalName": [Value("john@example.org")],
+                                        "displayName": [Value("John Doe")],
+                                        "mail": [Value("john@example.org")],
+                                        "isMemberOf": [Value("co:{}".format(i)) for i in range(100)]}})
+        context = munchify({"state": {}})
+        for service in services:
+            data = service.process(context, data)
+        return data
+
+    def test_no_attribute_serialization_at_info(self):
+        data = self._process(logging.INFO)
+        self.assertEqual(["john@example.org|john@example.org"], data.attributes["cmuid"])
+        self.assertEqual(0, Value.serialized)
+
+    def test_attribute_serialization_at_debug(self):
+        self._process(logging.DEBUG)
+        self.assertGreater(Value.serialized, 0)
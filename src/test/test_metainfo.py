@@ -0,0 +1,71 @@
+import time
+from unittest import TestCase
+
+from munch import munchify
+
+from scz_micro_services.metainfo import MetaInfo
+
+IDP = "https://idp.example.org"
+
+
+class MetadataStore(object):
+
+    def __init__(self, names):
+        self.metadata = {"eduGAIN": dict(names)}
+        self.lookups = 0
+
+    def name(self, issuer):
+        self.lookups += 1
+        return self.metadata["eduGAIN"].get(issuer)
+
+    def __getitem__(self, issuer):
+        return {"extensions": {"extension_elements": [{"registration_authority": "http://www.example.nl/"}]}}
+
+    def identity_providers(self):
+        return list(self.metadata["eduGAIN"])
+
+
+class TestMetaInfo(TestCase):
+
+    def _process(self, meta_info, metadata_store):
+        data = munchify({"auth_info": {"issuer": IDP}, "attributes": {}})
+        context = munchify({"state": {}, "internal_data": {"metadata_store": metadata_store}})
+        return meta_info.process(context, data)
+
+    def _meta_info(self, **config):
+        meta_info = MetaInfo(dict(config, exceptions={"https://incommon.org": "us"}), {}, name="metainfo",
+                             base_url="http://localhost")
+        meta_info.next = lambda context, data: data
+        return meta_info
+
+    def test_index(self):
+        meta_info = self._meta_info()
+        metadata_store = MetadataStore({IDP: "Example IdP"})
+
+        for _ in range(3):
+            data = self._process(meta_info, metadata_store)
+            self.assertListEqual(["Example IdP"], data.attributes["idp_name"])
+            self.assertListEqual(["nl"], data.attributes["idp_country"])
+        self.assertEqual(1, metadata_store.lookups)
+
+        # Reloaded metadata replaces the sources, the index is rebuilt
+        metadata_store.metadata = {"eduGAIN": {IDP: "Renamed IdP"}}
+        data = self._process(meta_info, metadata_store)
+        self.assertListEqual(["Renamed IdP"], data.attributes["idp_name"])
+        self.assertEqual(2, metadata_store.lookups)
+
+    def test_prebuild(self):
+        meta_info = self._meta_info(prebuild=True)
+        metadata_store = MetadataStore({IDP: "Example IdP", "https://other.example.org": None})
+        data = self._process(meta_info, metadata_store)
+        self.assertListEqual(["Example IdP"], data.attributes["idp_name"])
+
+        # The other issuer is indexed in the background, without a login
+        deadline = time.monotonic() + 5
+        while len(meta_info.index) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(2, len(meta_info.index))
+
+        lookups = metadata_store.lookups
+        self._process(meta_info, metadata_store)
+        self.assertEqual(lookups, metadata_store.lookups)
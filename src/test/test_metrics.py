@@ -0,0 +1,112 @@
+import gc
+import time
+from unittest import TestCase
+
+from munch import munchify
+from satosa.micro_services.base import ResponseMicroService
+from satosa.response import Redirect
+
+from scz_micro_services.cache import TTLCache
+from scz_micro_services.circuit_breaker import CircuitBreaker
+from scz_micro_services.db_pool import get_pool
+from scz_micro_services.instrumentation import REGISTRY, Instrumented, Registry
+from scz_micro_services.metrics import Metrics
+
+
+class Sleepy(Instrumented, ResponseMicroService):
+
+    def process(self, context, data):
+        with self.backend("db"):
+            time.sleep(0.01)
+        if data == "redirect":
+            return Redirect("/denied")
+        if data == "error":
+            raise ValueError(data)
+        return super().process(context, data)
+
+
+class Cached(Instrumented, ResponseMicroService):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = TTLCache(maxsize=10, ttl=60)
+        self.circuit_breaker = CircuitBreaker("backend", failure_threshold=1)
+
+    def component_stats(self):
+        return {"cache": self.cache.stats(), "circuit_breaker": self.circuit_breaker.stats()}
+
+
+class Broken(Instrumented, ResponseMicroService):
+
+    def component_stats(self):
+        raise RuntimeError("broken")
+
+
+class TestMetrics(TestCase):
+
+    def tearDown(self):
+        REGISTRY.enabled = False
+        REGISTRY.clear()
+
+    def test_metrics(self):
+        service = Sleepy(name="sleepy", base_url="http://localhost")
+
+        def downstream(context, data):
+            time.sleep(0.1)
+            return data
+
+        service.next = downstream
+        context = munchify({"state": {}})
+        service.process(context, "data")
+        self.assertNotIn("sleepy", REGISTRY.render())
+
+        metrics = Metrics({}, name="metrics", base_url="http://localhost")
+        self.assertEqual("^metrics$", metrics.register_endpoints()[0][0])
+        self.assertEqual("data", service.process(context, "data"))
+        self.assertIsInstance(service.process(context, "redirect"), Redirect)
+        with self.assertRaises(ValueError):
+            service.process(context, "error")
+
+        text = metrics._handle(context).message
+        for outcome in ["pass_through", "redirect", "error"]:
+            self.assertIn('satosa_micro_service_outcomes_total{{service="sleepy",outcome="{}"}} 1'.format(outcome),
+                          text)
+        self.assertIn('satosa_micro_service_backend_seconds_count{service="sleepy",backend="db"} 3', text)
+        self.assertIn('satosa_micro_service_process_seconds_count{service="sleepy"} 3', text)
+        # The time spent downstream is not counted
+        self.assertIn('satosa_micro_service_process_seconds_bucket{service="sleepy",le="0.1"} 3', text)
+
+    def test_component_stats(self):
+        service = Cached(name="cached", base_url="http://localhost")
+        service.cache.get("missing")
+        service.circuit_breaker.record_failure()
+        get_pool(("db.example.org", "metrics", "schema"), lambda: None, size=3)
+
+        metrics = Metrics({}, name="metrics", base_url="http://localhost")
+        text = metrics._handle(munchify({"state": {}})).message
+        self.assertIn("# TYPE satosa_micro_service_stat gauge", text)
+        self.assertIn('satosa_micro_service_stat{service="cached",component="cache",stat="misses"} 1', text)
+        self.assertIn('satosa_micro_service_stat{service="cached",component="cache",stat="maxsize"} 10', text)
+        self.assertIn('satosa_micro_service_stat{service="cached",component="circuit_breaker",stat="failures"} 1',
+                      text)
+        self.assertIn('satosa_micro_service_stat{service="cached",component="circuit_breaker",stat="state_open"} 1',
+                      text)
+        self.assertIn('satosa_micro_service_stat{service="db_pool",component="metrics@db.example.org/schema",'
+                      'stat="size"} 3', text)
+
+        # A service that is gone is no longer exported
+        del service
+        gc.collect()
+        self.assertNotIn('service="cached"', REGISTRY.render())
+
+    def test_component_stats_error(self):
+        registry = Registry()
+        service = Broken(name="broken", base_url="http://localhost")
+        registry.add_service(service)
+        registry.add_collector("shared", lambda: {"pool": {"size": 2, "loaded": True, "age": None}})
+        with self.assertLogs("satosa", "WARNING"):
+            text = registry.render()
+        self.assertNotIn('service="broken"', text)
+        self.assertIn('satosa_micro_service_stat{service="shared",component="pool",stat="loaded"} 1', text)
+        self.assertIn('satosa_micro_service_stat{service="shared",component="pool",stat="size"} 2', text)
+        self.assertNotIn('stat="age"', text)
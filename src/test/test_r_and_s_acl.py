@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+from munch import munchify
+from satosa.exception import SATOSAConfigurationError
+from satosa.internal_data import AuthenticationInformation, InternalResponse
+from satosa.response import Redirect
+
+from scz_micro_services.r_and_s_acl import RandSAcl, Requirement
+
+ATTRIBUTE_MAPPING = {
+    "edupersonprincipalname": "eduPersonPrincipalName",
+    "edupersontargetedid": "eduPersonTargetedID",
+    "displayname": "displayName",
+    "givenname": "givenName",
+    "sn": "surname",
+    "mail": "mail",
+}
+
+
+class TestRandSAcl(TestCase):
+
+    def test_requirement(self):
+        requirement = Requirement("edupersonprincipalname and (displayname or (givenname and sn)) and mail",
+                                  ATTRIBUTE_MAPPING)
+        self.assertEqual(2, len(requirement.masks))
+        attributes = {"eduPersonPrincipalName": ["john@idp"], "mail": ["john@example.org"], "givenName": ["John"]}
+        self.assertFalse(requirement.matches(attributes))
+        attributes["surname"] = ["Doe"]
+        self.assertTrue(requirement.matches(attributes))
+        attributes["mail"] = [""]
+        self.assertFalse(requirement.matches(attributes))
+
+        # Sets that contain a smaller set are dropped
+        self.assertEqual(1, len(Requirement("mail or (mail and sn)", ATTRIBUTE_MAPPING).masks))
+
+        for expression in ["mail and", "(mail or sn", "mail sn", "unknown"]:
+            with self.assertRaises(SATOSAConfigurationError):
+                Requirement(expression, ATTRIBUTE_MAPPING)
+
+    def test_process(self):
+        acl = RandSAcl({"attribute_mapping": ATTRIBUTE_MAPPING, "access_denied": "/static/denied",
+                        "https://coco": {"requirement": "edupersontargetedid or edupersonprincipalname"}},
+                       name="r_and_s_acl", base_url="http://localhost")
+        acl.next = lambda context, data: data
+        data = InternalResponse(AuthenticationInformation(None, "2019-01-01T00:00:00Z", "https://idp"))
+        data.attributes = {"eduPersonPrincipalName": ["john@idp"]}
+
+        data.requester = "https://sp"
+        context = munchify({"state": {}})
+        self.assertIsInstance(acl.process(context, data), Redirect)
+        self.assertEqual({"%custom%": "https://idp"}, context.state["substitutions"])
+
+        data.requester = "https://coco"
+        self.assertIs(data, acl.process(munchify({"state": {}}), data))
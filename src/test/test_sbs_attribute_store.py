@@ -1,8 +1,12 @@
 # -*- coding: future_fstrings -*-
 import json
 import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from unittest import TestCase
 
+import requests
 import requests_mock
 import yaml
 from munch import munchify
@@ -62,7 +66,139 @@ class TestSBSAttributeStore(TestCase):
 
         self.assertEqual(0, len(data.attributes))
 
-    def _do_test_process(self, m, config, satosa_base_requester_key="requester", status_code=200):
+    @requests_mock.mock()
+    def test_process_circuit_breaker(self, m):
+        config = munchify({
+            "sbs_api_user": "sysread",
+            "sbs_api_password": "secret",
+            "sbs_api_base_url": "http://localhost/",
+            "sbs_retries": 0,
+            "sbs_breaker_failure_threshold": 2})
+        sbs_attribute_store = self._sbs_attribute_store(config)
+        m.get("http://localhost/api/users/attributes", exc=requests.exceptions.ConnectTimeout)
+
+        for _ in range(3):
+            data, context = self._data_and_context()
+            sbs_attribute_store.process(context, data)
+            self.assertEqual(0, len(data.attributes))
+
+        self.assertEqual(2, m.call_count)
+        stats = sbs_attribute_store.circuit_breaker.stats()
+        self.assertEqual("open", stats["state"])
+        self.assertEqual(1, stats["rejections"])
+
+    @requests_mock.mock()
+    def test_process_cache(self, m):
+        config = munchify({
+            "sbs_api_user": "sysread",
+            "sbs_api_password": "secret",
+            "sbs_api_base_url": "http://localhost/",
+            "sbs_cache_size": 10})
+        sbs_attribute_store = self._sbs_attribute_store(config)
+        json_response = json.loads(self._read_file("mock/sbs_attributes.json"))
+        m.get("http://localhost/api/users/attributes", [
+            {"json": json_response, "headers": {"ETag": '"v1"', "Cache-Control": "max-age=60"}},
+            {"status_code": 304, "headers": {"ETag": '"v1"', "Cache-Control": "max-age=0"}}])
+
+        for _ in range(2):
+            data, context = self._data_and_context()
+            sbs_attribute_store.process(context, data)
+            self.assertListEqual(["John Doe"], data.attributes["name"])
+        self.assertEqual(1, m.call_count)
+
+        # Expire the cached entry, the next lookup is a conditional request
+        key = ("urn:john", "https://service_id")
+        entry = sbs_attribute_store.cache.get(key)
+        sbs_attribute_store.cache.set(key, entry._replace(fresh_until=0, stale_until=0))
+        data, context = self._data_and_context()
+        sbs_attribute_store.process(context, data)
+
+        self.assertEqual(2, m.call_count)
+        self.assertEqual('"v1"', m.last_request.headers["If-None-Match"])
+        self.assertListEqual(["AI computing", "ai_res"], sorted(data.attributes["isMemberOf"]))
+
+    @requests_mock.mock()
+    def test_process_single_flight(self, m):
+        config = munchify({
+            "sbs_api_user": "sysread",
+            "sbs_api_password": "secret",
+            "sbs_api_base_url": "http://localhost/"})
+        sbs_attribute_store = self._sbs_attribute_store(config)
+        json_response = json.loads(self._read_file("mock/sbs_attributes.json"))
+
+        def slow(text):
+            def callback(request, context):
+                time.sleep(0.2)
+                return text
+            return callback
+
+        def process_concurrently():
+            results = []
+
+            def process():
+                data, context = self._data_and_context()
+                try:
+                    sbs_attribute_store.process(context, data)
+                    results.append(data.attributes.get("name"))
+                except ValueError as err:
+                    results.append(err)
+
+            threads = [threading.Thread(target=process) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return results
+
+        m.get("http://localhost/api/users/attributes", text=slow(json.dumps(json_response)))
+        self.assertListEqual([["John Doe"]] * 5, process_concurrently())
+        self.assertEqual(1, m.call_count)
+        self.assertEqual(4, sbs_attribute_store.stats()["requests"]["coalesced"])
+
+        # Every waiter gets the error of the shared request
+        m.get("http://localhost/api/users/attributes", text=slow("not json"))
+        results = process_concurrently()
+        self.assertEqual(5, len([r for r in results if isinstance(r, ValueError)]))
+        self.assertEqual(2, m.call_count)
+
+    def test_process_retry_after(self):
+        requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                requests_seen.append(self.path)
+                self.send_response(503)
+                self.send_header("Retry-After", "3")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        config = munchify({
+            "sbs_api_user": "sysread",
+            "sbs_api_password": "secret",
+            "sbs_api_base_url": f"http://127.0.0.1:{server.server_port}/",
+            "sbs_read_timeout": 1,
+            "sbs_retries": 2,
+            "sbs_retry_backoff": 0.01})
+        sbs_attribute_store = self._sbs_attribute_store(config)
+        data, context = self._data_and_context()
+        start = time.monotonic()
+        sbs_attribute_store.process(context, data)
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(3, len(requests_seen))
+        self.assertEqual(0, len(data.attributes))
+
+    def _sbs_attribute_store(self, config):
         internal_attributes = yaml.load(self._read_file("internal_attributes.yaml"))
         sbs_attribute_store = SBSAttributeStore(config,
                                                 internal_attributes,
@@ -73,10 +209,19 @@ class TestSBSAttributeStore(TestCase):
             pass
 
         sbs_attribute_store.__dict__["next"] = next_call
+        return sbs_attribute_store
+
+    @staticmethod
+    def _data_and_context(satosa_base_requester_key="requester"):
         data = munchify({"user_id": "urn:john", "attributes": {}, "auth_info": {"issuer": "https://idp"}})
         context = munchify(
             {"state": {"state_dict": {"SATOSA_BASE": {satosa_base_requester_key: "https://service_id"}}}})
-        m.get("http://localhost/api/user_service_profiles/attributes",
+        return data, context
+
+    def _do_test_process(self, m, config, satosa_base_requester_key="requester", status_code=200):
+        sbs_attribute_store = self._sbs_attribute_store(config)
+        data, context = self._data_and_context(satosa_base_requester_key)
+        m.get("http://localhost/api/users/attributes",
               json=json.loads(self._read_file("mock/sbs_attributes.json")),
               status_code=status_code)
         sbs_attribute_store.process(context, data)
@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+from scz_micro_services.sp_config import REQUIRED, SPConfig
+
+OPTIONS = [
+    ("db_host", REQUIRED),
+    ("db_password", REQUIRED),
+    ("idp_identifiers", REQUIRED),
+    ("blacklist", []),
+    ("cache", True),
+]
+
+
+class TestSPConfig(TestCase):
+
+    def test_resolve(self):
+        sp_config = SPConfig({"db_host": "localhost",
+                              "db_password": "secret",
+                              "idp_identifiers": ["eppn"],
+                              "blacklist": None,
+                              "https://sp1": {"db_host": "other", "cache": False},
+                              "https://sp2": {"idp_identifiers": ["uid", "eppn"]}},
+                             OPTIONS, secrets=["db_password"])
+
+        default = sp_config.get("https://unknown")
+        self.assertIs(sp_config.default, default)
+        self.assertEqual(("localhost", "secret", ("eppn",), (), True), default)
+
+        sp1 = sp_config.get("https://sp1")
+        self.assertEqual("other", sp1.db_host)
+        self.assertFalse(sp1.cache)
+        self.assertEqual(("uid", "eppn"), sp_config.get("https://sp2").idp_identifiers)
+        self.assertEqual(3, len(sp_config.all()))
+
+        self.assertNotIn("secret", repr(sp1))
+        self.assertIn("XXXXXXXX", repr(sp1))
+
+    def test_unknown(self):
+        with self.assertLogs("satosa", "WARNING") as logs:
+            sp_config = SPConfig({"db_host": "localhost",
+                                  "db_password": "secret",
+                                  "idp_identifiers": ["eppn"],
+                                  "blacklists": {"https://sp1": True},
+                                  "urn:mace:example.org:sp2": {"db_hots": "other", "cache": False}},
+                                 OPTIONS)
+
+        # A misspelled option is not taken for an SP
+        self.assertListEqual(["urn:mace:example.org:sp2"], list(sp_config.per_sp))
+        sp2 = sp_config.get("urn:mace:example.org:sp2")
+        self.assertEqual("localhost", sp2.db_host)
+        self.assertFalse(sp2.cache)
+        self.assertEqual(2, len(logs.output))
+        self.assertIn("blacklists", logs.output[0])
+        self.assertIn("db_hots", logs.output[1])
+
+    def test_incomplete(self):
+        sp_config = SPConfig({"db_host": "localhost",
+                              "https://sp1": {"db_password": "secret", "idp_identifiers": ["eppn"]}},
+                             OPTIONS)
+
+        self.assertIsNone(sp_config.get("https://unknown"))
+        self.assertEqual("localhost", sp_config.get("https://sp1").db_host)
+        self.assertEqual(1, len(sp_config.all()))
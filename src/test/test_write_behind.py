@@ -0,0 +1,56 @@
+import threading
+from unittest import TestCase
+
+from scz_micro_services.write_behind import WriteBehindQueue
+
+
+class TestWriteBehindQueue(TestCase):
+
+    def test_batch_and_drain(self):
+        batches = []
+        writer = WriteBehindQueue(batches.append, batch_size=3, flush_interval=60)
+        for i in range(7):
+            self.assertTrue(writer.put("user{}".format(i % 5), i))
+        writer.close()
+
+        flushed = [row for batch in batches for row in batch]
+        self.assertEqual({"user0": 5, "user1": 6, "user2": 2, "user3": 3, "user4": 4}, dict(flushed))
+        self.assertTrue(all(len(batch) <= 3 for batch in batches))
+        self.assertIsNone(writer.pending("user0"))
+        self.assertEqual(0, writer.stats()["pending"])
+        self.assertFalse(writer.put("user0", 8))
+
+    def test_pending_until_flushed(self):
+        release = threading.Event()
+        flushed = threading.Event()
+
+        def flush(rows):
+            release.wait()
+            flushed.set()
+
+        writer = WriteBehindQueue(flush, flush_interval=0)
+        writer.put("john", "hash")
+        self.assertEqual("hash", writer.pending("john"))
+        release.set()
+        flushed.wait(5)
+        writer.close()
+        self.assertIsNone(writer.pending("john"))
+
+    def test_overflow(self):
+        release = threading.Event()
+        writer = WriteBehindQueue(lambda rows: release.wait(), queue_size=1, batch_size=1, flush_interval=0)
+        results = [writer.put("user{}".format(i), i) for i in range(5)]
+        self.assertIn(False, results)
+        self.assertGreater(writer.stats()["overflows"], 0)
+        release.set()
+        writer.close()
+
+    def test_failed_flush(self):
+        def flush(rows):
+            raise Exception("DB down")
+
+        writer = WriteBehindQueue(flush, flush_interval=0)
+        writer.put("john", "hash")
+        writer.close()
+        self.assertEqual(1, writer.stats()["failures"])
+        self.assertIsNone(writer.pending("john"))
@@ -0,0 +1,150 @@
+import json
+import sqlite3
+from unittest import TestCase
+
+from scz_micro_services.db_pool import ConnectionPool
+from scz_micro_services.zone_snapshot import ZoneSnapshot
+
+
+class Connection(object):
+    """
+    An SQLite connection that takes MySQLdb style %s parameters
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self):
+        return Cursor(self._connection.cursor())
+
+    def rollback(self):
+        self._connection.rollback()
+
+
+class Cursor(object):
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, args=()):
+        self._cursor.execute(query.replace("%s", "?"), args)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+class Timer(object):
+    now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestZoneSnapshot(TestCase):
+
+    def setUp(self):
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE `zone_people` (`id` INTEGER, `uid` TEXT, `attributes` TEXT, `updated` INTEGER);
+            CREATE TABLE `zone_services` (`id` INTEGER, `metadata` TEXT);
+            CREATE TABLE `zone_person_zone_service` (`zone_person_id` INTEGER, `zone_service_id` INTEGER);
+            INSERT INTO `zone_services` VALUES (1, 'https://sp1'), (2, 'https://sp2');
+            INSERT INTO `zone_person_zone_service` VALUES (1, 1), (1, 2), (2, 1);
+        """)
+        self._person(1, "john", ["co:a"], 1)
+        self._person(2, "john", ["co:b"], 1)
+        self.pool = ConnectionPool(lambda: Connection(self.db), size=1, ping_interval=3600)
+        self.timer = Timer()
+
+    def _person(self, person_id, uid, members, updated):
+        self.db.execute("DELETE FROM `zone_people` WHERE `id`=?", [person_id])
+        self.db.execute("INSERT INTO `zone_people` VALUES (?, ?, ?, ?)",
+                        [person_id, uid, json.dumps({"isMemberOf": members}), updated])
+        self.db.commit()
+
+    @staticmethod
+    def _lookup(snapshot, uids, metadata):
+        records = snapshot.lookup(uids, metadata)
+        return None if records is None else [attributes for attributes, _ in records]
+
+    def test_lookup(self):
+        snapshot = ZoneSnapshot(self.pool, max_age=60, timer=self.timer)
+        self.assertIsNone(self._lookup(snapshot, ["john"], "https://sp1"))
+
+        snapshot.refresh()
+        records = self._lookup(snapshot, ["john", "john"], "https://sp1")
+        self.assertListEqual([["co:a"], ["co:b"]], sorted(r["isMemberOf"] for r in records))
+        self.assertListEqual([{"isMemberOf": ["co:a"]}], self._lookup(snapshot, ["john"], "https://sp2"))
+        self.assertListEqual([], self._lookup(snapshot, ["jane"], "https://sp1"))
+        self.assertListEqual([({"isMemberOf": ["co:a"]}, len('{"isMemberOf": ["co:a"]}'))],
+                             snapshot.lookup(["john"], "https://sp2"))
+
+        stats = snapshot.stats()
+        self.assertEqual(2, stats["people"])
+        self.assertEqual(3, stats["memberships"])
+        self.assertFalse(stats["stale"])
+
+        self.timer.now = 61
+        self.assertIsNone(self._lookup(snapshot, ["john"], "https://sp1"))
+        self.assertTrue(snapshot.stats()["stale"])
+
+    def test_lookup_collation(self):
+        # Like the default MySQL collations, case and trailing spaces don't matter
+        self._person(2, "Jane ", ["co:b"], 1)
+        snapshot = ZoneSnapshot(self.pool, timer=self.timer)
+        snapshot.refresh()
+        self.assertListEqual([{"isMemberOf": ["co:a"]}], self._lookup(snapshot, ["JOHN  "], "HTTPS://SP2"))
+        self.assertListEqual([{"isMemberOf": ["co:b"]}], self._lookup(snapshot, ["jane"], "https://SP1 "))
+
+    def test_incremental(self):
+        snapshot = ZoneSnapshot(self.pool, updated_column="updated", timer=self.timer)
+        snapshot.refresh()
+
+        self._person(2, "jane", ["co:c"], 2)
+        snapshot.refresh()
+
+        self.assertListEqual([{"isMemberOf": ["co:a"]}], self._lookup(snapshot, ["john"], "https://sp1"))
+        self.assertListEqual([{"isMemberOf": ["co:c"]}], self._lookup(snapshot, ["jane"], "https://sp1"))
+        self.assertEqual(2, snapshot.stats()["refreshes"])
+
+    def test_incremental_same_high_water_mark(self):
+        snapshot = ZoneSnapshot(self.pool, updated_column="updated", timer=self.timer)
+        snapshot.refresh()
+
+        # Written after the refresh, with the updated value of the previous refresh
+        self._person(3, "jane", ["co:c"], 1)
+        self.db.execute("INSERT INTO `zone_person_zone_service` VALUES (3, 1)")
+        self.db.commit()
+        snapshot.refresh()
+        self.assertListEqual([{"isMemberOf": ["co:c"]}], self._lookup(snapshot, ["jane"], "https://sp1"))
+        self.assertEqual(3, snapshot.stats()["people"])
+
+    def test_incremental_removed(self):
+        snapshot = ZoneSnapshot(self.pool, updated_column="updated", timer=self.timer)
+        snapshot.refresh()
+
+        # The membership is left behind
+        self.db.execute("DELETE FROM `zone_people` WHERE `id`=2")
+        self.db.commit()
+        snapshot.refresh()
+        self.assertListEqual([{"isMemberOf": ["co:a"]}], self._lookup(snapshot, ["john"], "https://sp1"))
+        self.assertEqual(1, snapshot.stats()["people"])
+
+    def test_full_refresh(self):
+        snapshot = ZoneSnapshot(self.pool, updated_column="updated", full_refresh_interval=600, timer=self.timer)
+        snapshot.refresh()
+
+        # A change that does not move the updated column is only seen by a full refresh
+        self.db.execute("UPDATE `zone_people` SET `uid`='jane' WHERE `id`=2")
+        self.db.execute("UPDATE `zone_people` SET `updated`=0 WHERE `id`=2")
+        self.db.commit()
+        snapshot.refresh()
+        self.assertListEqual([], self._lookup(snapshot, ["jane"], "https://sp1"))
+
+        self.timer.now = 601
+        snapshot.refresh()
+        self.assertListEqual([{"isMemberOf": ["co:b"]}], self._lookup(snapshot, ["jane"], "https://sp1"))
+        self.assertEqual(2, snapshot.stats()["full_refreshes"])